@@ -1,5 +1,8 @@
 import os
+import sys
+import time
 import unittest
+import numpy
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
@@ -38,10 +41,12 @@ class UltrasoundSimulatorWidget(ScriptedLoadableModuleWidget):
   """
 
   def setup(self):
+    setupStartTime = time.time()
     ScriptedLoadableModuleWidget.setup(self)
+    self.setupTimings = [('base', time.time() - setupStartTime)]
 
     # Instantiate and connect widgets ...
-    self.iconsPath = "H:/src/S4Mods/UltrasoundSimulator/UltrasoundSimulator/Resources/Icons"
+    self.iconsPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Resources', 'Icons')
     # Used Icons
     self.recordIcon = qt.QIcon(self.iconsPath + '/icon_Record.png')
     self.playIcon = qt.QIcon(self.iconsPath + '/icon_Play.png')
@@ -52,6 +57,7 @@ class UltrasoundSimulatorWidget(ScriptedLoadableModuleWidget):
     #
     # Parameters Area
     #
+    sectionStartTime = time.time()
     self.calibrate1CollapsibleButton = ctk.ctkCollapsibleButton()
     self.calibrate1CollapsibleButton.text = "Calibrate I"
     self.layout.addWidget(self.calibrate1CollapsibleButton)
@@ -176,9 +182,20 @@ class UltrasoundSimulatorWidget(ScriptedLoadableModuleWidget):
     self.calculateTransformButton.setFixedHeight(buttonHeight)
     alignButtonLayout.addWidget(self.calculateTransformButton) 
 
+    self.placeSphereCentersButton = qt.QPushButton("Place Sphere Centers")
+    self.placeSphereCentersButton.setCheckable(False)
+    self.placeSphereCentersButton.setEnabled(False)
+    self.placeSphereCentersButton.setToolTip("Place the remaining fiducials at the sphere centers fitted on the calibration model")
+    self.placeSphereCentersButton.setSizePolicy(qt.QSizePolicy.Expanding, qt.QSizePolicy.Expanding)
+    self.placeSphereCentersButton.setFixedHeight(buttonHeight)
+    alignButtonLayout.addWidget(self.placeSphereCentersButton)
+
+    self.setupTimings.append(('calibrate1', time.time() - sectionStartTime))
+
     #
     # Calibrate 2 Area
     #
+    sectionStartTime = time.time()
     self.calibrate2CollapsibleButton = ctk.ctkCollapsibleButton()
     self.calibrate2CollapsibleButton.text = "Calibrate II"
     self.layout.addWidget(self.calibrate2CollapsibleButton)
@@ -226,19 +243,134 @@ class UltrasoundSimulatorWidget(ScriptedLoadableModuleWidget):
     self.runSimulatorButton.setSizePolicy(qt.QSizePolicy.Expanding, qt.QSizePolicy.Expanding)
     self.runSimulatorButton.setFixedHeight(buttonHeight)
     simulatorControlsLayout.addWidget(self.runSimulatorButton)
+    self.recordButton = qt.QPushButton("  Record Session")
+    self.recordButton.setCheckable(True)
+    self.recordButton.setEnabled(False)
+    self.recordButton.setIcon(self.recordIcon)
+    self.recordButton.setToolTip("Record the orientation transform and calibration transforms for replay")
+    self.recordButton.setSizePolicy(qt.QSizePolicy.Expanding, qt.QSizePolicy.Expanding)
+    self.recordButton.setFixedHeight(buttonHeight)
+    simulatorControlsLayout.addWidget(self.recordButton)
+    self.exportFramesButton = qt.QPushButton("  Export Frames")
+    self.exportFramesButton.setCheckable(True)
+    self.exportFramesButton.setEnabled(False)
+    self.exportFramesButton.setIcon(self.recordIcon)
+    self.exportFramesButton.setToolTip("Write the simulated frames and probe poses to a compressed frame store, on a background thread")
+    self.exportFramesButton.setSizePolicy(qt.QSizePolicy.Expanding, qt.QSizePolicy.Expanding)
+    self.exportFramesButton.setFixedHeight(buttonHeight)
+    simulatorControlsLayout.addWidget(self.exportFramesButton)
+
+    self.imagingModeComboBox = qt.QComboBox()
+    self.imagingModeComboBox.addItems(['B-mode', 'M-mode', 'Color Doppler'])
+    self.imagingModeComboBox.setToolTip("Imaging mode of the simulated image. Color Doppler shows the vessels of the first label map volume.")
+    self.imagingModeComboBox.setFixedHeight(buttonHeight)
+    simulatorControlsLayout.addWidget(self.imagingModeComboBox)
+
+    self.dopplerWidthRangeWidget = ctk.ctkRangeWidget()
+    self.dopplerDepthRangeWidget = ctk.ctkRangeWidget()
+    for rangeWidget, extent in ((self.dopplerWidthRangeWidget, "width"), (self.dopplerDepthRangeWidget, "depth")):
+      rangeWidget.decimals = 0
+      rangeWidget.minimum = 0
+      rangeWidget.maximum = 100
+      rangeWidget.minimumValue = 25
+      rangeWidget.maximumValue = 75
+      rangeWidget.suffix = " %"
+      rangeWidget.setToolTip("Extent of the color Doppler box, in percent of the image %s" % extent)
+    simulatorFormLayout.addRow("Doppler Box Width: ", self.dopplerWidthRangeWidget)
+    simulatorFormLayout.addRow("Doppler Box Depth: ", self.dopplerDepthRangeWidget)
+
+    self.displayRateSpinBox = qt.QSpinBox()
+    self.displayRateSpinBox.setRange(1, 120)
+    self.displayRateSpinBox.setValue(30)
+    self.displayRateSpinBox.setSuffix(" Hz")
+    self.displayRateSpinBox.setToolTip("Rate at which the views follow the orientation transform, independent of the sensor rate")
+    simulatorFormLayout.addRow("Display Rate: ", self.displayRateSpinBox)
+
+    self.backgroundRenderingCheckBox = qt.QCheckBox("Simulate image in the background")
+    self.backgroundRenderingCheckBox.setEnabled(False)
+    self.backgroundRenderingCheckBox.setToolTip("Render frames of the volume in the selected imaging mode on a worker thread, shown in the Yellow view")
+    simulatorFormLayout.addRow(self.backgroundRenderingCheckBox)
+
+    self.levelOfDetailCheckBox = qt.QCheckBox("Coarser B-mode image during fast rotations")
+    self.levelOfDetailCheckBox.setEnabled(False)
+    self.levelOfDetailCheckBox.setToolTip("Render the background B-mode image from a 2x or 4x downsampled volume while the probe rotates quickly, refined to full resolution once it stops. The downsampled volumes are built when this is first used.")
+    simulatorFormLayout.addRow(self.levelOfDetailCheckBox)
+
+    self.gainSlider = ctk.ctkSliderWidget()
+    self.gainSlider.minimum = -30
+    self.gainSlider.maximum = 30
+    self.gainSlider.value = 0
+    self.gainSlider.suffix = " dB"
+    self.gainSlider.setToolTip("Overall gain of the simulated image")
+    simulatorFormLayout.addRow("Gain: ", self.gainSlider)
+    self.dynamicRangeSlider = ctk.ctkSliderWidget()
+    self.dynamicRangeSlider.minimum = 20
+    self.dynamicRangeSlider.maximum = 100
+    self.dynamicRangeSlider.value = 60
+    self.dynamicRangeSlider.suffix = " dB"
+    self.dynamicRangeSlider.setToolTip("Range of echo amplitudes shown from black to white")
+    simulatorFormLayout.addRow("Dynamic Range: ", self.dynamicRangeSlider)
+    tgcLayout = qt.QHBoxLayout()
+    self.tgcSliders = []
+    for depthName in ("near", "middle", "far"):
+      tgcSlider = ctk.ctkSliderWidget()
+      tgcSlider.minimum = -20
+      tgcSlider.maximum = 20
+      tgcSlider.value = 0
+      tgcSlider.setToolTip("Time gain compensation (dB) of the %s field, interpolated over depth" % depthName)
+      tgcLayout.addWidget(tgcSlider)
+      self.tgcSliders.append(tgcSlider)
+    simulatorFormLayout.addRow("TGC (dB): ", tgcLayout)
+
+    #
+    # Performance Area
+    #
+    performanceCollapsibleButton = ctk.ctkCollapsibleButton()
+    performanceCollapsibleButton.text = "Performance"
+    performanceCollapsibleButton.collapsed = True
+    self.layout.addWidget(performanceCollapsibleButton)
+    performanceFormLayout = qt.QFormLayout(performanceCollapsibleButton)
+
+    performanceControlsLayout = qt.QHBoxLayout()
+    performanceFormLayout.addRow(performanceControlsLayout)
+    self.profilingCheckBox = qt.QCheckBox("Enable profiling")
+    self.profilingCheckBox.setToolTip("Time every stage of pose update and rendering")
+    performanceControlsLayout.addWidget(self.profilingCheckBox)
+    self.exportProfileButton = qt.QPushButton("Export Statistics")
+    self.exportProfileButton.setToolTip("Save the stage timings as JSON or CSV")
+    performanceControlsLayout.addWidget(self.exportProfileButton)
+    self.profileStatisticsLabel = qt.QLabel("Profiling disabled")
+    self.profileStatisticsLabel.setStyleSheet("QLabel {font-family: monospace;}")
+    performanceFormLayout.addRow(self.profileStatisticsLabel)
+    self.setupTimings.append(('calibrate2AndSimulate', time.time() - sectionStartTime))
+    sectionStartTime = time.time()
     
     # Connections
     self.calibrate2Button.connect('clicked(bool)', self.onCalibrate2Button)
     self.calculateTransformButton.connect('clicked(bool)', self.onCalculateTransformButton)
     self.alignedButton.connect('clicked(bool)', self.onAlignedButton)
+    self.placeSphereCentersButton.connect('clicked(bool)', self.onPlaceSphereCentersButton)
     self.startCalibrationButton.connect('clicked(bool)', self.onStartCalibrationButton)
     self.restartCalibrationButton.connect('clicked(bool)', self.onRestartCalibrationButton)
     self.stopCalibrationButton.connect('clicked(bool)', self.onStopCalibrationButton)
     self.IMUTransformSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onIMUTransformSelector)
     self.loadSampleVolumeButton.connect('clicked(bool)', self.onLoadSampleVolumeButton)
     self.runSimulatorButton.connect('clicked(bool)', self.onRunSimulatorButton)
+    self.displayRateSpinBox.connect('valueChanged(int)', self.onDisplayRateChanged)
+    self.recordButton.connect('toggled(bool)', self.onRecordButton)
+    self.exportFramesButton.connect('toggled(bool)', self.onExportFramesButton)
+    self.profilingCheckBox.connect('toggled(bool)', self.onProfilingCheckBox)
+    self.exportProfileButton.connect('clicked(bool)', self.onExportProfileButton)
+    self.backgroundRenderingCheckBox.connect('toggled(bool)', self.onBackgroundRenderingCheckBox)
+    self.levelOfDetailCheckBox.connect('toggled(bool)', self.onLevelOfDetailCheckBox)
+    self.imagingModeComboBox.connect('currentIndexChanged(QString)', self.onImagingModeChanged)
+    self.dopplerWidthRangeWidget.connect('valuesChanged(double,double)', self.onDopplerRoiChanged)
+    self.dopplerDepthRangeWidget.connect('valuesChanged(double,double)', self.onDopplerRoiChanged)
+    for slider in [self.gainSlider, self.dynamicRangeSlider] + self.tgcSliders:
+      slider.connect('valueChanged(double)', self.onPostProcessingChanged)
     
     # Logic and Node members
+    self.logic = UltrasoundSimulatorLogic()
     self.calibrationModelNode = None
     self.calibrationModelDisplayNode = None
     self.IMUTransformNode = None
@@ -253,23 +385,72 @@ class UltrasoundSimulatorWidget(ScriptedLoadableModuleWidget):
     self.finalTransform = None
     self.translateTransform = None
     self.maskVolumeNode = None
+    self.filteredIMUTransform = None
+    self.poseStream = None
+    self.poseStreamObservedNode = None
+    self.poseStreamObserverTag = None
+    self.displayedPose = None
+    self.poseDisplayStatistics = {'updated': 0, 'skipped': 0}
+    self.renderSink = None
+    
+    # Pose display, decoupled from IMU updates
+    self.poseDisplayTimer = qt.QTimer()
+    self.poseDisplayTimer.timeout.connect(self.onPoseDisplayTimeout)
+
+    # Refresh of the profiling statistics
+    self.profileStatisticsTimer = qt.QTimer()
+    self.profileStatisticsTimer.setInterval(1000)
+    self.profileStatisticsTimer.timeout.connect(self.updateProfileStatistics)
     
     # Parameter members
-    self.nbrOfFiducialsPlaced = 0
     self.nbrOfFiducialsToPlace = 3
         
     # Bool memebers
     self.calibrationInitialized = False
-    self.placingFiducials = False
     self.layoutOneUpRedSliceView = False
-    self.tempTransformApplied = False
     self.tempTransformAligned = False
     
-    # Calibration state
-    self.calibrationStateTimer = qt.QTimer()
-    self.calibrationStateTimer.timeout.connect(self.calibrationStateTimeOut)
-    self.currentCalibrationState = "PLACE_START_FIDUCIALS"
+    # Calibration state, advanced by button, markup and CLI events
+    from UltrasoundSimulatorLib import CalibrationStateMachine
+    self.calibrationStateMachine = CalibrationStateMachine(self.nbrOfFiducialsToPlace)
+    self.calibrationStateMachine.stateChangedCallbacks.append(self.onCalibrationStateChanged)
+    self.calibrationStateMachine.fiducialPlacedCallbacks.append(self.onCalibrationFiducialPlaced)
+    self.fiducialPlacementNode = None
+    self.fiducialPlacementObserverTag = None
+    
+    # Slice views and interactors are looked up on first use (initializeViews)
+    self.viewsInitialized = False
+    self.redInteractorObserverID = -1
+    self.greenInteractorObserverID = -1
+    self.yellowInteractorObserverID = -1  
     
+    # For disabling mouse interaction             
+    self.interactorObserverTags = []
+    self.mouseEvents = ( "LeftButtonPressEvent", "LeftButtonReleaseEvent",
+                         "MiddleButtonPressEvent", "MiddleButtonReleaseEvent",
+                         "RightButtonPressEvent", "RightButtonReleaseEvent",
+                         "MouseMoveEvent", "KeyPressEvent", "EnterEvent", "LeaveEvent",
+                         "MouseWheelForwardEvent", "MouseWheelBackwardEvent" )
+                                        
+    # Refresh state once the module panel is shown
+    qt.QTimer.singleShot(0, self.onIMUTransformSelector)
+    self.setupTimings.append(('members', time.time() - sectionStartTime))
+    self.setupSeconds = time.time() - setupStartTime
+    logging.info('UltrasoundSimulator setup: %.1f ms (%s)' % (1000 * self.setupSeconds,
+                 ', '.join('%s %.1f ms' % (name, 1000 * seconds) for name, seconds in self.setupTimings)))
+
+  def cleanup(self):
+    self.poseDisplayTimer.stop()
+    self.profileStatisticsTimer.stop()
+    self.logic.stopRenderWorker()
+    self.logic.stopFrameExport()
+
+  def initializeViews(self):
+    """Looks up the layout manager, slice views and interactors used by the
+    calibration and the simulator, the first time they are needed.
+    """
+    if self.viewsInitialized:
+      return
     # Layout manager
     self.applicationLogic = slicer.logic.vtkSlicerApplicationLogic()
     self.lm = slicer.app.layoutManager()
@@ -281,25 +462,12 @@ class UltrasoundSimulatorWidget(ScriptedLoadableModuleWidget):
     self.redInteractor = self.redSliceWidget.sliceView().interactorStyle().GetInteractor()
     self.greenInteractor = self.greenSliceWidget.sliceView().interactorStyle().GetInteractor()
     self.yellowInteractor = self.yellowSliceWidget.sliceView().interactorStyle().GetInteractor()
-    self.redInteractorObserverID = -1
-    self.greenInteractorObserverID = -1
-    self.yellowInteractorObserverID = -1  
     self.redSliceLogic = self.redSliceWidget.sliceLogic()
     self.redSliceNode = self.redSliceLogic.GetSliceNode()
     self.redSliceFGLayer = self.redSliceLogic.GetForegroundLayer()
     self.redSliceBGLayer = self.redSliceLogic.GetBackgroundLayer()
     self.redSliceCompositeNode = self.redSliceLogic.GetSliceCompositeNode()
-    
-    # For disabling mouse interaction             
-    self.interactorObserverTags = []
-    self.mouseEvents = ( "LeftButtonPressEvent", "LeftButtonReleaseEvent",
-                         "MiddleButtonPressEvent", "MiddleButtonReleaseEvent",
-                         "RightButtonPressEvent", "RightButtonReleaseEvent",
-                         "MouseMoveEvent", "KeyPressEvent", "EnterEvent", "LeaveEvent",
-                         "MouseWheelForwardEvent", "MouseWheelBackwardEvent" )
-                                        
-    # Refresh state
-    self.onIMUTransformSelector()
+    self.viewsInitialized = True
     
   def abortEvent(self, caller=None, event=None):
     """Set the AbortFlag on the vtkCommand associated
@@ -313,6 +481,7 @@ class UltrasoundSimulatorWidget(ScriptedLoadableModuleWidget):
       cmd.SetAbortFlag(1)
 
   def onCalibrate2Button(self):
+    self.initializeViews()
     self.inverseTransform = slicer.vtkMRMLLinearTransformNode()
     self.inverseTransform.SetName("InverseTransform")
     orientationTransform = self.IMUTransformNode
@@ -332,17 +501,17 @@ class UltrasoundSimulatorWidget(ScriptedLoadableModuleWidget):
     matrix.SetElement(1,3,-60)
     self.probeTransform.SetMatrixTransformToParent(matrix)
     slicer.mrmlScene.AddNode(self.probeTransform)
-    slicer.util.loadVolume("H:/src/S4Mods/UltrasoundSimulator/Data/Linear_probe.mha")
-    self.maskVolumeNode = slicer.util.getNode("Linear_probe")
+    self.maskVolumeNode = self.logic.loadDataNode("Linear_probe.mha", slicer.util.loadVolume)
     self.maskVolumeNode.SetAndObserveTransformNodeID(self.probeTransform.GetID())
     
-    slicer.util.loadVolume("H:/Data/CT/CT_abdominal_phantom.mha")
-    self.volumeCurrentlyLoaded = slicer.util.getNode("CT_abdominal_phantom")
+    self.volumeCurrentlyLoaded = self.logic.loadDataNode("CT_abdominal_phantom.mha", slicer.util.loadVolume)
     
     self.volumeCurrentlyLoaded.SetAndObserveTransformNodeID(self.translateTransform.GetID())
     
     self.IMUTransformNode.SetAndObserveTransformNodeID(self.inverseTransform.GetID())
-    self.translateTransform.SetAndObserveTransformNodeID(self.IMUTransformNode.GetID())
+    self.translateTransform.SetAndObserveTransformNodeID(self.startPoseStreaming().GetID())
+    self.logic.createTransformChain([self.translateTransform, self.filteredIMUTransform, self.inverseTransform],
+                                    self.probeTransform)
     
     self.volumeCurrentlyLoaded.GetScalarVolumeDisplayNode().SetAutoWindowLevel(False)
     self.volumeCurrentlyLoaded.GetScalarVolumeDisplayNode().SetWindowLevel(350, 40)
@@ -384,16 +553,17 @@ class UltrasoundSimulatorWidget(ScriptedLoadableModuleWidget):
     
   def onLoadSampleVolumeButton(self):
     self.loadSampleVolumeButton.enabled = False
-    slicer.util.loadVolume(self.ultrasoundSimulatorExtPath + "/Abdominal_phantom.mha")
-    self.volumeCurrentlyLoaded = getNode("Abdominal_phantom") 
+    self.volumeCurrentlyLoaded = self.logic.loadDataNode("Abdominal_phantom.mha", slicer.util.loadVolume)
     # Set W/L for volume
     self.volumeCurrentlyLoaded.GetScalarVolumeDisplayNode().SetAutoWindowLevel(False)
     self.volumeCurrentlyLoaded.GetScalarVolumeDisplayNode().SetWindowLevel(1135,197)
     self.runSimulatorButton.enabled = True  
     
   def onRunSimulatorButton(self):
+    self.initializeViews()
     self.runSimulatorButton.enabled = False
-    self.volumeCurrentlyLoaded.SetAndObserveTransformNodeID(self.IMUTransformNode.GetID())
+    self.volumeCurrentlyLoaded.SetAndObserveTransformNodeID(self.startPoseStreaming().GetID())
+    self.logic.createTransformChain([node for node in (self.filteredIMUTransform, self.saveTransform) if node])
     
     xyzOrigSampleVol = self.volumeCurrentlyLoaded.GetOrigin()
     self.volumeCurrentlyLoaded.SetOrigin(xyzOrigSampleVol[0], xyzOrigSampleVol[1] - xyzOrigSampleVol[1] / 2, xyzOrigSampleVol[2])
@@ -406,136 +576,362 @@ class UltrasoundSimulatorWidget(ScriptedLoadableModuleWidget):
       tag = self.redInteractor.AddObserver(e, self.abortEvent, 1.0)
       self.interactorObserverTags.append(tag)
       
+  def startPoseStreaming(self):
+    """Buffers IMU updates in a pose stream instead of re-rendering on each of
+    them. Returns the transform node that follows the filtered IMU pose at the
+    display rate; it replaces the IMU transform in the volume's transform chain.
+    """
+    if not self.filteredIMUTransform:
+      self.filteredIMUTransform = slicer.vtkMRMLLinearTransformNode()
+      self.filteredIMUTransform.SetName("FilteredIMUTransform")
+      slicer.mrmlScene.AddNode(self.filteredIMUTransform)
+    self.filteredIMUTransform.SetAndObserveTransformNodeID(self.IMUTransformNode.GetTransformNodeID())
+    if self.poseStreamObserverTag is not None:
+      self.poseStreamObservedNode.RemoveObserver(self.poseStreamObserverTag)
+    self.poseStream = self.logic.createPoseStream()
+    self.poseStreamObservedNode = self.IMUTransformNode
+    self.poseStreamObserverTag = self.logic.observeTransformNode(self.poseStream, self.IMUTransformNode)
+    self.poseStream.addSample(self.logic.arrayFromVTKMatrix(self.IMUTransformNode.GetMatrixTransformToParent()))
+    self.displayedPose = None
+    self.onPoseDisplayTimeout()
+    self.poseDisplayTimer.start(int(1000 / self.displayRateSpinBox.value))
+    self.recordButton.enabled = True
+    self.exportFramesButton.enabled = True
+    self.backgroundRenderingCheckBox.enabled = True
+    self.levelOfDetailCheckBox.enabled = True
+    return self.filteredIMUTransform
+
+  def onPoseDisplayTimeout(self):
+    # displayRenderResult counts the frames it shows, a tick that only
+    # reslices the views is counted below, so every tick counts once
+    displayedRenderResult = bool(self.renderSink) and self.logic.displayRenderResult(self.renderSink) is not None
+    if not self.poseStream.hasNewSamples() and not self.poseStream.displayDelay:
+      self.onIdleDisplayTick()
+      return
+    pose = self.poseStream.poseAt()
+    if self.displayedPose is not None:
+      # Reslicing the views is skipped for changes below the frame cache tolerances
+      from UltrasoundSimulatorLib import poseDifference
+      angle, distance = poseDifference(self.displayedPose, pose)
+      tolerances = self.logic.frameCacheTolerances
+      if angle <= tolerances['rotationTolerance'] and distance <= tolerances['translationTolerance']:
+        self.poseDisplayStatistics['skipped'] += 1
+        self.onIdleDisplayTick()
+        return
+    self.poseDisplayStatistics['updated'] += 1
+    self.displayedPose = pose
+    with self.logic.profiler.stage('poseUpdate'):
+      self.logic.setTransformNodeMatrix(self.filteredIMUTransform, pose)
+    if self.logic.renderWorker:
+      self.logic.renderWorker.submit(self.logic.transformChain.probeToVolume())
+    if not displayedRenderResult:
+      self.logic.profiler.frame()
+
+  def onIdleDisplayTick(self):
+    if self.logic.renderWorker and self.logic.imagingMode == 'M-mode':
+      # The M-mode sweep advances by one column per tick, also while the probe is still
+      self.logic.renderWorker.submit(self.logic.transformChain.probeToVolume())
+    else:
+      # The probe stopped, a frame rendered coarser while it moved is refined
+      self.logic.refineRenderWorkerFrame()
+
+  def onRecordButton(self, checked):
+    from UltrasoundSimulatorLib import SessionRecording
+    if not checked:
+      self.logic.stopSessionRecording()
+      self.recordButton.setText("  Record Session")
+      return
+    path = os.path.join(slicer.app.temporaryPath, time.strftime("UltrasoundSimulatorSession-%Y%m%d-%H%M%S.usrec"))
+    if self.translateTransform:
+      # Calibrate II chain: volume -> TranslateTransform -> IMU -> InverseTransform
+      calibrationTransformNodes = {SessionRecording.TRANSLATE: self.translateTransform,
+                                   SessionRecording.INVERSE: self.inverseTransform,
+                                   SessionRecording.PROBE: self.probeTransform}
+      chain = [SessionRecording.TRANSLATE, SessionRecording.IMU, SessionRecording.INVERSE]
+    else:
+      # Calibrate I chain: volume -> IMU -> EndToStartTransform
+      calibrationTransformNodes = {SessionRecording.END_TO_START: self.saveTransform}
+      chain = [SessionRecording.IMU, SessionRecording.END_TO_START]
+    self.logic.startSessionRecording(path, self.IMUTransformNode, calibrationTransformNodes, chain)
+    self.recordButton.setText("  Stop Recording")
+    logging.info('Recording session to ' + path)
+
+  def onExportFramesButton(self, checked):
+    if not checked:
+      self.logic.stopFrameExport()
+      self.exportFramesButton.setText("  Export Frames")
+      return
+    path = os.path.join(slicer.app.temporaryPath, time.strftime("UltrasoundSimulatorFrames-%Y%m%d-%H%M%S"))
+    self.logic.startFrameExport(path)
+    self.exportFramesButton.setText("  Stop Export")
+    logging.info('Exporting frames to ' + path)
+
+  def onBackgroundRenderingCheckBox(self, enabled):
+    if not enabled:
+      self.logic.stopRenderWorker()
+      return
+    mode = self.imagingModeComboBox.currentText
+    if mode == 'Color Doppler' and self.logic.flowModel is None:
+      labelMapNodes = slicer.util.getNodesByClass('vtkMRMLLabelMapVolumeNode')
+      if labelMapNodes:
+        self.logic.setFlowModel(labelMapNodes[0])
+      else:
+        logging.warning('No label map volume with vessels, color Doppler shows no flow')
+    volumeArray, spacing, origin, directions = self.logic.getVolumeArrayAndGeometry(self.volumeCurrentlyLoaded)
+    levelOfDetail = self.levelOfDetailCheckBox.checked and mode == 'B-mode'
+    worker = self.logic.startRenderWorker(volumeArray, spacing, origin, directions, mode=mode,
+                                          levelOfDetail=levelOfDetail)
+    renderer = self.logic.imagingModeRenderer
+    shape = renderer.frameShape
+    numberOfComponents = 3 if mode == 'Color Doppler' else 1
+    if (not self.renderSink or not slicer.mrmlScene.IsNodePresent(self.renderSink.volumeNode)
+        or self.renderSink.shape != tuple(shape) or self.renderSink.numberOfComponents != numberOfComponents):
+      if self.renderSink and slicer.mrmlScene.IsNodePresent(self.renderSink.volumeNode):
+        slicer.mrmlScene.RemoveNode(self.renderSink.volumeNode)
+      probe = self.logic.bModeRenderer.probe
+      self.renderSink = self.logic.createDisplaySink(shape, (probe.sampleSpacing, probe.scanlineSpacing),
+                                                    numberOfComponents=numberOfComponents)
+      yellowSliceLogic = self.lm.sliceWidget('Yellow').sliceLogic()
+      yellowSliceLogic.GetSliceCompositeNode().SetBackgroundVolumeID(self.renderSink.volumeNode.GetID())
+      yellowSliceLogic.FitSliceToAll()
+    worker.submit(self.logic.transformChain.probeToVolume())
+
+  def onImagingModeChanged(self, mode):
+    if self.backgroundRenderingCheckBox.checked:
+      self.onBackgroundRenderingCheckBox(True)
+
+  def onDopplerRoiChanged(self, minimumValue=None, maximumValue=None):
+    self.logic.setDopplerRoiFractions(
+      (self.dopplerWidthRangeWidget.minimumValue / 100.0, self.dopplerWidthRangeWidget.maximumValue / 100.0),
+      (self.dopplerDepthRangeWidget.minimumValue / 100.0, self.dopplerDepthRangeWidget.maximumValue / 100.0))
+    if self.backgroundRenderingCheckBox.checked and self.imagingModeComboBox.currentText == 'Color Doppler':
+      self.onBackgroundRenderingCheckBox(True)
+
+  def onLevelOfDetailCheckBox(self, enabled):
+    if self.backgroundRenderingCheckBox.checked:
+      self.onBackgroundRenderingCheckBox(True)
+
+  def onPostProcessingChanged(self, value=None):
+    # Only the lookup table stage re-runs on the last simulated frame
+    frame = self.logic.setPostProcessing(self.gainSlider.value, self.dynamicRangeSlider.value,
+                                         [slider.value for slider in self.tgcSliders])
+    if (frame is not None and self.renderSink and self.logic.imagingMode == 'B-mode'
+        and self.renderSink.shape == frame.shape):
+      self.renderSink.write(frame)
+
+  def onProfilingCheckBox(self, enabled):
+    self.logic.setProfilingEnabled(enabled)
+    if enabled:
+      self.profileStatisticsTimer.start()
+    else:
+      self.profileStatisticsTimer.stop()
+    self.updateProfileStatistics()
+
+  def updateProfileStatistics(self):
+    if not self.logic.profiler.enabled:
+      self.profileStatisticsLabel.setText("Profiling disabled")
+      return
+    statistics = self.logic.profiler.statistics()
+    lines = ["%d frames, %.1f frames/s" % (statistics['frames'], statistics['framesPerSecond']),
+             "%-12s %8s %8s %8s %8s" % ("stage (ms)", "p50", "p95", "p99", "max")]
+    for name in sorted(statistics['stages']):
+      stage = statistics['stages'][name]
+      lines.append("%-12s %8.2f %8.2f %8.2f %8.2f" % (name, stage['p50'], stage['p95'], stage['p99'], stage['max']))
+    if self.logic.renderWorker:
+      worker = self.logic.renderWorker.statistics()
+      lines.append("worker: pose to display p50 %.1f ms, p95 %.1f ms, %d of %d poses dropped"
+                   % (worker['latency']['p50'], worker['latency']['p95'],
+                      worker['droppedRequests'] + worker['droppedResults'], worker['submitted']))
+    self.profileStatisticsLabel.setText("\n".join(lines))
+
+  def onExportProfileButton(self):
+    path = qt.QFileDialog.getSaveFileName(None, "Export Statistics", os.path.join(slicer.app.temporaryPath, "UltrasoundSimulatorProfile.json"),
+                                          "JSON (*.json);;CSV (*.csv)")
+    if path:
+      self.logic.profiler.export(path)
+      logging.info('Exported profiling statistics to ' + path)
+
+  def onDisplayRateChanged(self, rate):
+    self.poseDisplayTimer.setInterval(int(1000 / rate))
+
   def onAlignedButton(self):
     self.w.setEnabled(False)
     self.alignedButton.setEnabled(False)
-    self.currentCalibrationState = "PLACE_END_FIDUCIALS"
+    self.calibrationStateMachine.processEvent(self.calibrationStateMachine.MODEL_ALIGNED)
     
-  def calibrationStateTimeOut(self):
+  def onCalibrationStateChanged(self, previousState, state, event):
+    self.initializeViews()
+    stateMachine = self.calibrationStateMachine
+    if previousState in (stateMachine.PLACE_START_FIDUCIALS, stateMachine.PLACE_END_FIDUCIALS):
+      self.stopFiducialPlacement()
     # Info
-    if self.currentCalibrationState == "PLACE_START_FIDUCIALS":
-      if not self.placingFiducials:
-        self.calibrationInstructionsLabel12.setStyleSheet("QLabel {color: #000000}")
-        self.lm.setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpView)
-        self.markupsModuleLogic.AddNewFiducialNode("I")
-        self.startFiducialNode = getNode("I")
-        self.redInteractorObserverID = self.redInteractor.AddObserver("LeftButtonPressEvent", self.leftButtonPressEvent)
-        self.greenInteractorObserverID = self.greenInteractor.AddObserver("LeftButtonPressEvent", self.leftButtonPressEvent)
-        self.yellowInteractorObserverID = self.yellowInteractor.AddObserver("LeftButtonPressEvent", self.leftButtonPressEvent)            
-        self.placingFiducials = True
-      elif self.nbrOfFiducialsPlaced == self.nbrOfFiducialsToPlace:
-        self.calibrationInstructionsLabel12.setText("Scroll through the slice views, locate the sphere numbered 3, press the point in the center of the sphere.")
-        self.calibrationInstructionsLabel12.setStyleSheet("QLabel {color: #000000; text-decoration: line-through;}")
-        self.currentCalibrationState = "ALIGN_CALIBRATION_MODEL"
-        self.redInteractor.RemoveObserver(self.redInteractorObserverID)
-        self.greenInteractor.RemoveObserver(self.greenInteractorObserverID)
-        self.yellowInteractor.RemoveObserver(self.yellowInteractorObserverID)
-        self.redInteractorObserverID = -1
-        self.greenInteractorObserverID = -1
-        self.yellowInteractorObserverID = -1
-        self.nbrOfFiducialsPlaced = 1  
-        self.placingFiducials = False             
-      else:
-        self.calibrationInstructionsLabel12.setText("Scroll through the slice views, locate the sphere numbered " + str(self.nbrOfFiducialsPlaced + 1) + ", press the point in the center of the sphere.")
-        return     
+    if state == stateMachine.PLACE_START_FIDUCIALS:
+      self.calibrationInstructionsLabel12.setStyleSheet("QLabel {color: #000000}")
+      self.lm.setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpView)
+      self.markupsModuleLogic.AddNewFiducialNode("I")
+      self.startFiducialNode = getNode("I")
+      self.startFiducialPlacement(self.startFiducialNode)
     # Info
-    elif self.currentCalibrationState == "ALIGN_CALIBRATION_MODEL":
-      if not self.tempTransformApplied:
-        self.lm.setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpRedSliceView)
-        self.redSliceNode.SetSliceOffset(0)
-        self.calibrationInstructionsLabel22.setStyleSheet("QLabel {color: #000000}")
-        self.tempTransformApplied = True
-        self.tempTransform = slicer.vtkMRMLLinearTransformNode()
-        slicer.mrmlScene.AddNode(self.tempTransform)
-        self.IMUTransformNode.SetAndObserveTransformNodeID(self.tempTransform.GetID())
-        self.w.setEnabled(True)
-        self.w.setMRMLTransformNode(self.tempTransform)
-        self.alignedButton.setEnabled(True)
-      else:
-        return      
+    elif state == stateMachine.ALIGN_CALIBRATION_MODEL:
+      self.calibrationInstructionsLabel12.setText("Scroll through the slice views, locate the sphere numbered 3, press the point in the center of the sphere.")
+      self.calibrationInstructionsLabel12.setStyleSheet("QLabel {color: #000000; text-decoration: line-through;}")
+      self.lm.setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpRedSliceView)
+      self.redSliceNode.SetSliceOffset(0)
+      self.calibrationInstructionsLabel22.setStyleSheet("QLabel {color: #000000}")
+      self.tempTransform = slicer.vtkMRMLLinearTransformNode()
+      slicer.mrmlScene.AddNode(self.tempTransform)
+      self.IMUTransformNode.SetAndObserveTransformNodeID(self.tempTransform.GetID())
+      self.w.setEnabled(True)
+      self.w.setMRMLTransformNode(self.tempTransform)
+      self.alignedButton.setEnabled(True)
     # Info
-    elif self.currentCalibrationState == "PLACE_END_FIDUCIALS":
-      if not self.placingFiducials:
-        self.calibrationInstructionsLabel22.setStyleSheet("QLabel {color: #000000;  text-decoration: line-through;}")
-        self.calibrationInstructionsLabel32.setStyleSheet("QLabel {color: #000000;}")
-        self.markupsModuleLogic.AddNewFiducialNode("C")
-        self.endFiducialNode = getNode("C")
-        
-        # Add first fiducial of Start to End since it is the same 
-        ras = [0,0,0]
-        self.startFiducialNode.GetNthFiducialPosition(0, ras)
-        self.endFiducialNode.AddFiducial(ras[0], ras[1], ras[2])
-        
-        self.redInteractorObserverID = self.redInteractor.AddObserver("LeftButtonPressEvent", self.leftButtonPressEvent)
-        self.greenInteractorObserverID = self.greenInteractor.AddObserver("LeftButtonPressEvent", self.leftButtonPressEvent)
-        self.yellowInteractorObserverID = self.yellowInteractor.AddObserver("LeftButtonPressEvent", self.leftButtonPressEvent)  
-        self.placingFiducials = True
-      elif self.nbrOfFiducialsPlaced == self.nbrOfFiducialsToPlace:
+    elif state == stateMachine.PLACE_END_FIDUCIALS:
+      self.calibrationInstructionsLabel22.setStyleSheet("QLabel {color: #000000;  text-decoration: line-through;}")
+      self.calibrationInstructionsLabel32.setStyleSheet("QLabel {color: #000000;}")
+      self.markupsModuleLogic.AddNewFiducialNode("C")
+      self.endFiducialNode = getNode("C")
+      
+      # Add first fiducial of Start to End since it is the same 
+      ras = [0,0,0]
+      self.startFiducialNode.GetNthFiducialPosition(0, ras)
+      self.endFiducialNode.AddFiducial(ras[0], ras[1], ras[2])
+      self.startFiducialPlacement(self.endFiducialNode)
+    # Info
+    elif state == stateMachine.CALCULATE_START_TO_END:
+      if previousState == stateMachine.PLACE_END_FIDUCIALS:
         self.calibrationInstructionsLabel32.setText("Scroll through the slice views, locate the sphere numbered 3, press the point in the center of the sphere.")
         self.calibrationInstructionsLabel32.setStyleSheet("QLabel {color: #000000; text-decoration: line-through;}")
-        self.currentCalibrationState = "CALCULATE_START_TO_END"
-        self.redInteractor.RemoveObserver(self.redInteractorObserverID)
-        self.greenInteractor.RemoveObserver(self.greenInteractorObserverID)
-        self.yellowInteractor.RemoveObserver(self.yellowInteractorObserverID)
-        self.redInteractorObserverID = -1
-        self.greenInteractorObserverID = -1
-        self.yellowInteractorObserverID = -1
-        self.nbrOfFiducialsPlaced = 0  
-        self.placingFiducials = False
-      else:
-        self.calibrationInstructionsLabel32.setText("Scroll through the slice views, locate the sphere numbered " + str(self.nbrOfFiducialsPlaced + 1) + ", press the point in the center of the sphere.")
-        return        
-    # Info
-    elif self.currentCalibrationState == "CALCULATE_START_TO_END":
       self.calibrationInstructionsLabel42.setStyleSheet("QLabel {color: #000000;}")
-      self.calculateTransformButton.setEnabled(True)         
+      self.calculateTransformButton.setEnabled(True)
     # Info
-    elif self.currentCalibrationState == "APPLY_AND_FINALIZE_CALIBRATION":
-      if self.saveTransform.GetMatrixTransformToParent().GetElement(0,0) != 1.0:
-        self.IMUTransformNode.SetAndObserveTransformNodeID(self.saveTransform.GetID())
-        self.loadSampleVolumeButton.enabled = True
-        self.calibrationStateTimer.stop()    
-        slicer.mrmlScene.RemoveNode(self.tempTransform)
-        self.tempTransform = None       
-        slicer.mrmlScene.RemoveNode(self.calibrationModelNode)
-        self.calibrationModelNode = None  
-        slicer.mrmlScene.RemoveNode(self.startFiducialNode)
-        self.startFiducialNode = None       
-        slicer.mrmlScene.RemoveNode(self.endFiducialNode)
-        self.endFiducialNode = None
-        self.startToEndTransformCalculated = False
-        self.tempTransformApplied = False
-        self.calibrate1CollapsibleButton.collapsed = True
-        self.calibrationStatusLabel.setText("Calibration completed")
-        self.calibrationStatusLabel.setStyleSheet("QLabel {color: #000000;}")
-           
-  def onCalculateTransformButton(self): 
+    elif state == stateMachine.APPLY_AND_FINALIZE_CALIBRATION:
+      self.calculateStartToEnd()
+    # Info
+    elif state == stateMachine.COMPLETED:
+      self.finalizeCalibration()
+    # Info
+    elif state == stateMachine.IDLE:
+      self.startCalibrationButton.setEnabled(self.IMUTransformNode is not None)
+      self.stopCalibrationButton.setEnabled(False)
+
+  def onCalibrationFiducialPlaced(self, nbrOfFiducialsPlaced):
+    if self.calibrationStateMachine.state == self.calibrationStateMachine.PLACE_START_FIDUCIALS:
+      label = self.calibrationInstructionsLabel12
+    else:
+      label = self.calibrationInstructionsLabel32
+    label.setText("Scroll through the slice views, locate the sphere numbered " + str(nbrOfFiducialsPlaced + 1) + ", press the point in the center of the sphere.")
+
+  def startFiducialPlacement(self, fiducialNode):
+    self.redInteractorObserverID = self.redInteractor.AddObserver("LeftButtonPressEvent", self.leftButtonPressEvent)
+    self.greenInteractorObserverID = self.greenInteractor.AddObserver("LeftButtonPressEvent", self.leftButtonPressEvent)
+    self.yellowInteractorObserverID = self.yellowInteractor.AddObserver("LeftButtonPressEvent", self.leftButtonPressEvent)
+    self.fiducialPlacementNode = fiducialNode
+    self.fiducialPlacementObserverTag = fiducialNode.AddObserver(slicer.vtkMRMLMarkupsNode.MarkupAddedEvent, self.onFiducialAdded)
+    self.placeSphereCentersButton.setEnabled(True)
+
+  def stopFiducialPlacement(self):
+    self.redInteractor.RemoveObserver(self.redInteractorObserverID)
+    self.greenInteractor.RemoveObserver(self.greenInteractorObserverID)
+    self.yellowInteractor.RemoveObserver(self.yellowInteractorObserverID)
+    self.redInteractorObserverID = -1
+    self.greenInteractorObserverID = -1
+    self.yellowInteractorObserverID = -1
+    if self.fiducialPlacementNode:
+      self.fiducialPlacementNode.RemoveObserver(self.fiducialPlacementObserverTag)
+    self.fiducialPlacementNode = None
+    self.fiducialPlacementObserverTag = None
+    self.placeSphereCentersButton.setEnabled(False)
+
+  def calibrationModelToWorld(self):
+    matrix = vtk.vtkMatrix4x4()
+    transformNode = self.calibrationModelNode.GetParentTransformNode()
+    if transformNode:
+      transformNode.GetMatrixTransformToWorld(matrix)
+    return matrix
+
+  def calculateStartToEnd(self):
     self.calibrationInstructionsLabel42.setStyleSheet("QLabel {color: #000000;  text-decoration: line-through;}")
     self.calculateTransformButton.setEnabled(False)   
     self.saveTransform = slicer.vtkMRMLLinearTransformNode()
     self.saveTransform.SetName("EndToStartTransform")
     slicer.mrmlScene.AddNode(self.saveTransform)
     logic = UltrasoundSimulatorLogic()  
-    logic.calculateStartToEnd(self.saveTransform, self.startFiducialNode, self.endFiducialNode)
-    self.currentCalibrationState = "APPLY_AND_FINALIZE_CALIBRATION" 
+    try:
+      logic.calculateStartToEnd(self.saveTransform, self.startFiducialNode, self.endFiducialNode)
+    except ValueError as e:
+      logging.error('Calibration registration failed: ' + str(e))
+      self.calibrationStateMachine.processEvent(self.calibrationStateMachine.REGISTRATION_FAILED)
+      return
+    self.calibrationStateMachine.processEvent(self.calibrationStateMachine.REGISTRATION_COMPLETED)
+
+  def finalizeCalibration(self):
+    self.IMUTransformNode.SetAndObserveTransformNodeID(self.saveTransform.GetID())
+    self.loadSampleVolumeButton.enabled = True
+    self.stopCalibrationButton.setEnabled(False)
+    slicer.mrmlScene.RemoveNode(self.tempTransform)
+    self.tempTransform = None       
+    slicer.mrmlScene.RemoveNode(self.calibrationModelNode)
+    self.calibrationModelNode = None  
+    slicer.mrmlScene.RemoveNode(self.startFiducialNode)
+    self.startFiducialNode = None       
+    slicer.mrmlScene.RemoveNode(self.endFiducialNode)
+    self.endFiducialNode = None
+    self.startToEndTransformCalculated = False
+    self.calibrate1CollapsibleButton.collapsed = True
+    self.calibrationStatusLabel.setText("Calibration completed")
+    self.calibrationStatusLabel.setStyleSheet("QLabel {color: #000000;}")
+           
+  def onCalculateTransformButton(self): 
+    self.calibrationStateMachine.processEvent(self.calibrationStateMachine.CALCULATE)
 
   # Events
   def leftButtonPressEvent(self, caller=None, event=None):
     ras=[0,0,0]
     self.crosshairNode.GetCursorPositionRAS(ras)
+    # A click near a sphere places the fiducial at its fitted center
+    center = self.logic.snapToSphereCenter(ras, self.calibrationModelToWorld(), model=self.calibrationModelNode)
+    if center is not None:
+      ras = center
     self.markupsModuleLogic.AddFiducial(ras[0], ras[1], ras[2])
-    self.nbrOfFiducialsPlaced += 1    
+
+  def onPlaceSphereCentersButton(self):
+    stateMachine = self.calibrationStateMachine
+    node = self.fiducialPlacementNode
+    placed = []
+    for index in range(node.GetNumberOfFiducials()):
+      position = [0.0, 0.0, 0.0]
+      node.GetNthFiducialPosition(index, position)
+      placed.append(position)
+    # Spheres already marked by a fiducial, e.g. clicked, are skipped
+    centers = self.logic.unmarkedSphereCenters(placed, self.calibrationModelToWorld(), self.calibrationModelNode)
+    needed = stateMachine.numberOfFiducialsToPlace - stateMachine.numberOfFiducialsPlaced
+    if len(centers) < needed:
+      logging.error('Found %d spheres without a fiducial on the calibration model, %d needed' % (len(centers), needed))
+      return
+    # Every fiducial added advances the state machine
+    for center in centers[:needed]:
+      node.AddFiducial(center[0], center[1], center[2])
+
+  def onFiducialAdded(self, caller=None, event=None):
+    self.calibrationStateMachine.processEvent(self.calibrationStateMachine.FIDUCIAL_PLACED)
       
   def onStartCalibrationButton(self):    
     self.calibrationInstructionsLabel02.setStyleSheet("QLabel {color: #000000; text-decoration: line-through;}")
     self.startCalibrationButton.setEnabled(False)
+    self.stopCalibrationButton.setEnabled(True)
     self.initializeCalibration()
-    self.calibrationStateTimer.start(200)
+    self.calibrationStateMachine.processEvent(self.calibrationStateMachine.START)
            
   def onStopCalibrationButton(self):
-    pass
+    self.calibrationStateMachine.processEvent(self.calibrationStateMachine.STOP)
     
   def onRestartCalibrationButton(self):
+    self.calibrationStateMachine.processEvent(self.calibrationStateMachine.STOP)
+    self.recordButton.checked = False
+    self.exportFramesButton.checked = False
+    self.backgroundRenderingCheckBox.checked = False
+    self.renderSink = None
+    self.logic.removeTransformChain()
     slicer.mrmlScene.Clear(0)
 
   def onIMUTransformSelector(self):
@@ -545,8 +941,7 @@ class UltrasoundSimulatorWidget(ScriptedLoadableModuleWidget):
       self.startCalibrationButton.enabled = self.IMUTransformNode
     
   def initializeCalibration(self):
-    slicer.util.loadModel("H:/src/S4Mods/UltrasoundSimulator/Data/Calibration_model.stl")
-    self.calibrationModelNode = getNode("Calibration_model")      
+    self.calibrationModelNode = self.logic.loadDataNode("Calibration_model.stl", slicer.util.loadModel)
     self.calibrationModelDisplayNode = self.calibrationModelNode.GetModelDisplayNode()
     self.calibrationModelDisplayNode.SliceIntersectionVisibilityOn()
     self.calibrationModelDisplayNode.SetColor(1,0,0) 
@@ -569,17 +964,941 @@ class UltrasoundSimulatorLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    self.bModeRenderer = None
+    self.bModeRendererKey = None
+    self.dataNodes = {}
+    from UltrasoundSimulatorLib import Profiler
+    self.profiler = Profiler()
+    self.sessionRecorder = None
+    self.sessionRecordingObservers = []
+    self.transformChain = None
+    self.transformChainObservers = []
+    self.frameCache = None
+    # Rotation (degrees) and translation (mm) changes below which a displayed
+    # frame is reused, and distance (voxels) beyond which scanlines are resampled
+    self.frameCacheTolerances = {'rotationTolerance': 0.05, 'translationTolerance': 0.05, 'resampleDistance': 1.0}
+    self.volumePyramid = None
+    self.volumePyramidKey = None
+    self.levelOfDetailRenderer = None
+    self.levelOfDetailRendererKey = None
+    self.probeBindings = []
+    self.multiProbeRenderer = None
+    self.multiProbeRendererKey = None
+    self.acousticPropertyCache = None
+    self.acousticPropertyCacheKey = None
+    self.renderWorker = None
+    self.imagingMode = 'B-mode'
+    self.imagingModeRenderer = None
+    self.flowModel = None
+    # Color Doppler ROI (scanline start, end, sample start, end), from
+    # dopplerRoiFractions of the frame width and depth if None
+    self.dopplerRoi = None
+    self.dopplerRoiFractions = (0.25, 0.75, 0.25, 0.75)
+    from UltrasoundSimulatorLib import ScanConverterCache
+    self.scanConverters = ScanConverterCache()
+    self.frameExport = None
+    self.frameExporter = None
+    # Gain and dynamic range (dB) and TGC (dB at equally spaced depths) set by
+    # setPostProcessing, used by the B-mode renderers created afterwards too
+    self.postProcessing = {}
+    self.sphereDetector = None
+    self.sphereDetectorKey = None
+
+  def dataPath(self, fileName):
+    """Returns the path of a data file (calibration model, probe mask,
+    phantoms), looked up in the directory set by the
+    ULTRASOUND_SIMULATOR_DATA_PATH environment variable, in Resources/Data
+    next to this module, then in the Data directory of the source tree.
+    """
+    moduleDirectory = os.path.dirname(os.path.abspath(__file__))
+    directories = [os.environ.get('ULTRASOUND_SIMULATOR_DATA_PATH'),
+                   os.path.join(moduleDirectory, 'Resources', 'Data'),
+                   os.path.join(moduleDirectory, os.pardir, 'Data')]
+    for directory in directories:
+      if directory and os.path.exists(os.path.join(directory, fileName)):
+        return os.path.normpath(os.path.join(directory, fileName))
+    raise ValueError('%s not found in %s' % (fileName, ', '.join(directory for directory in directories if directory)))
+
+  def loadDataNode(self, fileName, loader):
+    """Loads a data file with loader (e.g. slicer.util.loadVolume) the first
+    time it is needed and returns its node, reusing the node while it is in
+    the scene.
+    """
+    node = self.dataNodes.get(fileName)
+    if node is not None and slicer.mrmlScene.IsNodePresent(node):
+      return node
+    startTime = time.time()
+    loader(self.dataPath(fileName))
+    node = slicer.util.getNode(os.path.splitext(fileName)[0])
+    self.dataNodes[fileName] = node
+    logging.info('Loaded %s in %.2f s' % (fileName, time.time() - startTime))
+    return node
+
+  def arrayFromVTKMatrix(self, vmatrix):
+    """Returns a vtkMatrix4x4 as a 4x4 numpy array
+    """
+    return numpy.array([[vmatrix.GetElement(row, column) for column in range(4)] for row in range(4)])
+
+  def setTransformNodeMatrix(self, transformNode, matrix):
+    """Sets the to parent matrix of a linear transform node from a 4x4 array
+    """
+    vmatrix = vtk.vtkMatrix4x4()
+    for row in range(4):
+      for column in range(4):
+        vmatrix.SetElement(row, column, matrix[row][column])
+    transformNode.SetMatrixTransformToParent(vmatrix)
+
+  def createPoseStream(self, capacity=256, smoothingTimeConstant=0.05, displayDelay=0.0):
+    """Returns a PoseStream that buffers and filters incoming probe poses so
+    they can be rendered at a display rate independent of the sensor rate.
+    Samples come from observeTransformNode or from a FileReplaySource or
+    UdpPoseSource thread.
+    """
+    from UltrasoundSimulatorLib import PoseStream
+    return PoseStream(capacity, smoothingTimeConstant, displayDelay)
+
+  def observeTransformNode(self, poseStream, transformNode):
+    """Adds every update of a linear transform node to poseStream. Returns the
+    observer tag.
+    """
+    def onTransformModified(caller, event):
+      poseStream.addSample(self.arrayFromVTKMatrix(caller.GetMatrixTransformToParent()))
+    return transformNode.AddObserver(slicer.vtkMRMLTransformableNode.TransformModifiedEvent, onTransformModified)
+
+  def createTransformChain(self, transformNodes, probeTransformNode=None):
+    """Maintains a TransformChain of linear transform nodes mapping the volume
+    to world coordinates, innermost first, and of the probe transform node.
+    Each node's to parent matrix is copied into the chain only when the node
+    is modified, and the composed pose only when it is next requested, so
+    simulateFrame and batch jobs read the pose without walking the scene.
+    """
+    from UltrasoundSimulatorLib import TransformChain
+    self.removeTransformChain()
+    self.transformChain = TransformChain(len(transformNodes))
+    def observe(node, setMatrix):
+      def onTransformModified(caller, event):
+        setMatrix(self.arrayFromVTKMatrix(caller.GetMatrixTransformToParent()))
+      onTransformModified(node, None)
+      self.transformChainObservers.append((node, node.AddObserver(slicer.vtkMRMLTransformableNode.TransformModifiedEvent, onTransformModified)))
+    for index, node in enumerate(transformNodes):
+      observe(node, lambda matrix, index=index: self.transformChain.setMatrix(index, matrix))
+    if probeTransformNode:
+      observe(probeTransformNode, self.transformChain.setProbeToWorld)
+    return self.transformChain
+
+  def transformChainPose(self, caller):
+    """Probe to volume pose of the transform chain, used by caller when it
+    is given no pose.
+    """
+    if self.transformChain is None:
+      raise ValueError('%s: no probe pose given and no transform chain configured (see createTransformChain)'
+                       % caller)
+    return self.transformChain.probeToVolume()
+
+  def removeTransformChain(self):
+    for node, tag in self.transformChainObservers:
+      node.RemoveObserver(tag)
+    self.transformChainObservers = []
+    self.transformChain = None
+
+  def startSessionRecording(self, path, imuTransformNode, calibrationTransformNodes, chain):
+    """Records every update of the IMU transform node and of the calibration
+    transform nodes ({record kind: node}) to a session recording at path.
+    chain lists the record kinds mapping the volume to world, innermost first.
+    """
+    from UltrasoundSimulatorLib import SessionRecorder, SessionRecording
+    self.stopSessionRecording()
+    self.sessionRecorder = SessionRecorder(path, chain)
+    nodes = dict(calibrationTransformNodes)
+    nodes[SessionRecording.IMU] = imuTransformNode
+    for kind, node in nodes.items():
+      if not node:
+        continue
+      def onTransformModified(caller, event, kind=kind):
+        self.sessionRecorder.addRecord(kind, self.arrayFromVTKMatrix(caller.GetMatrixTransformToParent()))
+      onTransformModified(node, None)
+      self.sessionRecordingObservers.append((node, node.AddObserver(slicer.vtkMRMLTransformableNode.TransformModifiedEvent, onTransformModified)))
+
+  def stopSessionRecording(self):
+    for node, tag in self.sessionRecordingObservers:
+      node.RemoveObserver(tag)
+    self.sessionRecordingObservers = []
+    if self.sessionRecorder:
+      self.sessionRecorder.close()
+      logging.info('Recorded %d transforms to %s' % (self.sessionRecorder.numberOfRecords, self.sessionRecorder.path))
+      self.sessionRecorder = None
+
+  def replaySession(self, path, volumeArray, spacing, origin, probeToWorldMatrix=None, directions=None,
+                    speed=None, frameCallback=None, **parameters):
+    """Renders a frame for every IMU record of a session recording with the
+    NumPy engine, no scene or views needed. Frames are paced at speed times
+    the recorded rate, or rendered as fast as possible if speed is None, and
+    passed to frameCallback(timestamp, frame). probeToWorldMatrix is the fixed
+    probe pose in world coordinates. Returns the number of frames and the
+    achieved frame rate.
+    """
+    from UltrasoundSimulatorLib import SessionRecording
+    timestamps, poses = SessionRecording(path).probePoses(probeToWorldMatrix)
+    renderer = self.getBModeRenderer(volumeArray, spacing, origin, directions, **parameters)
+    startTime = time.time()
+    for timestamp, pose in zip(timestamps, poses):
+      if speed:
+        delay = startTime + (timestamp - timestamps[0]) / speed - time.time()
+        if delay > 0:
+          time.sleep(delay)
+      frame = renderer.render(pose)
+      if frameCallback:
+        frameCallback(timestamp, frame)
+    elapsed = time.time() - startTime
+    framesPerSecond = len(poses) / elapsed if elapsed > 0 else 0.0
+    logging.info('replaySession: %d frames at %.1f frames/s' % (len(poses), framesPerSecond))
+    return {'numberOfFrames': len(poses), 'framesPerSecond': framesPerSecond}
+
+  def getVolumeArrayAndGeometry(self, volumeNode):
+    """Returns the voxel array (k, j, i) of a scalar volume node together with
+    its spacing, origin and IJK to RAS directions
+    """
+    directions = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASDirectionMatrix(directions)
+    return (slicer.util.arrayFromVolume(volumeNode), volumeNode.GetSpacing(), volumeNode.GetOrigin(),
+            self.arrayFromVTKMatrix(directions)[:3, :3])
+
+  def getBModeRenderer(self, volumeArray, spacing, origin, directions=None, **parameters):
+    """Returns a BModeRenderer for the volume, reusing the previous one if
+    neither the volume nor the parameters changed
+    """
+    from UltrasoundSimulatorLib import BModeRenderer
+    key = (id(volumeArray), tuple(spacing), tuple(origin),
+           None if directions is None else numpy.asarray(directions).tobytes(),
+           tuple(sorted(parameters.items())))
+    if self.bModeRenderer is None or self.bModeRendererKey != key:
+      self.bModeRenderer = BModeRenderer(volumeArray, spacing, origin, directions, **parameters)
+      self.bModeRenderer.profiler = self.profiler
+      self.bModeRenderer.postProcessor.setParameters(**{name: value for name, value in self.postProcessing.items()
+                                                        if name not in parameters})
+      self.bModeRendererKey = key
+    return self.bModeRenderer
+
+  def simulateFrame(self, volumeArray, spacing, origin, probeToWorldMatrix=None, directions=None,
+                    useFrameCache=False, **parameters):
+    """Renders a B-mode frame of a CT volume for a 4x4 probe pose. Only NumPy is
+    used, so this works without views or the MRML scene (e.g. in batch jobs).
+    Without a pose, the current pose of the transform chain is used. With
+    useFrameCache, frames are reused or partially re-rendered while the pose
+    stays within frameCacheTolerances of the last rendered one.
+    Returns a uint8 array shaped (samples, scanlines).
+    """
+    if probeToWorldMatrix is None:
+      probeToWorldMatrix = self.transformChainPose('simulateFrame')
+    if isinstance(probeToWorldMatrix, vtk.vtkMatrix4x4):
+      probeToWorldMatrix = self.arrayFromVTKMatrix(probeToWorldMatrix)
+    probeToWorldMatrix = numpy.asarray(probeToWorldMatrix, dtype=numpy.float64)
+    renderer = self.getBModeRenderer(volumeArray, spacing, origin, directions, **parameters)
+    with self.profiler.stage('render'):
+      if not useFrameCache:
+        frame = renderer.render(probeToWorldMatrix)
+      else:
+        from UltrasoundSimulatorLib import FrameCoherenceCache
+        if self.frameCache is None or self.frameCache.renderer is not renderer:
+          self.frameCache = FrameCoherenceCache(renderer, **self.frameCacheTolerances)
+        frame = self.frameCache.render(probeToWorldMatrix)
+    self.exportFrame(frame, probeToWorldMatrix)
+    self.profiler.frame()
+    return frame
+
+  def setPostProcessing(self, gain=None, dynamicRange=None, tgc=None):
+    """Changes the gain, dynamic range and TGC (those given) of the B-mode
+    renderers. Returns the last B-mode frame with the new settings, applied
+    by the lookup table stage without simulating it again, or None if no
+    frame was rendered yet.
+    """
+    if dynamicRange is not None and dynamicRange <= 0:
+      raise ValueError('The dynamic range must be positive, got %r' % dynamicRange)
+    for name, value in (('gain', gain), ('dynamicRange', dynamicRange), ('tgc', tgc)):
+      if value is not None:
+        self.postProcessing[name] = value
+    renderers = list(self.multiProbeRenderer.renderers) if self.multiProbeRenderer else []
+    if self.levelOfDetailRenderer:
+      renderers.extend(self.levelOfDetailRenderer.renderers)
+    if self.bModeRenderer:
+      renderers.append(self.bModeRenderer)
+    with self.profiler.stage('postProcess'):
+      for renderer in renderers:
+        renderer.postProcessor.setParameters(dynamicRange, gain, tgc)
+      # Cached frames have the previous settings
+      self.frameCache = None
+      return self.bModeRenderer.postProcess() if self.bModeRenderer else None
+
+  def setProfilingEnabled(self, enabled):
+    """Starts or stops timing pipeline stages, clearing earlier timings when started.
+    """
+    if enabled and not self.profiler.enabled:
+      self.profiler.reset()
+    self.profiler.enabled = enabled
+
+  def exportProfile(self, path):
+    """Saves per-stage p50/p95/p99 timings as CSV (.csv) or JSON.
+    """
+    self.profiler.export(path)
+    return self.profiler.statistics()
+
+  def createDisplaySink(self, shape, spacing=(1.0, 1.0), name="SimulatedUltrasound", dtype=numpy.uint8,
+                        numberOfComponents=1):
+    """Returns a FrameDisplaySink of (rows, columns) frames shown by a new
+    scalar volume node, or vector volume node for RGB frames
+    (numberOfComponents 3), depth increasing along -A. Frames written to the
+    sink update the node without allocating or copying an image.
+    """
+    from UltrasoundSimulatorLib.DisplaySink import FrameDisplaySink
+    sink = FrameDisplaySink(shape, (1.0, 1.0), dtype, numberOfComponents)
+    sink.volumeNode = slicer.vtkMRMLVectorVolumeNode() if numberOfComponents > 1 else slicer.vtkMRMLScalarVolumeNode()
+    sink.volumeNode.SetName(name)
+    sink.volumeNode.SetSpacing(spacing[1], spacing[0], 1.0)
+    sink.volumeNode.SetIJKToRASDirections(1, 0, 0, 0, -1, 0, 0, 0, 1)
+    slicer.mrmlScene.AddNode(sink.volumeNode)
+    sink.volumeNode.CreateDefaultDisplayNodes()
+    sink.volumeNode.SetAndObserveImageData(sink.imageData)
+    return sink
+
+  def simulateFrameToDisplaySink(self, sink, volumeArray, spacing, origin, probeToWorldMatrix=None, directions=None,
+                                 **parameters):
+    """Renders a frame like simulateFrame directly into the shared buffer of
+    a FrameDisplaySink and signals the displayed volume node.
+    """
+    if probeToWorldMatrix is None:
+      probeToWorldMatrix = self.transformChainPose('simulateFrameToDisplaySink')
+    renderer = self.getBModeRenderer(volumeArray, spacing, origin, directions, **parameters)
+    with self.profiler.stage('render'):
+      renderer.render(numpy.asarray(probeToWorldMatrix, dtype=numpy.float64), out=sink.frame)
+    with self.profiler.stage('display'):
+      sink.modified()
+    self.profiler.frame()
+    return sink.frame
+
+  def addProbe(self, probe, transformNode, viewName=None, name=None):
+    """Binds a probe geometry to the linear transform node holding its pose
+    (probe to world) and to a new display sink, shown in the slice view
+    viewName ('Red', 'Yellow', ...) if given. All bound probes are rendered
+    together by renderProbes. Returns the display sink.
+    """
+    name = name or '%sSimulatedUltrasound' % transformNode.GetName()
+    sink = self.createDisplaySink((probe.samplesPerLine, probe.numberOfScanlines),
+                                  (probe.sampleSpacing, probe.scanlineSpacing or probe.sampleSpacing), name)
+    if viewName:
+      sliceLogic = slicer.app.layoutManager().sliceWidget(viewName).sliceLogic()
+      sliceLogic.GetSliceCompositeNode().SetBackgroundVolumeID(sink.volumeNode.GetID())
+      sliceLogic.FitSliceToAll()
+    self.probeBindings.append({'probe': probe, 'transformNode': transformNode, 'sink': sink, 'viewName': viewName})
+    return sink
+
+  def removeProbes(self):
+    for binding in self.probeBindings:
+      slicer.mrmlScene.RemoveNode(binding['sink'].volumeNode)
+    self.probeBindings = []
+    self.multiProbeRenderer = None
+    self.multiProbeRendererKey = None
+
+  def getMultiProbeRenderer(self, volumeArray, spacing, origin, probes, directions=None, **parameters):
+    """Returns a MultiProbeRenderer for the volume and probes, reusing the
+    previous one if nothing changed
+    """
+    from UltrasoundSimulatorLib import MultiProbeRenderer
+    key = (id(volumeArray), tuple(spacing), tuple(origin), tuple(probes),
+           None if directions is None else numpy.asarray(directions).tobytes(),
+           tuple(sorted(parameters.items())))
+    if self.multiProbeRenderer is None or self.multiProbeRendererKey != key:
+      self.multiProbeRenderer = MultiProbeRenderer(volumeArray, spacing, origin, probes, directions, **parameters)
+      self.multiProbeRenderer.profiler = self.profiler
+      self.multiProbeRendererKey = key
+    return self.multiProbeRenderer
+
+  def simulateProbeFrames(self, volumeArray, spacing, origin, probes, probeToWorldMatrices, directions=None,
+                          **parameters):
+    """Renders one B-mode frame per probe geometry for one 4x4 pose per
+    probe, resampling the volume once for all of them, with the other
+    renderer parameters shared. Only NumPy is used.
+    Returns a list of uint8 arrays shaped (samples, scanlines).
+    """
+    renderer = self.getMultiProbeRenderer(volumeArray, spacing, origin, probes, directions, **parameters)
+    with self.profiler.stage('render'):
+      frames = renderer.render(numpy.asarray(probeToWorldMatrices, dtype=numpy.float64))
+    self.profiler.frame()
+    return frames
+
+  def renderProbes(self, volumeArray, spacing, origin, directions=None, **parameters):
+    """Renders the probes bound by addProbe at the current poses of their
+    transform nodes into their display sinks, in one pass.
+    """
+    if not self.probeBindings:
+      return []
+    volumeToWorld = self.transformChain.volumeToWorld() if self.transformChain else numpy.eye(4)
+    worldToVolume = numpy.linalg.inv(volumeToWorld)
+    probeToWorld = vtk.vtkMatrix4x4()
+    poses = []
+    for binding in self.probeBindings:
+      binding['transformNode'].GetMatrixTransformToWorld(probeToWorld)
+      poses.append(numpy.dot(worldToVolume, self.arrayFromVTKMatrix(probeToWorld)))
+    renderer = self.getMultiProbeRenderer(volumeArray, spacing, origin,
+                                          [binding['probe'] for binding in self.probeBindings], directions, **parameters)
+    with self.profiler.stage('render'):
+      frames = renderer.render(poses, [binding['sink'].frame for binding in self.probeBindings])
+    with self.profiler.stage('display'):
+      for binding in self.probeBindings:
+        binding['sink'].modified()
+    self.profiler.frame()
+    return frames
+
+  def startRenderWorker(self, volumeArray, spacing, origin, directions=None, numberOfThreads=1, mode=None,
+                        levelOfDetail=False, **parameters):
+    """Starts a RenderWorker rendering frames of the volume in an imaging
+    mode (imagingMode by default, see createImagingModeRenderer) on
+    background threads. Submit probe to volume poses to it and display the
+    latest frame with displayRenderResult. With levelOfDetail, B-mode frames
+    are rendered from a coarser level of the volume pyramid while the probe
+    rotates quickly, on one thread, and refineRenderWorkerFrame re-renders
+    them at full resolution once it stopped. M-mode and color Doppler keep
+    the state of the previous update, so they are rendered on one thread too.
+    """
+    from UltrasoundSimulatorLib import RenderWorker
+    mode = mode or self.imagingMode
+    if levelOfDetail and numberOfThreads != 1:
+      raise ValueError('startRenderWorker: level of detail rendering uses a single thread')
+    if mode != 'B-mode' and numberOfThreads != 1:
+      raise ValueError('startRenderWorker: %s rendering uses a single thread' % mode)
+    self.stopRenderWorker()
+    renderer = self.createImagingModeRenderer(mode, volumeArray, spacing, origin, directions,
+                                              levelOfDetail, **parameters)
+    self.renderWorker = RenderWorker(renderer.render, numberOfThreads)
+    return self.renderWorker
+
+  def refineRenderWorkerFrame(self):
+    """Submits the last pose again to a level of detail render worker if
+    its frame came from a coarser level, which renders it at full resolution
+    since the probe did not rotate. Call it when the pose stopped changing.
+    Returns True if the pose was submitted.
+    """
+    renderer = self.levelOfDetailRenderer
+    if not self.renderWorker or renderer is None or renderer is not self.imagingModeRenderer:
+      return False
+    if not renderer.levelRendered:
+      return False
+    self.renderWorker.submit(renderer.pose)
+    return True
+
+  def stopRenderWorker(self):
+    if self.renderWorker:
+      self.renderWorker.stop()
+      logging.info('Render worker: %s' % self.renderWorker.statistics())
+      self.renderWorker = None
+
+  def displayRenderResult(self, sink):
+    """Writes the latest frame finished by the render worker to a display
+    sink, on the main thread. Returns the frame, or None if there was none.
+    """
+    result = self.renderWorker.takeResult() if self.renderWorker else None
+    if result is None:
+      return None
+    frame, pose = result
+    with self.profiler.stage('display'):
+      sink.write(frame)
+    self.exportFrame(frame, pose)
+    self.profiler.frame()
+    return frame
+
+  def startFrameExport(self, path, chunkSize=256, compress=True, blocking=False):
+    """Writes every frame simulated by simulateFrame or displayed by
+    displayRenderResult, with its probe pose, to a frame store at path (see
+    FrameStoreWriter) on a background thread, appending to the store if it
+    exists. The store is opened at the first frame, frames of another shape
+    or type are skipped.
+    """
+    self.stopFrameExport()
+    self.frameExport = {'path': path, 'chunkSize': chunkSize, 'compress': compress, 'blocking': blocking,
+                        'skippedFrames': 0}
+
+  def exportFrame(self, frame, pose):
+    if self.frameExport is None:
+      return
+    if self.frameExporter is None:
+      from UltrasoundSimulatorLib import FrameStoreWriter
+      options = self.frameExport
+      self.frameExporter = FrameStoreWriter(options['path'], frame.shape, frame.dtype, options['chunkSize'],
+                                            options['compress'], blocking=options['blocking'])
+    if frame.shape != self.frameExporter.frameShape or frame.dtype != self.frameExporter.dtype:
+      self.frameExport['skippedFrames'] += 1
+      return
+    with self.profiler.stage('export'):
+      self.frameExporter.write(frame, pose)
+
+  def stopFrameExport(self):
+    """Writes the remaining frames and closes the frame store. Returns the
+    writer statistics, or None if no frame was exported.
+    """
+    statistics = None
+    if self.frameExporter:
+      self.frameExporter.close()
+      statistics = self.frameExporter.statistics()
+      statistics['skippedFrames'] = self.frameExport['skippedFrames']
+      logging.info('Exported frames to %s: %s' % (self.frameExporter.path, statistics))
+    self.frameExport = None
+    self.frameExporter = None
+    return statistics
+
+  def setFlowModel(self, labelVolume, flowVelocities=None, speed=300.0):
+    """Sets the vessels used by color Doppler: a label map volume node or a
+    (k, j, i) label array with the geometry of the simulated volume, and the
+    velocity (mm/s) of each label. A node's labels flow at speed along their
+    principal axis unless flowVelocities are given.
+    """
+    from UltrasoundSimulatorLib import vesselFlowVelocities
+    if isinstance(labelVolume, slicer.vtkMRMLScalarVolumeNode):
+      labelVolume, spacing, origin, directions = self.getVolumeArrayAndGeometry(labelVolume)
+      if flowVelocities is None:
+        flowVelocities = vesselFlowVelocities(labelVolume, spacing, origin, directions, speed)
+    self.flowModel = (labelVolume, flowVelocities or {})
+    logging.info('Color Doppler flow model: %d vessels' % len(self.flowModel[1]))
+
+  def setDopplerRoiFractions(self, lateralRange, depthRange):
+    """Sets the color Doppler ROI as (start, end) fractions of the frame
+    width, across the scanlines, and of the imaging depth. It applies to
+    renderers created afterwards, unless dopplerRoi gives the ROI as indices.
+    """
+    self.dopplerRoiFractions = tuple(float(value) for value in tuple(lateralRange) + tuple(depthRange))
+
+  def dopplerRoiIndices(self, probe):
+    """The color Doppler ROI of a probe geometry as (scanline start, end,
+    sample start, end) indices, at least one sample wide.
+    """
+    if self.dopplerRoi is not None:
+      return self.dopplerRoi
+    lateralStart, lateralEnd, depthStart, depthEnd = self.dopplerRoiFractions
+    roi = []
+    for start, end, size in ((lateralStart, lateralEnd, probe.numberOfScanlines),
+                             (depthStart, depthEnd, probe.samplesPerLine)):
+      start = min(max(int(round(start * size)), 0), size - 1)
+      roi += [start, min(max(int(round(end * size)), start + 1), size)]
+    return tuple(roi)
+
+  def createImagingModeRenderer(self, mode, volumeArray, spacing, origin, directions=None, levelOfDetail=False,
+                                **parameters):
+    """Returns the renderer of an imaging mode, 'B-mode' (BModeRenderer,
+    or with levelOfDetail the LevelOfDetailRenderer of the volume pyramid,
+    built on first use), 'M-mode' (MModeRenderer of the center scanline) or
+    'Color Doppler' (DopplerRenderer of flowModel within dopplerRoiIndices). All of
+    them sample the volume through the same BModeRenderer. Its render(pose)
+    returns the frame to display, (samples, scanlines, 3) RGB for color
+    Doppler.
+    """
+    from UltrasoundSimulatorLib import IMAGING_MODES, DopplerRenderer, MModeRenderer
+    if mode not in IMAGING_MODES:
+      raise ValueError('Unknown imaging mode %r, expected one of %s' % (mode, ', '.join(IMAGING_MODES)))
+    renderer = self.getBModeRenderer(volumeArray, spacing, origin, directions, **parameters)
+    if mode == 'B-mode' and levelOfDetail:
+      self.getVolumePyramid(volumeArray, spacing, origin, directions)
+      renderer = self.getLevelOfDetailRenderer(**parameters)
+    elif mode == 'M-mode':
+      renderer = MModeRenderer(renderer)
+    elif mode == 'Color Doppler':
+      labelVolume, flowVelocities = self.flowModel or (None, None)
+      renderer = DopplerRenderer(renderer, labelVolume, flowVelocities, self.dopplerRoiIndices(renderer.probe))
+    self.imagingMode = mode
+    self.imagingModeRenderer = renderer
+    return renderer
+
+  def createSpeckleModel(self, seed=None, **parameters):
+    """Returns a SpeckleModel to pass as the speckle parameter of
+    simulateFrame or simulateSequence. Frames are reproducible for a given seed.
+    """
+    from UltrasoundSimulatorLib import SpeckleModel
+    return SpeckleModel(seed=seed, **parameters)
+
+  def buildVolumePyramid(self, volume, spacing=None, origin=None, directions=None, numberOfLevels=3):
+    """Builds the 2x and 4x downsampled versions of a scalar volume node (or
+    voxel array with its geometry) rendered while the probe moves fast.
+    """
+    from UltrasoundSimulatorLib import VolumePyramid
+    if isinstance(volume, slicer.vtkMRMLScalarVolumeNode):
+      volume, spacing, origin, directions = self.getVolumeArrayAndGeometry(volume)
+    self.volumePyramid = VolumePyramid(volume, spacing, origin, directions, numberOfLevels)
+    self.volumePyramidKey = self.volumePyramidKeyOf(volume, spacing, origin, directions, numberOfLevels)
+    self.levelOfDetailRenderer = None
+    report = self.volumePyramid.memoryReport()
+    logging.info('Volume pyramid of %d levels built in %.2f s, %.1f MB (%.1f%%) overhead'
+                 % (len(self.volumePyramid), report['buildSeconds'], report['overheadBytes'] / 1e6,
+                    100 * report['overheadFraction']))
+    return self.volumePyramid
+
+  @staticmethod
+  def volumePyramidKeyOf(volume, spacing, origin, directions, numberOfLevels):
+    return (id(volume), tuple(spacing), tuple(origin),
+            None if directions is None else numpy.asarray(directions).tobytes(), numberOfLevels)
+
+  def getVolumePyramid(self, volumeArray, spacing, origin, directions=None, numberOfLevels=3):
+    """Returns the pyramid of a voxel array, only built the first time it
+    is needed for that volume.
+    """
+    if (self.volumePyramid is None
+        or self.volumePyramidKey != self.volumePyramidKeyOf(volumeArray, spacing, origin, directions, numberOfLevels)):
+      self.buildVolumePyramid(volumeArray, spacing, origin, directions, numberOfLevels)
+    return self.volumePyramid
+
+  def getLevelOfDetailRenderer(self, **parameters):
+    """Returns a LevelOfDetailRenderer of the volume pyramid, reusing the
+    previous one if the parameters did not change. Its full resolution
+    level is the B-mode renderer of the pyramid's volume.
+    """
+    from UltrasoundSimulatorLib import LevelOfDetailRenderer
+    key = tuple(sorted(parameters.items()))
+    if self.levelOfDetailRenderer is None or self.levelOfDetailRendererKey != key:
+      volume, spacing, origin = self.volumePyramid.level(0)
+      renderer = self.getBModeRenderer(volume, spacing, origin, self.volumePyramid.directions, **parameters)
+      self.levelOfDetailRenderer = LevelOfDetailRenderer(self.volumePyramid, renderer=renderer, **parameters)
+      for levelRenderer in self.levelOfDetailRenderer.renderers:
+        levelRenderer.profiler = self.profiler
+      self.levelOfDetailRendererKey = key
+    return self.levelOfDetailRenderer
+
+  def simulateLevelOfDetailFrame(self, probeToWorldMatrix=None, timestamp=None, **parameters):
+    """Renders a frame of the volume pyramid, from a coarser level the faster
+    the probe rotates (see LevelOfDetailRenderer). Without a pose, the
+    current pose of the transform chain is used.
+    """
+    if probeToWorldMatrix is None:
+      probeToWorldMatrix = self.transformChainPose('simulateLevelOfDetailFrame')
+    return self.getLevelOfDetailRenderer(**parameters).render(probeToWorldMatrix, timestamp)
+
+  def refineLevelOfDetailFrame(self):
+    """Full resolution frame of the last pose if it was rendered coarser, else None.
+    """
+    if self.levelOfDetailRenderer is None:
+      return None
+    return self.levelOfDetailRenderer.refine()
+
+  def frameCacheStatistics(self):
+    """Hit/miss statistics of the frame cache used by simulateFrame.
+    """
+    if self.frameCache is None:
+      return {}
+    statistics = self.frameCache.statistics()
+    logging.info('Frame cache: %s' % ', '.join('%s=%.4g' % item for item in sorted(statistics.items())))
+    return statistics
+
+  def simulateSequence(self, volume, poses, spacing=None, origin=None, directions=None,
+                       outputPath=None, numberOfWorkers=None, **parameters):
+    """Renders B-mode frames for a sequence of 4x4 probe poses (N, 4, 4) on a
+    process pool. volume is a scalar volume node or a voxel array, in which
+    case spacing and origin must be given. Returns a (N, samples, scanlines)
+    uint8 array, or a memmap of the .npy stack at outputPath. The workers
+    are started with PythonSlicer (see workerPythonExecutable).
+    """
+    from UltrasoundSimulatorLib import simulateSequence
+    if isinstance(volume, slicer.vtkMRMLScalarVolumeNode):
+      volume, spacing, origin, directions = self.getVolumeArrayAndGeometry(volume)
+    elif spacing is None or origin is None:
+      raise ValueError('simulateSequence: spacing and origin are required for a voxel array')
+    parameters.setdefault('pythonExecutable', self.workerPythonExecutable())
+    return simulateSequence(volume, spacing, origin, poses, directions, outputPath, numberOfWorkers, **parameters)
+
+  def workerPythonExecutable(self):
+    """PythonSlicer next to the running executable, which starts worker
+    processes as the Slicer application itself cannot, or None if there is
+    none (e.g. outside Slicer).
+    """
+    executable = os.path.join(os.path.dirname(sys.executable), 'PythonSlicer' + ('.exe' if os.name == 'nt' else ''))
+    return executable if os.path.exists(executable) else None
+
+  def volumeCacheDirectory(self):
+    return os.path.join(slicer.app.temporaryPath, 'UltrasoundSimulator')
+
+  def openVolumeStore(self, path, cacheDirectory=None):
+    """Memory maps a MetaImage or NRRD volume instead of decoding it into RAM.
+    Compressed files are converted once into a bricked cache file. The returned
+    store's array, spacing, origin and directions can be used with
+    simulateFrame and simulateSequence.
+    """
+    from UltrasoundSimulatorLib import VolumeStore
+    return VolumeStore(path, cacheDirectory or self.volumeCacheDirectory())
+
+  def precomputeAcousticProperties(self, source, cacheDirectory=None, maxCacheBytes=4 * 1024 ** 3):
+    """Returns impedance, attenuation and scatterer density volumes of a CT
+    given as a file path, scalar volume node or voxel array. They are computed
+    once and kept in a cache directory, keyed by the content hash of the source
+    and the HU mapping, so later sessions only memory map them. Pass the result
+    as acousticProperties to simulateFrame or simulateSequence. The hash of a
+    volume node is remembered until its image data is modified, so only the
+    first call hashes its voxels.
+    """
+    from UltrasoundSimulatorLib import AcousticPropertyCache
+    key = (os.path.join(cacheDirectory or self.volumeCacheDirectory(), 'AcousticProperties'), maxCacheBytes)
+    if self.acousticPropertyCache is None or self.acousticPropertyCacheKey != key:
+      self.acousticPropertyCache = AcousticPropertyCache(*key)
+      self.acousticPropertyCacheKey = key
+    cache = self.acousticPropertyCache
+    if isinstance(source, slicer.vtkMRMLScalarVolumeNode):
+      return cache.get(slicer.util.arrayFromVolume(source),
+                       sourceKey=(source.GetID(), source.GetImageData().GetMTime()))
+    if isinstance(source, str):
+      return cache.get(source, self.openVolumeStore(source, cacheDirectory).array)
+    return cache.get(source)
+
+  def benchmarkVolumeLoad(self, path):
+    """Compares load time, time to first frame and memory use of
+    slicer.util.loadVolume, a full read and the memory mapped VolumeStore.
+    """
+    from UltrasoundSimulatorLib.Benchmark import benchmarkVolumeLoad, currentRss
+    results = benchmarkVolumeLoad(path, self.volumeCacheDirectory())
+    rss = currentRss()
+    startTime = time.time()
+    slicer.util.loadVolume(path)
+    volumeNode = slicer.util.getNode(os.path.splitext(os.path.basename(path))[0])
+    results['loadVolume'] = {'loadSeconds': time.time() - startTime, 'rssBytes': currentRss() - rss}
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    for name, result in results.items():
+      logging.info('benchmarkVolumeLoad %s: %s' % (name, ', '.join('%s=%.4g' % item for item in sorted(result.items()))))
+    return results
+
+  def benchmarkProbeGeometries(self, volumeNode, probes=None):
+    """Time per frame of linear and convex probe configurations, compared
+    with resampling the whole 180 x 180 mm slice view.
+    """
+    from UltrasoundSimulatorLib.Benchmark import benchmarkProbeGeometries
+    volumeArray, spacing, origin, directions = self.getVolumeArrayAndGeometry(volumeNode)
+    results = benchmarkProbeGeometries(volumeArray, spacing, origin, directions, probes)
+    for probe, numberOfSamples, seconds in results:
+      logging.info('benchmarkProbeGeometries %r: %d samples, %.1f ms/frame' % (probe, numberOfSamples, seconds * 1000))
+    return results
+
+  def scanConvert(self, frame, probe=None, outputShape=None):
+    """Scan converts a (samples, scanlines) frame of probe (the B-mode
+    renderer's probe by default) to a Cartesian image with square pixels, or
+    of outputShape. The interpolation operator of every geometry is built
+    once and cached.
+    """
+    if probe is None:
+      if self.bModeRenderer is None:
+        raise ValueError('scanConvert: no probe given and no frame simulated yet')
+      probe = self.bModeRenderer.probe
+    return self.scanConverters.get(probe, outputShape).apply(frame)
+
+  def benchmarkScanConversion(self, probes=None, outputShape=(512, 512)):
+    """Time per frame of scan conversion with the precomputed operator
+    compared with rebuilding the interpolation for every frame.
+    """
+    from UltrasoundSimulatorLib.Benchmark import benchmarkScanConversion
+    results = benchmarkScanConversion(probes, outputShape)
+    for probe, precomputedSeconds, rebuiltSeconds, nbytes in results:
+      logging.info('benchmarkScanConversion %r: %.2f ms precomputed, %.2f ms rebuilt, %.1f MB'
+                   % (probe, precomputedSeconds * 1000, rebuiltSeconds * 1000, nbytes / 1024.0 ** 2))
+    return results
+
+  def benchmarkScanlineEcho(self, shapes=((128, 256), (256, 512), (512, 1024))):
+    """Throughput of the vectorized attenuation, reflection and shadowing
+    stage compared with the sample by sample reference implementation.
+    """
+    from UltrasoundSimulatorLib.Benchmark import benchmarkScanlineEcho
+    results = benchmarkScanlineEcho(shapes)
+    for shape, seconds, samplesPerSecond in results:
+      logging.info('benchmarkScanlineEcho %dx%d: %.2f ms/frame, %.3g samples/s' % (shape + (seconds * 1000, samplesPerSecond)))
+    return results
+
+  def runBenchmarkSuite(self, baselinePath=None, threshold=0.25, updateBaseline=False, retries=2, **parameters):
+    """Runs the headless benchmark suite on a synthetic phantom (see
+    UltrasoundSimulatorLib.Benchmark.runBenchmarkSuite for the parameters) and
+    compares it with the baseline results at baselinePath, running it again up
+    to retries times while stages regressed, or stores them there with
+    updateBaseline. Returns the results and the list of regressed stages.
+    """
+    from UltrasoundSimulatorLib.Benchmark import (formatBenchmarkResults, loadBenchmarkResults, runAndCompare,
+                                                  saveBenchmarkResults)
+    baseline = None
+    if baselinePath and os.path.exists(baselinePath) and not updateBaseline:
+      baseline = loadBenchmarkResults(baselinePath)
+    results, regressions = runAndCompare(baseline, threshold, retries, **parameters)
+    logging.info('Benchmark suite:\n' + formatBenchmarkResults(results, baseline))
+    if baselinePath and updateBaseline:
+      saveBenchmarkResults(results, baselinePath)
+    for stage, reference, seconds, ratio in regressions:
+      logging.warning('Benchmark regression %s: %.3f ms -> %.3f ms (x%.2f)' % (stage, reference * 1000, seconds * 1000, ratio))
+    return results, regressions
+
+  def benchmarkMultiProbe(self, volumeNode, probe=None, probeCounts=(1, 2, 4, 8)):
+    """Time per update of 1, 2, 4, ... probes rendered on the same volume in
+    one pass, and with one renderer per probe.
+    """
+    from UltrasoundSimulatorLib.Benchmark import benchmarkMultiProbe
+    volumeArray, spacing, origin, directions = self.getVolumeArrayAndGeometry(volumeNode)
+    results = benchmarkMultiProbe(volumeArray, spacing, origin, directions, probe, probeCounts)
+    for count, seconds, separateSeconds in results:
+      logging.info('benchmarkMultiProbe %d probes: %.1f ms (%.1f ms separately)'
+                   % (count, seconds * 1000, separateSeconds * 1000))
+    return results
+
+  def benchmarkImagingModes(self, volumeNode, probe=None):
+    """Time per update of M-mode compared with a B-mode frame, and of color
+    Doppler for ROIs of a quarter, half and all of the frame.
+    """
+    from UltrasoundSimulatorLib.Benchmark import benchmarkDoppler, benchmarkMMode
+    volumeArray, spacing, origin, directions = self.getVolumeArrayAndGeometry(volumeNode)
+    mModeSeconds, bModeSeconds = benchmarkMMode(volumeArray, spacing, origin, directions, probe)
+    logging.info('benchmarkImagingModes M-mode: %.2f ms/update, B-mode: %.2f ms/frame'
+                 % (mModeSeconds * 1000, bModeSeconds * 1000))
+    doppler = benchmarkDoppler(volumeArray, spacing, origin, directions, probe)
+    for fraction, estimateSeconds, frameSeconds in doppler:
+      logging.info('benchmarkImagingModes color Doppler, ROI %d%%: %.2f ms estimates, %.2f ms/frame'
+                   % (fraction * 100, estimateSeconds * 1000, frameSeconds * 1000))
+    return {'M-mode': mModeSeconds, 'B-mode': bModeSeconds, 'Color Doppler': doppler}
+
+  def getSphereDetector(self, model=None, **parameters):
+    """Returns a SphereDetector of the calibration model, indexed once: a
+    model node, whose polydata is in RAS like the views, or an STL file
+    (Calibration_model.stl by default) in its file coordinates.
+    """
+    from UltrasoundSimulatorLib import SphereDetector, readStl
+    if isinstance(model, slicer.vtkMRMLModelNode):
+      key = (model.GetID(), model.GetPolyData().GetMTime(), tuple(sorted(parameters.items())))
+    else:
+      model = model or self.dataPath('Calibration_model.stl')
+      key = (model, tuple(sorted(parameters.items())))
+    if self.sphereDetector is None or self.sphereDetectorKey != key:
+      startTime = time.time()
+      if isinstance(model, slicer.vtkMRMLModelNode):
+        vertices, faces = self.arraysFromPolyData(model.GetPolyData())
+        name = model.GetName()
+      else:
+        vertices, faces = readStl(model)
+        name = model
+      self.sphereDetector = SphereDetector(vertices, faces, **parameters)
+      self.sphereDetectorKey = key
+      logging.info('Indexed %d vertices of %s in %.2f s' % (len(vertices), name, time.time() - startTime))
+    return self.sphereDetector
+
+  def arraysFromPolyData(self, polyData):
+    """Returns the (V, 3) vertices and (F, 3) triangles of a vtkPolyData,
+    polygons triangulated and points with identical coordinates merged
+    like in readStl.
+    """
+    from vtk.util import numpy_support
+    from UltrasoundSimulatorLib import mergeVertices
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(polyData)
+    triangleFilter.PassVertsOff()
+    triangleFilter.PassLinesOff()
+    triangleFilter.Update()
+    triangles = triangleFilter.GetOutput()
+    points = numpy_support.vtk_to_numpy(triangles.GetPoints().GetData())
+    faces = numpy_support.vtk_to_numpy(triangles.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    return mergeVertices(points[faces].reshape(-1, 3))
+
+  def modelToWorldArray(self, modelToWorld):
+    if modelToWorld is None:
+      return numpy.eye(4)
+    if isinstance(modelToWorld, vtk.vtkMatrix4x4):
+      return self.arrayFromVTKMatrix(modelToWorld)
+    return numpy.asarray(modelToWorld, dtype=numpy.float64)
+
+  def calibrationSphereCenters(self, modelToWorld=None, model=None):
+    """Returns the (N, 3) world positions of the centers of all spheres of
+    the calibration model (see getSphereDetector), for its model to world
+    transform (4x4 array or vtkMatrix4x4, identity by default). The order is
+    the same for every transform, so centers at two poses are corresponding
+    landmarks.
+    """
+    from UltrasoundSimulatorLib import transformPoints
+    spheres = self.getSphereDetector(model).detectSpheres()
+    return transformPoints(self.modelToWorldArray(modelToWorld), spheres.center)
+
+  def unmarkedSphereCenters(self, positions, modelToWorld=None, model=None):
+    """Returns the world positions of the calibration model sphere centers,
+    in the order of calibrationSphereCenters, that have none of the (N, 3)
+    world positions (e.g. placed fiducials) within their radius.
+    """
+    centers = self.calibrationSphereCenters(modelToWorld, model)
+    radii = self.getSphereDetector(model).detectSpheres().radius
+    positions = numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)
+    if not len(positions) or not len(centers):
+      return centers
+    distances = numpy.linalg.norm(centers[:, numpy.newaxis] - positions[numpy.newaxis], axis=-1)
+    return centers[distances.min(axis=1) > radii]
+
+  def snapToSphereCenter(self, position, modelToWorld=None, searchRadius=None, model=None):
+    """Returns the world position of the center of the calibration model
+    sphere fitted at a world position (e.g. a click on its surface), or None
+    if no sphere center is within searchRadius (mm, 1.5 times the radius of
+    the largest sphere of the model by default).
+    """
+    from UltrasoundSimulatorLib import transformPoints
+    detector = self.getSphereDetector(model)
+    if searchRadius is None:
+      radii = detector.detectSpheres().radius
+      searchRadius = 1.5 * (radii.max() if len(radii) else detector.minimumRadius)
+    matrix = self.modelToWorldArray(modelToWorld)
+    modelPosition = transformPoints(numpy.linalg.inv(matrix), numpy.asarray(position, dtype=numpy.float64))
+    fit = detector.fitNear(modelPosition, searchRadius)
+    if fit is None or numpy.linalg.norm(fit.center - modelPosition) > searchRadius:
+      return None
+    return transformPoints(matrix, fit.center)
+
+  def benchmarkSphereDetection(self, path=None):
+    """Time to read and index a calibration model STL (a synthetic one by
+    default) and detect its spheres, and time per sphere fitted at a click.
+    """
+    from UltrasoundSimulatorLib.Benchmark import benchmarkSphereDetection
+    numberOfVertices, loadSeconds, detectionSeconds, clickSeconds = benchmarkSphereDetection(path)
+    logging.info('benchmarkSphereDetection %d vertices: %.1f ms load and index, %.1f ms detection, %.1f ms/click'
+                 % (numberOfVertices, loadSeconds * 1000, detectionSeconds * 1000, clickSeconds * 1000))
+    return numberOfVertices, loadSeconds, detectionSeconds, clickSeconds
+
+  def benchmarkFrameStore(self, numberOfFrames=2048, chunkSize=256):
+    """Write throughput of the frame store with and without compression, and
+    time spent in write by the simulation thread.
+    """
+    from UltrasoundSimulatorLib.Benchmark import benchmarkFrameStore
+    results = {}
+    for compress in (True, False):
+      statistics = benchmarkFrameStore(numberOfFrames, chunkSize, compress)
+      logging.info('benchmarkFrameStore %s: %.0f frames/s, %.1f MB/s, ratio %.1f, write %.3f ms mean, %.1f ms max'
+                   % ('compressed' if compress else 'uncompressed', statistics['writeFramesPerSecond'],
+                      statistics['writeMegabytesPerSecond'], statistics['compressionRatio'],
+                      statistics['meanWriteSeconds'] * 1000, statistics['maxWriteSeconds'] * 1000))
+      results['compressed' if compress else 'uncompressed'] = statistics
+    return results
+
+  def fiducialPositions(self, fiducialNode):
+    """Returns the positions of all fiducials of a markups node as an (N, 3) array
+    """
+    positions = numpy.zeros((fiducialNode.GetNumberOfFiducials(), 3))
+    ras = [0,0,0]
+    for index in range(len(positions)):
+      fiducialNode.GetNthFiducialPosition(index, ras)
+      positions[index] = ras
+    return positions
+
+  def registerLandmarks(self, movingPoints, fixedPoints, weights=None, similarity=False):
+    """Closed-form (SVD) landmark registration computed in process. Point
+    arrays are (..., N, 3), leading dimensions are solved as a batch. Returns
+    a RegistrationResult of the moving to fixed matrix, RMS error and
+    per-point residuals.
+    """
+    from UltrasoundSimulatorLib import fitLandmarkTransform
+    return fitLandmarkTransform(movingPoints, fixedPoints, weights, similarity)
+
   def calculateStartToEnd(self, saveTransform, startFiducialNode, endFiducialNode):
+    """Sets saveTransform to the rigid transform mapping the start fiducials
+    onto the end fiducials and returns the RegistrationResult. Raises
+    ValueError if the fiducial lists do not match.
+    """
     logging.info("calculateEndToStart")
-    parameters = {}
-    rms = 0
-    parameters["fixedLandmarks"] = endFiducialNode.GetID()
-    parameters["movingLandmarks"] = startFiducialNode.GetID()
-    parameters["saveTransform"] = saveTransform.GetID()
-    parameters["rms"] = rms 
-    fidReg = slicer.modules.fiducialregistration
-    slicer.cli.run(fidReg, None, parameters)
-    return
+    startPoints = self.fiducialPositions(startFiducialNode)
+    endPoints = self.fiducialPositions(endFiducialNode)
+    if len(startPoints) < 3 or len(startPoints) != len(endPoints):
+      raise ValueError('calculateStartToEnd: %d start and %d end fiducials, expected the same number and at least 3'
+                       % (len(startPoints), len(endPoints)))
+    result = self.registerLandmarks(startPoints, endPoints)
+    self.setTransformNodeMatrix(saveTransform, result.matrix)
+    logging.info("calculateEndToStart: RMS error %.3f mm" % result.rms)
+    return result
     
   def hasImageData(self,volumeNode):
     """This is an example logic method that
@@ -686,6 +2005,71 @@ class UltrasoundSimulatorTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_UltrasoundSimulator1()
+    self.setUp()
+    self.test_UltrasoundSimulatorBMode()
+    self.setUp()
+    self.test_UltrasoundSimulatorSequence()
+    self.setUp()
+    self.test_UltrasoundSimulatorAcousticProperties()
+    self.setUp()
+    self.test_UltrasoundSimulatorCalibrationStateMachine()
+    self.setUp()
+    self.test_UltrasoundSimulatorLandmarkRegistration()
+    self.setUp()
+    self.test_UltrasoundSimulatorSessionRecording()
+    self.setUp()
+    self.test_UltrasoundSimulatorTransformChain()
+    self.setUp()
+    self.test_UltrasoundSimulatorFrameCache()
+    self.setUp()
+    self.test_UltrasoundSimulatorVolumePyramid()
+    self.setUp()
+    self.test_UltrasoundSimulatorSpeckle()
+    self.setUp()
+    self.test_UltrasoundSimulatorDisplaySink()
+    self.setUp()
+    self.test_UltrasoundSimulatorDataPaths()
+    self.setUp()
+    self.test_UltrasoundSimulatorProfiler()
+    self.setUp()
+    self.test_UltrasoundSimulatorBenchmarkSuite()
+    self.setUp()
+    self.test_UltrasoundSimulatorScanlineEcho()
+    self.setUp()
+    self.test_UltrasoundSimulatorMultiProbe()
+    self.setUp()
+    self.test_UltrasoundSimulatorProbeBindings()
+    self.setUp()
+    self.test_UltrasoundSimulatorRenderWorker()
+    self.setUp()
+    self.test_UltrasoundSimulatorImagingModes()
+    self.setUp()
+    self.test_UltrasoundSimulatorScanConversion()
+    self.setUp()
+    self.test_UltrasoundSimulatorPostProcessing()
+    self.setUp()
+    self.test_UltrasoundSimulatorSphereDetection()
+    self.setUp()
+    self.test_UltrasoundSimulatorCalibrationModelNode()
+    self.setUp()
+    self.test_UltrasoundSimulatorFrameStore()
+    self.setUp()
+    self.test_UltrasoundSimulatorVolumeStore()
+    self.setUp()
+    self.test_UltrasoundSimulatorPoseStream()
+
+  def randomPhantom(self, low=-1000, high=2000, **parameters):
+    """Random (40, 50, 60) HU phantom of values in [low, high) with 1 mm
+    voxels at the origin, a probe pose inside it and the probe parameters
+    of the small frames the tests render, updated with parameters. Returns
+    (volume, probeToWorld, parameters).
+    """
+    volume = numpy.random.RandomState(0).randint(low, high, (40, 50, 60)).astype(numpy.int16)
+    probeToWorld = numpy.eye(4)
+    probeToWorld[:3, 3] = [30, 5, 20]
+    probeParameters = dict(width=30.0, depth=40.0, numberOfScanlines=16, samplesPerLine=64)
+    probeParameters.update(parameters)
+    return volume, probeToWorld, probeParameters
 
   def test_UltrasoundSimulator1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -722,3 +2106,1025 @@ class UltrasoundSimulatorTest(ScriptedLoadableModuleTest):
     logic = UltrasoundSimulatorLogic()
     self.assertTrue( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorBMode(self):
+    """Renders a synthetic phantom with the NumPy engine, without any view.
+    """
+    self.delayDisplay("Starting the B-mode test")
+    volume = numpy.full((60, 80, 100), 40, dtype=numpy.int16)
+    volume[:, 40:, :] = 1200
+    probeToWorld = numpy.eye(4)
+    probeToWorld[:3, 3] = [50, 10, 30]
+    logic = UltrasoundSimulatorLogic()
+    frame = logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld,
+                                width=40.0, depth=50.0, numberOfScanlines=32, samplesPerLine=101)
+    self.assertEqual(frame.shape, (101, 32))
+    self.assertEqual(frame.dtype, numpy.uint8)
+    # Strongest echo at the soft tissue/bone interface, 29.5 mm below the probe
+    self.assertTrue(numpy.all(numpy.argmax(frame, axis=0) == 59))
+
+    # A convex probe reaches the interface later on its oblique scanlines
+    from UltrasoundSimulatorLib import ConvexProbe
+    probe = ConvexProbe(radius=20.0, angle=60.0, depth=50.0, numberOfScanlines=33, samplesPerLine=101)
+    frame = logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld, probe=probe)
+    self.assertEqual(frame.shape, (101, 33))
+    interfaceSamples = numpy.argmax(frame, axis=0)
+    self.assertEqual(interfaceSamples[16], 59)
+    self.assertTrue(interfaceSamples[0] > 59 and interfaceSamples[-1] > 59)
+    # Without a pose the transform chain is required
+    self.assertRaises(ValueError, logic.simulateFrame, volume, (1, 1, 1), (0, 0, 0), probe=probe)
+    # A geometry without sample positions cannot be created
+    from UltrasoundSimulatorLib import ProbeGeometry
+    class IncompleteProbe(ProbeGeometry):
+      pass
+    self.assertRaises(TypeError, IncompleteProbe, 50.0, 32, 101)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorSequence(self):
+    """Frames rendered on a process pool must match the single process path,
+    with property volumes and speckle shared rather than pickled.
+    """
+    self.delayDisplay("Starting the sequence test")
+    volume, probeToWorld, parameters = self.randomPhantom()
+    poses = numpy.tile(probeToWorld, (10, 1, 1))
+    poses[:, 2, 3] += numpy.linspace(-5, 5, 10)
+    logic = UltrasoundSimulatorLogic()
+    single = logic.simulateSequence(volume, poses, (1, 1, 1), (0, 0, 0), numberOfWorkers=1, **parameters)
+    pooled = logic.simulateSequence(volume, poses, (1, 1, 1), (0, 0, 0), numberOfWorkers=2, **parameters)
+    self.assertEqual(single.shape, (10, 64, 16))
+    self.assertTrue(numpy.array_equal(single, pooled))
+
+    # Acoustic properties and speckle reach the workers as memory mapped files
+    import pickle, shutil
+    from UltrasoundSimulatorLib import computeAcousticProperties
+    from UltrasoundSimulatorLib.BatchSimulation import sharedTemporaryDirectory, shareParameters
+    parameters.update(acousticProperties=computeAcousticProperties(volume), speckle=logic.createSpeckleModel(seed=1))
+    directory = sharedTemporaryDirectory()
+    try:
+      shared = shareParameters(parameters, directory)
+      self.assertTrue(len(pickle.dumps(shared)) < 4096)
+      speckle = pickle.loads(pickle.dumps(shared['speckle']))
+      self.assertTrue(numpy.array_equal(speckle.texture, parameters['speckle'].texture))
+      self.assertIsNone(parameters['speckle'].texturePath)
+    finally:
+      shutil.rmtree(directory)
+    single = logic.simulateSequence(volume, poses, (1, 1, 1), (0, 0, 0), numberOfWorkers=1, **parameters)
+    pooled = logic.simulateSequence(volume, poses, (1, 1, 1), (0, 0, 0), numberOfWorkers=2, **parameters)
+    self.assertTrue(numpy.array_equal(single, pooled))
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorAcousticProperties(self):
+    """Acoustic property volumes are cached by content and evicted LRU.
+    """
+    self.delayDisplay("Starting the acoustic properties test")
+    import shutil, tempfile
+    from UltrasoundSimulatorLib import AcousticPropertyCache, computeAcousticProperties
+    cacheDirectory = tempfile.mkdtemp()
+    try:
+      volume = numpy.random.RandomState(0).randint(-1000, 2000, (20, 30, 40)).astype(numpy.int16)
+      cache = AcousticPropertyCache(cacheDirectory, maxBytes=volume.size * 5 + 1024)
+      computed = computeAcousticProperties(volume)
+      cached = cache.get(volume)
+      self.assertTrue(numpy.array_equal(cached.impedance, computed.impedance))
+      self.assertEqual(cached.scattererDensity.dtype, numpy.uint8)
+      self.assertTrue(isinstance(cache.get(volume.copy()).impedance, numpy.memmap))
+      # A second volume does not fit next to the first one
+      cache.get(volume[::-1].copy())
+      self.assertEqual(len(cache.entries()), 1)
+      # The hash of a keyed array is only computed again for a new version
+      cache.arrayHashes['node'] = (1, 'stale')
+      self.assertEqual(cache.sourceHash(volume, ('node', 1)), 'stale')
+      self.assertEqual(cache.sourceHash(volume, ('node', 2)), cache.sourceHash(volume))
+      self.assertTrue(numpy.array_equal(cache.get(volume, sourceKey=('node', 2)).impedance, computed.impedance))
+    finally:
+      shutil.rmtree(cacheDirectory)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorCalibrationStateMachine(self):
+    """Walks the calibration workflow through its events, without any GUI.
+    """
+    self.delayDisplay("Starting the calibration state machine test")
+    from UltrasoundSimulatorLib import CalibrationStateMachine
+    stateMachine = CalibrationStateMachine(3)
+    transitions = []
+    fiducialCounts = []
+    stateMachine.stateChangedCallbacks.append(lambda previous, state, event: transitions.append(state))
+    stateMachine.fiducialPlacedCallbacks.append(fiducialCounts.append)
+
+    self.assertFalse(stateMachine.processEvent(stateMachine.FIDUCIAL_PLACED))
+    self.assertTrue(stateMachine.processEvent(stateMachine.START))
+    for i in range(3):
+      stateMachine.processEvent(stateMachine.FIDUCIAL_PLACED)
+    self.assertEqual(stateMachine.state, stateMachine.ALIGN_CALIBRATION_MODEL)
+    self.assertFalse(stateMachine.processEvent(stateMachine.CALCULATE))
+    stateMachine.processEvent(stateMachine.MODEL_ALIGNED)
+    # The first end fiducial is shared with the start fiducials
+    for i in range(2):
+      stateMachine.processEvent(stateMachine.FIDUCIAL_PLACED)
+    stateMachine.processEvent(stateMachine.CALCULATE)
+    stateMachine.processEvent(stateMachine.REGISTRATION_FAILED)
+    stateMachine.processEvent(stateMachine.CALCULATE)
+    stateMachine.processEvent(stateMachine.REGISTRATION_COMPLETED)
+
+    self.assertEqual(fiducialCounts, [1, 2, 2])
+    self.assertEqual(transitions, [
+      stateMachine.PLACE_START_FIDUCIALS, stateMachine.ALIGN_CALIBRATION_MODEL, stateMachine.PLACE_END_FIDUCIALS,
+      stateMachine.CALCULATE_START_TO_END, stateMachine.APPLY_AND_FINALIZE_CALIBRATION,
+      stateMachine.CALCULATE_START_TO_END, stateMachine.APPLY_AND_FINALIZE_CALIBRATION, stateMachine.COMPLETED])
+    stateMachine.processEvent(stateMachine.STOP)
+    self.assertEqual(stateMachine.state, stateMachine.IDLE)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorLandmarkRegistration(self):
+    """Landmark registration recovers known rigid and similarity transforms.
+    """
+    self.delayDisplay("Starting the landmark registration test")
+    from UltrasoundSimulatorLib import fitLandmarkTransformRansac
+    logic = UltrasoundSimulatorLogic()
+    random = numpy.random.RandomState(0)
+    angle = numpy.radians(30)
+    rotation = numpy.array([[numpy.cos(angle), -numpy.sin(angle), 0],
+                            [numpy.sin(angle), numpy.cos(angle), 0],
+                            [0, 0, 1]])
+    translation = numpy.array([10.0, -5.0, 3.0])
+    moving = random.rand(3, 3) * 50
+    fixed = numpy.dot(moving, rotation.T) + translation
+
+    result = logic.registerLandmarks(moving, fixed)
+    self.assertTrue(numpy.allclose(result.matrix[:3, :3], rotation))
+    self.assertTrue(numpy.allclose(result.matrix[:3, 3], translation))
+    self.assertTrue(result.rms < 1e-9)
+
+    result = logic.registerLandmarks(moving, 2.0 * fixed, similarity=True)
+    self.assertTrue(numpy.allclose(result.matrix[:3, :3], 2.0 * rotation))
+
+    # A batch of point sets, one of them mirrored which must still give a rotation
+    moving = random.rand(4, 3) * 50
+    fixed = numpy.dot(moving, rotation.T) + translation
+    batchMoving = numpy.array([moving, moving])
+    batchFixed = numpy.array([fixed, fixed * [1, 1, -1]])
+    result = logic.registerLandmarks(batchMoving, batchFixed)
+    self.assertEqual(result.matrix.shape, (2, 4, 4))
+    self.assertTrue(numpy.allclose(numpy.linalg.det(result.matrix[:, :3, :3]), 1.0))
+    self.assertTrue(result.rms[1] > 1.0)
+
+    # A zero weight and RANSAC both ignore an outlier
+    moving = random.rand(8, 3) * 50
+    fixed = numpy.dot(moving, rotation.T) + translation
+    fixed[5] += 20
+    weights = numpy.ones(8)
+    weights[5] = 0
+    result = logic.registerLandmarks(moving, fixed, weights)
+    self.assertTrue(numpy.allclose(result.matrix[:3, 3], translation))
+    self.assertTrue(result.residuals[5] > 10)
+    result, inliers = fitLandmarkTransformRansac(moving, fixed, 1.0, seed=0)
+    self.assertEqual(list(numpy.nonzero(~inliers)[0]), [5])
+    self.assertTrue(numpy.allclose(result.matrix[:3, 3], translation))
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorSessionRecording(self):
+    """A recorded session replays to the probe poses that were rendered live.
+    """
+    self.delayDisplay("Starting the session recording test")
+    import shutil, tempfile
+    from UltrasoundSimulatorLib import SessionRecorder, SessionRecording
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'session.usrec')
+    translate = numpy.eye(4)
+    translate[:3, 3] = [-30, -5, -20]
+    inverse = numpy.linalg.inv(translate)
+    recorder = SessionRecorder(path, [SessionRecording.TRANSLATE, SessionRecording.IMU, SessionRecording.INVERSE])
+    recorder.addRecord(SessionRecording.TRANSLATE, translate, 0.0)
+    recorder.addRecord(SessionRecording.INVERSE, inverse, 0.0)
+    imuMatrices = []
+    for index, angle in enumerate(numpy.radians([0, 5, 10])):
+      imu = numpy.eye(4)
+      imu[:3, :3] = [[numpy.cos(angle), -numpy.sin(angle), 0], [numpy.sin(angle), numpy.cos(angle), 0], [0, 0, 1]]
+      recorder.addRecord(SessionRecording.IMU, imu, 0.01 * (index + 1))
+      imuMatrices.append(imu)
+    recorder.close()
+
+    recording = SessionRecording(path)
+    self.assertEqual(len(recording), 5)
+    timestamps, poses = recording.probePoses()
+    self.assertTrue(numpy.allclose(timestamps, [0.01, 0.02, 0.03]))
+    for imu, pose in zip(imuMatrices, poses):
+      self.assertTrue(numpy.allclose(pose, numpy.linalg.inv(numpy.dot(inverse, numpy.dot(imu, translate)))))
+
+    volume = numpy.full((40, 50, 60), 40, dtype=numpy.int16)
+    frames = []
+    logic = UltrasoundSimulatorLogic()
+    statistics = logic.replaySession(path, volume, (1, 1, 1), (0, 0, 0), frameCallback=lambda t, frame: frames.append(frame),
+                                     width=20.0, depth=20.0, numberOfScanlines=16, samplesPerLine=32)
+    self.assertEqual(statistics['numberOfFrames'], 3)
+    self.assertEqual(frames[0].shape, (32, 16))
+    shutil.rmtree(directory)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorTransformChain(self):
+    """The composed pose is only recomputed after a transform of the chain changed.
+    """
+    self.delayDisplay("Starting the transform chain test")
+    from UltrasoundSimulatorLib import TransformChain
+    translate = numpy.eye(4)
+    translate[1, 3] = -80
+    imu = numpy.eye(4)
+    imu[:3, :3] = [[0, -1, 0], [1, 0, 0], [0, 0, 1]]
+    probeToWorld = numpy.eye(4)
+    probeToWorld[1, 3] = -60
+    chain = TransformChain(3, probeToWorld)
+    chain.setMatrix(0, translate)
+    chain.setMatrix(1, imu)
+    chain.setMatrix(2, numpy.linalg.inv(imu))
+    expected = numpy.dot(numpy.linalg.inv(translate), probeToWorld)
+    self.assertTrue(numpy.allclose(chain.probeToVolume(), expected))
+    self.assertTrue(numpy.allclose(chain.volumeToProbe(), numpy.linalg.inv(expected)))
+    self.assertEqual(chain.numberOfCompositions, 1)
+
+    modifiedTime = chain.modifiedTime
+    chain.setMatrix(1, numpy.eye(4))
+    self.assertTrue(chain.isModifiedSince(modifiedTime))
+    self.assertFalse(numpy.allclose(chain.probeToVolume(), expected))
+    self.assertEqual(chain.numberOfCompositions, 2)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorFrameCache(self):
+    """Small pose changes reuse the cached frame, larger ones re-render.
+    """
+    self.delayDisplay("Starting the frame cache test")
+    volume, probeToWorld, parameters = self.randomPhantom()
+    logic = UltrasoundSimulatorLogic()
+    frame = logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld, useFrameCache=True, **parameters)
+    probeToWorld[0, 3] += 0.01
+    cached = logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld, useFrameCache=True, **parameters)
+    self.assertTrue(numpy.array_equal(frame, cached))
+    probeToWorld[0, 3] += 5.0
+    moved = logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld, useFrameCache=True, **parameters)
+    self.assertTrue(numpy.array_equal(moved, logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld, **parameters)))
+    statistics = logic.frameCacheStatistics()
+    self.assertEqual((statistics['hits'], statistics['misses']), (1, 2))
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorVolumePyramid(self):
+    """Fast rotations render from a coarser level, refined once motion stops.
+    """
+    self.delayDisplay("Starting the volume pyramid test")
+    volume = numpy.full((60, 80, 100), 40, dtype=numpy.int16)
+    volume[:, 40:, :] = 1200
+    logic = UltrasoundSimulatorLogic()
+    pyramid = logic.buildVolumePyramid(volume, (1, 1, 1), (0, 0, 0))
+    self.assertEqual([pyramid.level(index)[0].shape for index in range(3)], [(60, 80, 100), (30, 40, 50), (15, 20, 25)])
+    self.assertTrue(pyramid.memoryReport()['overheadFraction'] < 1 / 7.0)
+
+    parameters = dict(width=40.0, depth=50.0, numberOfScanlines=32, samplesPerLine=101)
+    probeToWorld = numpy.eye(4)
+    probeToWorld[:3, 3] = [50, 10, 30]
+    frame = logic.simulateLevelOfDetailFrame(probeToWorld, 0.0, **parameters)
+    self.assertEqual(logic.levelOfDetailRenderer.levelRendered, 0)
+    self.assertEqual(logic.refineLevelOfDetailFrame(), None)
+    angle = numpy.radians(5)
+    rotated = probeToWorld.copy()
+    rotated[:3, :3] = [[numpy.cos(angle), -numpy.sin(angle), 0], [numpy.sin(angle), numpy.cos(angle), 0], [0, 0, 1]]
+    # 5 degrees in 10 ms is 500 degrees/s
+    coarse = logic.simulateLevelOfDetailFrame(rotated, 0.01, **parameters)
+    self.assertEqual(logic.levelOfDetailRenderer.levelRendered, 2)
+    self.assertEqual(coarse.shape, frame.shape)
+    refined = logic.refineLevelOfDetailFrame()
+    self.assertTrue(numpy.array_equal(refined, logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), rotated, **parameters)))
+
+    # The render worker builds the pyramid only when level of detail is used
+    logic = UltrasoundSimulatorLogic()
+    logic.startRenderWorker(volume, (1, 1, 1), (0, 0, 0), **parameters)
+    logic.stopRenderWorker()
+    self.assertIsNone(logic.volumePyramid)
+    worker = logic.startRenderWorker(volume, (1, 1, 1), (0, 0, 0), levelOfDetail=True, **parameters)
+    try:
+      self.assertEqual(len(logic.volumePyramid), 3)
+      worker.submit(probeToWorld)
+      worker.waitForResult(10.0)
+      self.assertFalse(logic.refineRenderWorkerFrame())
+      # 45 degrees between two renders is coarse unless they are seconds apart
+      rotated[:3, :3] = [[numpy.cos(numpy.pi / 4), -numpy.sin(numpy.pi / 4), 0],
+                         [numpy.sin(numpy.pi / 4), numpy.cos(numpy.pi / 4), 0], [0, 0, 1]]
+      worker.submit(rotated)
+      coarse, _ = worker.waitForResult(10.0)
+      self.assertTrue(logic.levelOfDetailRenderer.levelRendered > 0)
+      # Once the probe stopped, the last pose is refined on the worker
+      self.assertTrue(logic.refineRenderWorkerFrame())
+      refined, pose = worker.waitForResult(10.0)
+      self.assertEqual(logic.levelOfDetailRenderer.levelRendered, 0)
+      self.assertTrue(numpy.array_equal(pose, rotated))
+      self.assertFalse(logic.refineRenderWorkerFrame())
+    finally:
+      logic.stopRenderWorker()
+    self.assertTrue(numpy.array_equal(refined, logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), rotated, **parameters)))
+    self.assertRaises(ValueError, logic.startRenderWorker, volume, (1, 1, 1), (0, 0, 0), numberOfThreads=2,
+                      levelOfDetail=True)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorSpeckle(self):
+    """Speckle textures homogeneous tissue and is reproducible for a seed.
+    """
+    self.delayDisplay("Starting the speckle test")
+    volume = numpy.full((60, 80, 100), 40, dtype=numpy.int16)
+    probeToWorld = numpy.eye(4)
+    probeToWorld[:3, 3] = [50, 10, 30]
+    logic = UltrasoundSimulatorLogic()
+    parameters = dict(width=40.0, depth=50.0, numberOfScanlines=64, samplesPerLine=128)
+    plain = logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld, **parameters)
+    speckled = logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld,
+                                   speckle=logic.createSpeckleModel(seed=1), **parameters)
+    self.assertEqual(speckled.shape, plain.shape)
+    self.assertTrue(numpy.std(speckled[10:100, 10:50].astype(float)) > 5 * numpy.std(plain[10:100, 10:50].astype(float)))
+    again = logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld,
+                                speckle=logic.createSpeckleModel(seed=1), **parameters)
+    self.assertTrue(numpy.array_equal(speckled, again))
+    other = logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld,
+                                speckle=logic.createSpeckleModel(seed=2), **parameters)
+    self.assertFalse(numpy.array_equal(speckled, other))
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorDisplaySink(self):
+    """Frames reach a volume node through shared memory, without allocations.
+    """
+    self.delayDisplay("Starting the display sink test")
+    from UltrasoundSimulatorLib.DisplaySink import measureRenderAllocations, measureWriteAllocations
+    volume = numpy.full((60, 80, 100), 40, dtype=numpy.int16)
+    volume[:, 40:, :] = 1200
+    probeToWorld = numpy.eye(4)
+    probeToWorld[:3, 3] = [50, 10, 30]
+    parameters = dict(width=40.0, depth=50.0, numberOfScanlines=128, samplesPerLine=256)
+    logic = UltrasoundSimulatorLogic()
+    sink = logic.createDisplaySink((256, 128), (50.0 / 255, 40.0 / 127))
+    frame = logic.simulateFrameToDisplaySink(sink, volume, (1, 1, 1), (0, 0, 0), probeToWorld, **parameters)
+    self.assertTrue(numpy.array_equal(frame, logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld, **parameters)))
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(sink.volumeNode)[0], frame))
+
+    frames = [numpy.roll(frame, shift, axis=0) for shift in range(20)]
+    allocations = measureWriteAllocations(sink, frames)
+    logging.info('Display sink allocations: %s' % allocations)
+    self.assertTrue(allocations['bytesPerFrame'] < 1024)
+    self.assertTrue(allocations['peakBytes'] < frame.nbytes)
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(sink.volumeNode)[0], frames[-1]))
+
+    # Rendering into the sink does not allocate frames either, but the
+    # renderer's point sized temporaries (32768 samples) peak at about 1.7 MB
+    renderer = logic.getBModeRenderer(volume, (1, 1, 1), (0, 0, 0), **parameters)
+    poses = numpy.repeat(probeToWorld[numpy.newaxis], 10, axis=0)
+    poses[:, 0, 3] += numpy.linspace(0.0, 5.0, 10)
+    allocations = measureRenderAllocations(sink, renderer, poses)
+    logging.info('Render to display sink allocations: %s' % allocations)
+    self.assertTrue(allocations['bytesPerFrame'] < 1024)
+    self.assertTrue(allocations['peakBytes'] < 64 * frame.nbytes)
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(sink.volumeNode)[0], renderer.render(poses[-1])))
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorDataPaths(self):
+    """Data files are resolved relative to the module or the configured directory.
+    """
+    self.delayDisplay("Starting the data paths test")
+    import shutil, tempfile
+    directory = tempfile.mkdtemp()
+    open(os.path.join(directory, 'Linear_probe.mha'), 'w').close()
+    logic = UltrasoundSimulatorLogic()
+    previous = os.environ.get('ULTRASOUND_SIMULATOR_DATA_PATH')
+    os.environ['ULTRASOUND_SIMULATOR_DATA_PATH'] = directory
+    try:
+      self.assertEqual(logic.dataPath('Linear_probe.mha'), os.path.join(directory, 'Linear_probe.mha'))
+      self.assertRaises(ValueError, logic.dataPath, 'Missing_phantom.mha')
+    finally:
+      if previous is None:
+        del os.environ['ULTRASOUND_SIMULATOR_DATA_PATH']
+      else:
+        os.environ['ULTRASOUND_SIMULATOR_DATA_PATH'] = previous
+      shutil.rmtree(directory)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorProfiler(self):
+    """Enabled profiling times every rendering stage and exports the statistics.
+    """
+    self.delayDisplay("Starting the profiler test")
+    import csv, json, shutil, tempfile
+    volume, probeToWorld, parameters = self.randomPhantom()
+    logic = UltrasoundSimulatorLogic()
+    logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld, **parameters)
+    self.assertEqual(logic.profiler.statistics()['stages'], {})
+    logic.setProfilingEnabled(True)
+    for _ in range(5):
+      logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld, **parameters)
+    statistics = logic.profiler.statistics()
+    self.assertEqual(statistics['frames'], 5)
+    self.assertEqual(sorted(statistics['stages']), ['echo', 'logCompress', 'render', 'reslice'])
+    render = statistics['stages']['render']
+    self.assertEqual(render['count'], 5)
+    self.assertTrue(render['p50'] <= render['p95'] <= render['p99'] <= render['max'])
+
+    directory = tempfile.mkdtemp()
+    logic.exportProfile(os.path.join(directory, 'profile.json'))
+    with open(os.path.join(directory, 'profile.json')) as f:
+      self.assertEqual(json.load(f)['frames'], 5)
+    logic.exportProfile(os.path.join(directory, 'profile.csv'))
+    with open(os.path.join(directory, 'profile.csv')) as f:
+      self.assertEqual(len(list(csv.reader(f))), 5)
+    shutil.rmtree(directory)
+
+    # Render threads and the main thread record into the same profiler
+    import threading
+    from UltrasoundSimulatorLib import Profiler
+    profiler = Profiler(historySize=64, enabled=True)
+    def record():
+      for _ in range(2000):
+        with profiler.stage('render'):
+          pass
+        profiler.frame()
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    statistics = profiler.statistics()
+    self.assertEqual((statistics['stages']['render']['count'], statistics['frames']), (8000, 8000))
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorBenchmarkSuite(self):
+    """The benchmark suite runs on a synthetic phantom and flags slowed down stages.
+    """
+    self.delayDisplay("Starting the benchmark suite test")
+    import copy, shutil, tempfile
+    directory = tempfile.mkdtemp()
+    baselinePath = os.path.join(directory, 'baseline.json')
+    parameters = dict(shape=(32, 40, 40), spacing=(1.0, 1.0, 1.0), numberOfFrames=4, workerCounts=(1,), repeats=2,
+                      probeParameters=dict(width=30.0, depth=30.0, numberOfScanlines=16, samplesPerLine=32))
+    logic = UltrasoundSimulatorLogic()
+    try:
+      results, regressions = logic.runBenchmarkSuite(baselinePath, updateBaseline=True, **parameters)
+      self.assertEqual(regressions, [])
+      self.assertTrue(os.path.exists(baselinePath))
+      self.assertEqual(sorted(results['stages']), ['acousticProperties', 'batchFrame/1', 'frameLatency',
+                                                   'registration', 'volumeLoad'])
+      self.assertTrue(all(timing['seconds'] > 0 for timing in results['stages'].values()))
+
+      from UltrasoundSimulatorLib.Benchmark import compareToBaseline, fastestResults, loadBenchmarkResults
+      baseline = loadBenchmarkResults(baselinePath)
+      self.assertEqual(compareToBaseline(baseline, baseline), [])
+      slower = copy.deepcopy(baseline)
+      slower['stages']['frameLatency']['min'] = baseline['stages']['frameLatency']['min'] * 2 + 0.01
+      regressions = compareToBaseline(slower, baseline, threshold=0.25)
+      self.assertEqual([stage for stage, _, _, _ in regressions], ['frameLatency'])
+      # Outliers that only move the median are not regressions
+      noisy = copy.deepcopy(baseline)
+      for timing in noisy['stages'].values():
+        timing['seconds'] = timing['seconds'] * 3 + 0.01
+      self.assertEqual(compareToBaseline(noisy, baseline, threshold=0.25), [])
+      # Running the suite again keeps the fastest run of every stage
+      self.assertEqual(fastestResults(slower, baseline)['stages'], baseline['stages'])
+    finally:
+      shutil.rmtree(directory)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorScanlineEcho(self):
+    """The vectorized echo with shadowing matches the sample by sample reference.
+    """
+    self.delayDisplay("Starting the scanline echo test")
+    from UltrasoundSimulatorLib import (SpeckleModel, mapHounsfieldToAttenuation, mapHounsfieldToImpedance,
+                                        scanlineEcho, scanlineEchoReference)
+    random = numpy.random.RandomState(0)
+    hu = random.normal(40, 30, (12, 80))
+    hu[:4, 30:34] = 1000 # bone
+    hu[4:8, 40:44] = -1000 # air
+    impedance, attenuation = mapHounsfieldToImpedance(hu), mapHounsfieldToAttenuation(hu)
+    for shadowing in (True, False):
+      echo = scanlineEcho(impedance, attenuation, 0.3, 5.0, shadowing=shadowing)
+      reference = scanlineEchoReference(impedance, attenuation, 0.3, 5.0, shadowing=shadowing)
+      self.assertEqual(echo.dtype, numpy.float32)
+      self.assertTrue(numpy.allclose(echo, reference, rtol=1e-4, atol=1e-9))
+    scattering = SpeckleModel(textureSize=16, seed=0).scatterers(random.uniform(0, 10, hu.shape + (3,)),
+                                                                 numpy.full(hu.shape, 200))
+    echo = scanlineEcho(impedance, attenuation, 0.3, 5.0, scattering)
+    reference = scanlineEchoReference(impedance, attenuation, 0.3, 5.0, scattering)
+    self.assertTrue(numpy.allclose(echo, reference, rtol=1e-4, atol=1e-9))
+
+    # Tissue behind the bone and the air gap is shadowed
+    shadowed = scanlineEcho(impedance, attenuation, 0.3, 5.0)
+    unshadowed = scanlineEcho(impedance, attenuation, 0.3, 5.0, shadowing=False)
+    self.assertTrue(numpy.all(shadowed[:8, 55:] < 0.5 * unshadowed[:8, 55:]))
+    self.assertTrue(numpy.all(shadowed[8:, 55:] > 0.5 * unshadowed[8:, 55:]))
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorMultiProbe(self):
+    """Probes rendered together give the frames of separate renderers.
+    """
+    self.delayDisplay("Starting the multiple probes test")
+    from UltrasoundSimulatorLib import BModeRenderer, ConvexProbe, LinearProbe, computeAcousticProperties
+    volume, _, _ = self.randomPhantom()
+    probes = [LinearProbe(width=30.0, depth=40.0, numberOfScanlines=16, samplesPerLine=64),
+              ConvexProbe(radius=15.0, angle=60.0, depth=30.0, numberOfScanlines=17, samplesPerLine=48),
+              LinearProbe(width=20.0, depth=40.0, numberOfScanlines=8, samplesPerLine=64)]
+    poses = numpy.tile(numpy.eye(4), (3, 1, 1))
+    poses[:, :3, 3] = [[30, 5, 20], [25, 5, 15], [35, 5, 25]]
+    # Biplane: the third probe images the orthogonal plane
+    poses[2, :3, :3] = [[0, 0, 1], [0, 1, 0], [-1, 0, 0]]
+    logic = UltrasoundSimulatorLogic()
+    frames = logic.simulateProbeFrames(volume, (1, 1, 1), (0, 0, 0), probes, poses)
+    self.assertEqual([frame.shape for frame in frames], [(64, 16), (48, 17), (64, 8)])
+    for probe, pose, frame in zip(probes, poses, frames):
+      self.assertTrue(numpy.array_equal(frame, BModeRenderer(volume, (1, 1, 1), (0, 0, 0), probe=probe).render(pose)))
+    self.assertRaises(ValueError, logic.simulateProbeFrames, volume, (1, 1, 1), (0, 0, 0), probes, poses[:2])
+    # With speckle, acoustic properties and gain the probes are still rendered separately
+    speckle = logic.createSpeckleModel(seed=1)
+    properties = computeAcousticProperties(volume)
+    frames = logic.simulateProbeFrames(volume, (1, 1, 1), (0, 0, 0), probes, poses, speckle=speckle,
+                                       acousticProperties=properties, gain=6.0)
+    for probe, pose, frame in zip(probes, poses, frames):
+      renderer = BModeRenderer(volume, (1, 1, 1), (0, 0, 0), probe=probe, speckle=speckle,
+                               acousticProperties=properties, gain=6.0)
+      self.assertTrue(numpy.array_equal(frame, renderer.render(pose)))
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorProbeBindings(self):
+    """Probes bound to transform nodes render into their own volume nodes.
+    """
+    self.delayDisplay("Starting the probe bindings test")
+    from UltrasoundSimulatorLib import BModeRenderer, LinearProbe
+    volume, _, _ = self.randomPhantom()
+    probes = [LinearProbe(width=30.0, depth=40.0, numberOfScanlines=16, samplesPerLine=64),
+              LinearProbe(width=20.0, depth=40.0, numberOfScanlines=8, samplesPerLine=64)]
+    poses = numpy.tile(numpy.eye(4), (2, 1, 1))
+    poses[:, :3, 3] = [[30, 5, 20], [35, 5, 25]]
+    poses[1, :3, :3] = [[0, 0, 1], [0, 1, 0], [-1, 0, 0]]
+    logic = UltrasoundSimulatorLogic()
+    transformNodes, sinks = [], []
+    for probe, pose in zip(probes, poses):
+      transformNode = slicer.vtkMRMLLinearTransformNode()
+      slicer.mrmlScene.AddNode(transformNode)
+      logic.setTransformNodeMatrix(transformNode, pose)
+      transformNodes.append(transformNode)
+      sinks.append(logic.addProbe(probe, transformNode))
+    self.assertEqual(len(logic.probeBindings), 2)
+    frames = [frame.copy() for frame in logic.renderProbes(volume, (1, 1, 1), (0, 0, 0))]
+    for probe, pose, frame, sink in zip(probes, poses, frames, sinks):
+      self.assertTrue(numpy.array_equal(frame, BModeRenderer(volume, (1, 1, 1), (0, 0, 0), probe=probe).render(pose)))
+      self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(sink.volumeNode)[0], frame))
+
+    # Moving one transform node only changes the frame of its probe
+    moved = poses[0].copy()
+    moved[:3, 3] += [0, 0, 3]
+    logic.setTransformNodeMatrix(transformNodes[0], moved)
+    logic.renderProbes(volume, (1, 1, 1), (0, 0, 0))
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(sinks[0].volumeNode)[0],
+                                      BModeRenderer(volume, (1, 1, 1), (0, 0, 0), probe=probes[0]).render(moved)))
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(sinks[1].volumeNode)[0], frames[1]))
+
+    volumeNodeIDs = [sink.volumeNode.GetID() for sink in sinks]
+    logic.removeProbes()
+    self.assertEqual(logic.probeBindings, [])
+    self.assertTrue(all(slicer.mrmlScene.GetNodeByID(nodeID) is None for nodeID in volumeNodeIDs))
+    self.assertEqual(logic.renderProbes(volume, (1, 1, 1), (0, 0, 0)), [])
+    for transformNode in transformNodes:
+      slicer.mrmlScene.RemoveNode(transformNode)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorRenderWorker(self):
+    """Frames are rendered on a worker thread and stale poses are dropped.
+    """
+    self.delayDisplay("Starting the render worker test")
+    import threading
+    from UltrasoundSimulatorLib import RenderWorker
+    volume, probeToWorld, parameters = self.randomPhantom()
+    logic = UltrasoundSimulatorLogic()
+    worker = logic.startRenderWorker(volume, (1, 1, 1), (0, 0, 0), **parameters)
+    try:
+      worker.submit(probeToWorld)
+      frame, pose = worker.waitForResult(10.0)
+      self.assertTrue(numpy.array_equal(frame, logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld, **parameters)))
+      self.assertIsNone(worker.takeResult())
+    finally:
+      logic.stopRenderWorker()
+
+    # While the first pose renders, newer poses replace each other
+    started, release = threading.Event(), threading.Event()
+    def render(pose):
+      started.set()
+      release.wait(10.0)
+      return pose[0, 3]
+    worker = RenderWorker(render)
+    try:
+      worker.submit(numpy.eye(4))
+      self.assertTrue(started.wait(10.0))
+      for translation in (1.0, 2.0, 3.0):
+        pose = numpy.eye(4)
+        pose[0, 3] = translation
+        worker.submit(pose)
+      release.set()
+      # The first frame is dropped if the last one finishes before it is taken
+      results = [worker.waitForResult(10.0)[0]]
+      if results[0] != 3.0:
+        results.append(worker.waitForResult(10.0)[0])
+    finally:
+      worker.stop()
+    self.assertEqual(results[-1], 3.0)
+    statistics = worker.statistics()
+    self.assertEqual((statistics['submitted'], statistics['rendered'], statistics['droppedRequests']), (4, 2, 2))
+    self.assertEqual(statistics['delivered'] + statistics['droppedResults'], 2)
+    self.assertTrue(0 < statistics['latency']['p50'] <= statistics['latency']['max'])
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorImagingModes(self):
+    """M-mode sweeps one scanline over time and color Doppler measures the flow in its ROI.
+    """
+    self.delayDisplay("Starting the imaging modes test")
+    from UltrasoundSimulatorLib import vesselFlowVelocities
+    volume = numpy.full((40, 60, 80), 40, dtype=numpy.int16)
+    probeToWorld = numpy.eye(4)
+    probeToWorld[:3, 3] = [40, 0, 20]
+    parameters = dict(width=60.0, depth=50.0, numberOfScanlines=64, samplesPerLine=100)
+    logic = UltrasoundSimulatorLogic()
+
+    mMode = logic.createImagingModeRenderer('M-mode', volume, (1, 1, 1), (0, 0, 0), **parameters)
+    bModeFrame = logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld, **parameters)
+    for _ in range(3):
+      image = mMode.render(probeToWorld)
+    self.assertEqual(image.shape, (100, 256))
+    self.assertEqual(mMode.column, 2)
+    self.assertTrue(numpy.array_equal(image[:, 2], bModeFrame[:, 32]))
+    self.assertTrue(numpy.all(image[:, 3:] == 0))
+    # Frames handed out are not changed by later updates
+    mMode.render(probeToWorld)
+    self.assertTrue(numpy.all(image[:, 3] == 0))
+
+    # With speckle the lateral point spread function mixes neighboring
+    # scanlines, the M-mode line still matches the B-mode column
+    speckleVolume, speckleProbeToWorld, speckleParameters = self.randomPhantom()
+    speckle = logic.createSpeckleModel(seed=0, lateralResolution=4.0)
+    mMode = logic.createImagingModeRenderer('M-mode', speckleVolume, (1, 1, 1), (0, 0, 0), speckle=speckle,
+                                            **speckleParameters)
+    self.assertTrue(len(mMode.scanlines) > 1)
+    speckleFrame = logic.simulateFrame(speckleVolume, (1, 1, 1), (0, 0, 0), speckleProbeToWorld, speckle=speckle,
+                                       **speckleParameters)
+    self.assertTrue(numpy.array_equal(mMode.render(speckleProbeToWorld)[:, 0], speckleFrame[:, 8]))
+
+    # A vessel rising along x, so its flow has a component along the beams
+    k, j, i = numpy.ogrid[:40, :60, :80]
+    labels = (((j - (15 + 0.3 * i)) ** 2 + (k - 20) ** 2) <= 16).astype(numpy.uint8)
+    flowVelocities = vesselFlowVelocities(labels, (1, 1, 1), (0, 0, 0), speed=200.0)
+    towardProbe = -flowVelocities[1][1]
+    logic.setFlowModel(labels, flowVelocities)
+    logic.dopplerRoi = (10, 54, 20, 80)
+    doppler = logic.createImagingModeRenderer('Color Doppler', volume, (1, 1, 1), (0, 0, 0), **parameters)
+    doppler.random.seed(0)
+    self.assertTrue(abs(towardProbe) < doppler.nyquistVelocity)
+    velocities = doppler.velocities(probeToWorld)
+    self.assertEqual(velocities.shape, (100, 64))
+    self.assertTrue(numpy.all(numpy.isnan(velocities[:20])) and numpy.all(numpy.isnan(velocities[:, :10])))
+    flow = ~numpy.isnan(velocities)
+    self.assertTrue(numpy.count_nonzero(flow) > 100)
+    self.assertTrue(abs(numpy.median(velocities[flow]) - towardProbe) < 0.05 * abs(towardProbe))
+    frame = doppler.render(probeToWorld)
+    self.assertEqual(frame.shape, (100, 64, 3))
+    # Without indices the ROI follows the fractions of the frame set in the widget
+    logic.dopplerRoi = None
+    doppler = logic.createImagingModeRenderer('Color Doppler', volume, (1, 1, 1), (0, 0, 0), **parameters)
+    self.assertEqual(doppler.roi, (16, 48, 25, 75))
+    logic.setDopplerRoiFractions((0.0, 0.5), (0.2, 0.2))
+    doppler = logic.createImagingModeRenderer('Color Doppler', volume, (1, 1, 1), (0, 0, 0), **parameters)
+    self.assertEqual(doppler.roi, (0, 32, 20, 21))
+    self.assertRaises(ValueError, logic.createImagingModeRenderer, 'A-mode', volume, (1, 1, 1), (0, 0, 0))
+    # Both keep the state of the previous update, so they are not rendered concurrently
+    for mode in ('M-mode', 'Color Doppler'):
+      self.assertRaises(ValueError, logic.startRenderWorker, volume, (1, 1, 1), (0, 0, 0), numberOfThreads=2,
+                        mode=mode, **parameters)
+    self.assertIsNone(logic.renderWorker)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorScanConversion(self):
+    """Precomputed scan conversion matches the probe geometry and is cached per geometry.
+    """
+    self.delayDisplay("Starting the scan conversion test")
+    from UltrasoundSimulatorLib import ConvexProbe, LinearProbe, ScanConverter, ScanConverterCache
+    frame = numpy.random.RandomState(0).randint(0, 256, (64, 32)).astype(numpy.uint8)
+    linear = LinearProbe(width=31.0, depth=63.0, numberOfScanlines=32, samplesPerLine=64)
+    # Pixels on the sample grid reproduce the frame
+    self.assertTrue(numpy.array_equal(ScanConverter(linear, (64, 32)).apply(frame), frame))
+
+    convex = ConvexProbe(radius=40.0, angle=60.0, depth=80.0, numberOfScanlines=65, samplesPerLine=100)
+    ramp = numpy.tile(numpy.arange(65, dtype=numpy.float32), (100, 1))
+    converter = ScanConverter(convex, (200, 201), outsideValue=-1)
+    image = converter.apply(numpy.stack([ramp, 2 * ramp]))
+    self.assertEqual(image.shape, (2, 200, 201))
+    # The center column is the center scanline, the top corners are outside the sector
+    inside = image[0, :, 100] >= 0
+    self.assertTrue(numpy.count_nonzero(inside) > 150)
+    self.assertTrue(numpy.allclose(image[0, inside, 100], 32.0, atol=1e-3))
+    self.assertTrue(numpy.allclose(image[1], numpy.where(image[0] < 0, -1, 2 * image[0]), atol=1e-3))
+    self.assertEqual(image[0, 0, 0], -1)
+    self.assertTrue(converter.numberOfPixels < 200 * 201)
+
+    cache = ScanConverterCache(maxBytes=converter.nbytes + 1)
+    self.assertIs(cache.get(convex, (200, 201)), cache.get(convex, (200, 201)))
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+    cache.get(linear, (64, 32))
+    cache.get(convex, (400, 401))
+    self.assertEqual(cache.evictions, 2)
+    self.assertEqual(len(cache.converters), 1)
+    logic = UltrasoundSimulatorLogic()
+    self.assertEqual(logic.scanConvert(frame, linear, (64, 32)).shape, (64, 32))
+    # Scan conversion needs the inverse mapping of every geometry
+    from UltrasoundSimulatorLib import ProbeGeometry, probePlanePoints
+    class ForwardOnlyProbe(ProbeGeometry):
+      def computePoints(self):
+        return probePlanePoints(30.0, self.depth, self.numberOfScanlines, self.samplesPerLine)
+    self.assertRaises(TypeError, ForwardOnlyProbe, 50.0, 32, 64)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorPostProcessing(self):
+    """Gain, TGC and dynamic range changes of the last frame, also partly
+    re-rendered by the frame cache, match the full pipeline.
+    """
+    self.delayDisplay("Starting the post-processing test")
+    from UltrasoundSimulatorLib import BModeRenderer, FrameCoherenceCache, logCompress, tgcProfile
+    volume, probeToWorld, parameters = self.randomPhantom(-200, 400, width=40.0, numberOfScanlines=32,
+                                                          samplesPerLine=80)
+    logic = UltrasoundSimulatorLogic()
+    self.assertIsNone(logic.setPostProcessing(gain=5.0))
+    logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld, **parameters)
+    envelope = logic.bModeRenderer.envelope(probeToWorld)
+    for gain, dynamicRange, tgc in ((5.0, 60.0, None), (-10.0, 40.0, [0.0, 10.0, 25.0]), (12.0, 80.0, [-5.0, 5.0])):
+      frame = logic.setPostProcessing(gain, dynamicRange, tgc)
+      # Identical to simulating the frame again with these settings
+      renderer = BModeRenderer(volume, (1, 1, 1), (0, 0, 0), gain=gain, dynamicRange=dynamicRange, tgc=tgc, **parameters)
+      self.assertTrue(numpy.array_equal(frame, renderer.render(probeToWorld)))
+      # and within one grey level of log compressing the envelope
+      reference = logCompress(envelope, dynamicRange, gain + tgcProfile(logic.postProcessing.get('tgc'), 80)).T
+      difference = numpy.abs(frame.astype(int) - reference)
+      self.assertTrue(difference.max() <= 1 and numpy.mean(difference) < 0.05)
+    self.assertEqual(logic.getBModeRenderer(volume, (1, 1, 1), (0, 0, 0), **parameters).gain, 12.0)
+    self.assertRaises(ValueError, logic.setPostProcessing, dynamicRange=0.0)
+
+    # After the frame cache re-rendered the scanlines that moved, the lookup
+    # table stage shows the frame of the new pose
+    logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), probeToWorld, useFrameCache=True, **parameters)
+    angle = numpy.radians(2.0)
+    rotation = numpy.eye(4)
+    rotation[:2, :2] = [[numpy.cos(angle), -numpy.sin(angle)], [numpy.sin(angle), numpy.cos(angle)]]
+    pivot = numpy.eye(4)
+    pivot[:3, 3] = logic.bModeRenderer.probePoints[0, 40]
+    rotated = numpy.dot(probeToWorld, numpy.dot(pivot, numpy.dot(rotation, numpy.linalg.inv(pivot))))
+    frame = logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), rotated, useFrameCache=True, **parameters)
+    self.assertEqual(logic.frameCache.partialHits, 1)
+    self.assertTrue(numpy.array_equal(logic.bModeRenderer.postProcess(), frame))
+    frame = logic.setPostProcessing(gain=0.0)
+    cache = FrameCoherenceCache(BModeRenderer(volume, (1, 1, 1), (0, 0, 0), gain=0.0, dynamicRange=80.0,
+                                              tgc=[-5.0, 5.0], **parameters))
+    cache.render(probeToWorld)
+    self.assertTrue(numpy.array_equal(frame, cache.render(rotated)))
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorSphereDetection(self):
+    """Sphere centers fitted on the calibration model give the calibration registration.
+    """
+    self.delayDisplay("Starting the sphere detection test")
+    import shutil, tempfile
+    from UltrasoundSimulatorLib import SpatialGrid, matrixFromQuaternion, writeStl
+    from UltrasoundSimulatorLib.Benchmark import syntheticCalibrationModel
+    centers = numpy.array([[0.0, 0.0, 0.0], [60.0, 0.0, 0.0], [0.0, 40.0, 20.0]])
+    vertices, faces = syntheticCalibrationModel(centers, radius=5.0, resolution=16)
+    grid = SpatialGrid(vertices, 4.0)
+    found = grid.query(centers[1], 5.5)
+    distances = numpy.linalg.norm(vertices - centers[1], axis=1)
+    self.assertEqual(sorted(found), sorted(numpy.flatnonzero(distances <= 5.5)))
+
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'Calibration_model.stl')
+      writeStl(path, vertices, faces)
+      logic = UltrasoundSimulatorLogic()
+      spheres = logic.getSphereDetector(path).detectSpheres()
+      self.assertTrue(numpy.allclose(spheres.center, centers[numpy.lexsort(centers.T[::-1])], atol=1e-4))
+      self.assertTrue(numpy.allclose(spheres.radius, 5.0, atol=1e-4))
+      modelToWorld = numpy.eye(4)
+      modelToWorld[:3, :3] = matrixFromQuaternion(numpy.array([0.9, 0.1, -0.3, 0.2]) / numpy.sqrt(0.95))
+      modelToWorld[:3, 3] = [10.0, -20.0, 35.0]
+      # A click off center snaps to the sphere center, a click far from the spheres does not
+      click = modelToWorld[:3, :3].dot(centers[2] + [2.0, -1.5, 1.0]) + modelToWorld[:3, 3]
+      snapped = logic.snapToSphereCenter(click, modelToWorld, 10.0, path)
+      self.assertTrue(numpy.allclose(snapped, modelToWorld[:3, :3].dot(centers[2]) + modelToWorld[:3, 3], atol=1e-4))
+      self.assertIsNone(logic.snapToSphereCenter([500.0, 0.0, 0.0], modelToWorld, 10.0, path))
+      # By default only clicks on or close to a sphere snap
+      onSurface = modelToWorld[:3, :3].dot(centers[2] + [0.0, 0.0, 5.0]) + modelToWorld[:3, 3]
+      snapped = logic.snapToSphereCenter(onSurface, modelToWorld, model=path)
+      self.assertTrue(numpy.allclose(snapped, modelToWorld[:3, :3].dot(centers[2]) + modelToWorld[:3, 3], atol=1e-4))
+      beside = modelToWorld[:3, :3].dot(centers[2] + [0.0, 0.0, 13.0]) + modelToWorld[:3, 3]
+      self.assertIsNone(logic.snapToSphereCenter(beside, modelToWorld, model=path))
+      # Spheres with a fiducial inside are not placed again
+      sortedCenters = centers[numpy.lexsort(centers.T[::-1])]
+      unmarked = logic.unmarkedSphereCenters([sortedCenters[1] + [1.0, 2.0, 0.0]], numpy.eye(4), path)
+      self.assertTrue(numpy.allclose(unmarked, sortedCenters[[0, 2]], atol=1e-4))
+      self.assertEqual(len(logic.unmarkedSphereCenters(sortedCenters, numpy.eye(4), path)), 0)
+      # Centers at the start and end poses are landmarks of the registration
+      start = logic.calibrationSphereCenters(numpy.eye(4), path)
+      end = logic.calibrationSphereCenters(modelToWorld, path)
+      result = logic.registerLandmarks(start, end)
+      self.assertTrue(numpy.allclose(result.matrix, modelToWorld, atol=1e-4))
+      self.assertTrue(result.rms < 1e-4)
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorCalibrationModelNode(self):
+    """Spheres are detected on the model node as displayed, in RAS.
+    """
+    self.delayDisplay("Starting the calibration model node test")
+    import shutil, tempfile
+    from UltrasoundSimulatorLib import writeStl
+    from UltrasoundSimulatorLib.Benchmark import syntheticCalibrationModel
+    centers = numpy.array([[0.0, 0.0, 0.0], [60.0, 0.0, 0.0], [0.0, 40.0, 20.0]])
+    vertices, faces = syntheticCalibrationModel(centers, radius=5.0, resolution=16)
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'Calibration_model.stl')
+      writeStl(path, vertices, faces)
+      modelNode = slicer.util.loadModel(path)
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    # The STL file is in LPS, the loaded polydata in RAS
+    rasCenters = centers * [-1, -1, 1]
+    logic = UltrasoundSimulatorLogic()
+    detected = logic.calibrationSphereCenters(numpy.eye(4), modelNode)
+    self.assertTrue(numpy.allclose(detected, rasCenters[numpy.lexsort(rasCenters.T[::-1])], atol=1e-4))
+    modelToWorld = numpy.eye(4)
+    modelToWorld[:3, 3] = [10.0, -20.0, 35.0]
+    snapped = logic.snapToSphereCenter(rasCenters[1] + modelToWorld[:3, 3] + [0.0, 5.0, 0.0], modelToWorld,
+                                       model=modelNode)
+    self.assertTrue(numpy.allclose(snapped, rasCenters[1] + modelToWorld[:3, 3], atol=1e-4))
+    slicer.mrmlScene.RemoveNode(modelNode)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorFrameStore(self):
+    """Exported frames and poses are read back from the frame store, and exports resume.
+    """
+    self.delayDisplay("Starting the frame store test")
+    import shutil, tempfile
+    from UltrasoundSimulatorLib import FrameStore, FrameStoreWriter
+    volume, probeToWorld, parameters = self.randomPhantom(-200, 400, width=40.0, numberOfScanlines=32,
+                                                          samplesPerLine=80)
+    poses = numpy.tile(probeToWorld, (50, 1, 1))
+    poses[:, 2, 3] += numpy.linspace(-5, 5, 50)
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'frames')
+      logic = UltrasoundSimulatorLogic()
+      logic.startFrameExport(path, chunkSize=16, blocking=True)
+      frames = [logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), pose, **parameters).copy() for pose in poses[:40]]
+      statistics = logic.stopFrameExport()
+      self.assertEqual((statistics['frames'], statistics['shards'], statistics['droppedFrames']), (40, 3, 0))
+      # A crash while appending a shard leaves a partial index line
+      with open(os.path.join(path, 'index.jsonl'), 'a') as f:
+        f.write('{"file": "chunk-')
+      logic.startFrameExport(path, chunkSize=16, blocking=True)
+      frames += [logic.simulateFrame(volume, (1, 1, 1), (0, 0, 0), pose, **parameters).copy() for pose in poses[40:]]
+      self.assertEqual(logic.stopFrameExport()['resumedFrames'], 40)
+
+      store = FrameStore(path)
+      self.assertEqual(len(store), 50)
+      self.assertTrue(numpy.array_equal(store.poses(), poses))
+      for index in (0, 15, 16, 39, 40, -1):
+        frame, pose, timestamp = store[index]
+        self.assertTrue(numpy.array_equal(frame, frames[index]))
+        self.assertTrue(numpy.array_equal(pose, poses[index]))
+      self.assertRaises(IndexError, store.__getitem__, 50)
+      self.assertRaises(ValueError, FrameStoreWriter, path, (10, 10))
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorVolumeStore(self):
+    """MetaImage and NRRD volumes, raw or compressed, are mapped with their RAS geometry.
+    """
+    self.delayDisplay("Starting the volume store test")
+    import gzip, shutil, tempfile, zlib
+    from UltrasoundSimulatorLib import BModeRenderer, BrickedVolume, readVolumeHeader
+    volume, probeToWorld, parameters = self.randomPhantom()
+    data = volume.astype('<i2').tobytes()
+    directory = tempfile.mkdtemp()
+    try:
+      # Origin and axes are LPS in both formats
+      metaImageHeader = ('ObjectType = Image\nNDims = 3\nBinaryData = True\nBinaryDataByteOrderMSB = False\n'
+                         'CompressedData = %s\nTransformMatrix = 0 1 0 -1 0 0 0 0 1\nOffset = 10 20 30\n'
+                         'ElementSpacing = 0.5 1 2\nDimSize = 60 50 40\nElementType = MET_SHORT\n'
+                         'ElementDataFile = LOCAL\n')
+      nrrdHeader = ('NRRD0004\n# Complete NRRD file format specification at:\ntype: short\ndimension: 3\n'
+                    'space: left-posterior-superior\nsizes: 60 50 40\n'
+                    'space directions: (0,0.5,0) (-1,0,0) (0,0,2)\nendian: little\nencoding: %s\n'
+                    'space origin: (10,20,30)\n')
+      files = {
+        'raw.mha': (metaImageHeader % 'False').encode('latin-1') + data,
+        'compressed.mha': (metaImageHeader % 'True').encode('latin-1') + zlib.compress(data),
+        'raw.nrrd': (nrrdHeader % 'raw' + '\n').encode('latin-1') + data,
+        'compressed.nrrd': (nrrdHeader % 'gzip' + '\n').encode('latin-1') + gzip.compress(data),
+        'detached.nhdr': (nrrdHeader % 'raw' + 'data file: detached.raw\n\n').encode('latin-1'),
+        'detached.raw': data,
+        }
+      for name, contents in files.items():
+        with open(os.path.join(directory, name), 'wb') as f:
+          f.write(contents)
+      self.assertRaises(ValueError, readVolumeHeader, os.path.join(directory, 'detached.raw'))
+
+      logic = UltrasoundSimulatorLogic()
+      cacheDirectory = os.path.join(directory, 'cache')
+      reference = BModeRenderer(volume, (1, 1, 1), (0, 0, 0), **parameters).render(probeToWorld)
+      for name in ('raw.mha', 'compressed.mha', 'raw.nrrd', 'compressed.nrrd', 'detached.nhdr'):
+        store = logic.openVolumeStore(os.path.join(directory, name), cacheDirectory)
+        self.assertEqual(store.header.shape, (40, 50, 60))
+        self.assertTrue(numpy.allclose(store.spacing, (0.5, 1, 2)))
+        self.assertTrue(numpy.allclose(store.origin, (-10, -20, 30)))
+        self.assertTrue(numpy.allclose(store.directions, [[0, 1, 0], [-1, 0, 0], [0, 0, 1]]))
+        self.assertEqual(isinstance(store.array, BrickedVolume), name.startswith('compressed'))
+        self.assertTrue(numpy.array_equal(numpy.asarray(store.array), volume))
+        # Rendering from the store at the pose of the same voxels gives the frame of the voxel array
+        ijkToRas = numpy.eye(4)
+        ijkToRas[:3, :3] = store.directions * store.spacing
+        ijkToRas[:3, 3] = store.origin
+        renderer = BModeRenderer(store.array, store.spacing, store.origin, store.directions, **parameters)
+        self.assertTrue(numpy.array_equal(renderer.render(numpy.dot(ijkToRas, probeToWorld)), reference))
+
+      # Bricks straddling the volume border, gathers and slabs
+      store = logic.openVolumeStore(os.path.join(directory, 'compressed.nrrd'), cacheDirectory)
+      k, j, i = numpy.random.RandomState(1).randint(0, 40, 100), numpy.arange(100) % 50, numpy.arange(100) % 60
+      self.assertTrue(numpy.array_equal(store.array[k, j, i], volume[k, j, i]))
+      self.assertTrue(numpy.array_equal(store.array[30:35], volume[30:35]))
+      # The brick cache is converted once and reused
+      modifiedTime = os.path.getmtime(store.cachePath)
+      self.assertEqual(logic.openVolumeStore(os.path.join(directory, 'compressed.nrrd'), cacheDirectory).cachePath,
+                       store.cachePath)
+      self.assertEqual(os.path.getmtime(store.cachePath), modifiedTime)
+      self.assertEqual(len([name for name in os.listdir(cacheDirectory) if name.endswith('.npy')]), 2)
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+  def test_UltrasoundSimulatorPoseStream(self):
+    """Buffered poses are interpolated along the shortest rotation, and late samples are dropped.
+    """
+    self.delayDisplay("Starting the pose stream test")
+    import shutil, tempfile
+    from UltrasoundSimulatorLib import FileReplaySource, matrixFromQuaternion, quaternionFromMatrix, slerp
+    def rotationZ(degrees, translation=(0, 0, 0)):
+      angle = numpy.radians(degrees)
+      matrix = numpy.eye(4)
+      matrix[:3, :3] = [[numpy.cos(angle), -numpy.sin(angle), 0], [numpy.sin(angle), numpy.cos(angle), 0], [0, 0, 1]]
+      matrix[:3, 3] = translation
+      return matrix
+
+    # Quaternions round trip, also at 180 degrees where w vanishes, with w >= 0
+    rotations = numpy.array([rotationZ(degrees)[:3, :3] for degrees in (0, 30, 179, 180, 270)]
+                            + [numpy.diag([1.0, -1.0, -1.0]), numpy.diag([-1.0, 1.0, -1.0])])
+    quaternions = quaternionFromMatrix(rotations)
+    self.assertTrue(numpy.allclose(matrixFromQuaternion(quaternions), rotations))
+    self.assertTrue(numpy.all(quaternions[:, 0] >= 0))
+    # The midpoint of 0 and 90 degrees is 45 degrees, whichever sign q1 has
+    q0, q1 = quaternionFromMatrix(rotationZ(0)), quaternionFromMatrix(rotationZ(90))
+    self.assertTrue(numpy.allclose(slerp(q0, q1, 0.5), quaternionFromMatrix(rotationZ(45))))
+    self.assertTrue(numpy.allclose(slerp(q0, -q1, 0.5), quaternionFromMatrix(rotationZ(45))))
+    self.assertTrue(numpy.allclose(slerp(q0, q1, [0.0, 1.0]), [q0, q1]))
+
+    logic = UltrasoundSimulatorLogic()
+    stream = logic.createPoseStream(capacity=4, smoothingTimeConstant=0.0)
+    self.assertIsNone(stream.poseAt(0.0))
+    # 179 and 181 degrees have quaternions of opposite hemispheres, their midpoint is 180 degrees
+    stream.addSample(rotationZ(179), 0.0)
+    stream.addSample(rotationZ(181), 1.0)
+    self.assertTrue(numpy.allclose(stream.poseAt(0.5), rotationZ(180)))
+    # The ring buffer keeps the last 4 samples
+    for timestamp in range(2, 10):
+      stream.addSample(rotationZ(0, (timestamp, 0, 0)), float(timestamp))
+    self.assertTrue(stream.hasNewSamples())
+    self.assertTrue(numpy.allclose(stream.poseAt(8.25)[:3, 3], [8.25, 0, 0]))
+    self.assertFalse(stream.hasNewSamples())
+    self.assertTrue(numpy.allclose(stream.poseAt(1.0)[:3, 3], [6, 0, 0]))
+    self.assertTrue(numpy.allclose(stream.poseAt(20.0)[:3, 3], [9, 0, 0]))
+    # A sample overtaken by a newer one is dropped
+    self.assertFalse(stream.addSample(rotationZ(0, (100, 0, 0)), 8.5))
+    self.assertEqual(stream.numberOfLateSamples, 1)
+    self.assertTrue(numpy.allclose(stream.poseAt(8.75)[:3, 3], [8.75, 0, 0]))
+
+    # Smoothing moves a time constant after a step by 1 - 1/e of the step
+    stream = logic.createPoseStream(smoothingTimeConstant=0.1)
+    stream.addSample(rotationZ(0), 0.0)
+    stream.addSample(rotationZ(0, (10, 0, 0)), 0.1)
+    self.assertTrue(numpy.allclose(stream.poseAt(0.1)[:3, 3], [10 * (1 - numpy.exp(-1)), 0, 0]))
+
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'poses.npy')
+      samples = numpy.array([numpy.concatenate([[0.01 * index], rotationZ(10 * index, (index, 0, 0)).ravel()])
+                             for index in range(5)])
+      numpy.save(path, samples)
+      stream = logic.createPoseStream(smoothingTimeConstant=0.0)
+      source = FileReplaySource(stream, path, speed=10.0)
+      source.start()
+      source.join(10.0)
+      self.assertEqual(stream.numberOfSamples, 5)
+      self.assertTrue(numpy.allclose(stream.poseAt(), rotationZ(40, (4, 0, 0))))
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
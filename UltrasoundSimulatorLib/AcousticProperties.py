@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from . import BModeRendering
+
+# Bump when the way property volumes are computed changes, to invalidate caches
+CACHE_FORMAT_VERSION = 1
+
+HU_MINIMUM = -1024
+HU_MAXIMUM = 3071
+
+#
+# Lookup tables
+#
+
+def defaultMappingParameters():
+  """Parameters of the HU to acoustic property mapping. They are part of the
+  cache key, so changing any control point rebuilds the property volumes.
+  """
+  return {
+    'hu': BModeRendering.HU_CONTROL_POINTS.tolist(),
+    'density': BModeRendering.DENSITY_CONTROL_POINTS.tolist(),
+    'speedOfSound': BModeRendering.SPEED_OF_SOUND_CONTROL_POINTS.tolist(),
+    'attenuation': BModeRendering.ATTENUATION_CONTROL_POINTS.tolist(),
+    'scattererDensity': BModeRendering.SCATTERER_DENSITY_CONTROL_POINTS.tolist(),
+    }
+
+def buildLookupTables(mappingParameters=None):
+  """Returns impedance (float16, MRayl), attenuation (float16, dB/(cm MHz))
+  and scatterer density (uint8) tables indexed by HU - HU_MINIMUM.
+  """
+  parameters = mappingParameters or defaultMappingParameters()
+  hu = np.arange(HU_MINIMUM, HU_MAXIMUM + 1, dtype=np.float32)
+  density = np.interp(hu, parameters['hu'], parameters['density'])
+  speedOfSound = np.interp(hu, parameters['hu'], parameters['speedOfSound'])
+  impedance = (density * speedOfSound * 1e-3).astype(np.float16)
+  attenuation = np.interp(hu, parameters['hu'], parameters['attenuation']).astype(np.float16)
+  scattererDensity = np.round(np.interp(hu, parameters['hu'], parameters['scattererDensity'])).astype(np.uint8)
+  return impedance, attenuation, scattererDensity
+
+#
+# AcousticPropertyVolumes
+#
+
+class AcousticPropertyVolumes(object):
+  """Per-voxel impedance, attenuation and scatterer density of a CT volume,
+  indexed (k, j, i) like the CT. When loaded from a cache entry the volumes
+  are memory mapped and pickling only transfers the entry directory, so they
+  can be passed to worker processes cheaply.
+  """
+
+  NAMES = ('impedance', 'attenuation', 'scattererDensity')
+
+  def __init__(self, impedance, attenuation, scattererDensity, directory=None):
+    self.impedance = impedance
+    self.attenuation = attenuation
+    self.scattererDensity = scattererDensity
+    self.directory = directory
+
+  @classmethod
+  def load(cls, directory):
+    arrays = [np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in cls.NAMES]
+    return cls(*arrays, directory=directory)
+
+  def save(self, directory):
+    for name in self.NAMES:
+      np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+
+  @property
+  def nbytes(self):
+    return sum(getattr(self, name).nbytes for name in self.NAMES)
+
+  def __getstate__(self):
+    if self.directory:
+      return {'directory': self.directory}
+    return dict((name, np.asarray(getattr(self, name))) for name in self.NAMES)
+
+  def __setstate__(self, state):
+    if 'directory' in state:
+      state = self.load(state['directory']).__dict__
+    self.__dict__.update(state)
+    self.__dict__.setdefault('directory', None)
+
+def computeAcousticProperties(volume, mappingParameters=None, slabSize=16):
+  """Derives the property volumes of a (k, j, i) HU volume with vectorized
+  table lookups, slab by slab so memory mapped volumes are streamed.
+  """
+  impedanceTable, attenuationTable, scattererTable = buildLookupTables(mappingParameters)
+  shape = volume.shape
+  impedance = np.empty(shape, dtype=np.float16)
+  attenuation = np.empty(shape, dtype=np.float16)
+  scattererDensity = np.empty(shape, dtype=np.uint8)
+  for start in range(0, shape[0], slabSize):
+    hu = np.asarray(volume[start:start + slabSize])
+    if hu.dtype.kind == 'f':
+      hu = np.round(hu)
+    index = np.clip(hu, HU_MINIMUM, HU_MAXIMUM).astype(np.intp) - HU_MINIMUM
+    impedance[start:start + slabSize] = impedanceTable[index]
+    attenuation[start:start + slabSize] = attenuationTable[index]
+    scattererDensity[start:start + slabSize] = scattererTable[index]
+  return AcousticPropertyVolumes(impedance, attenuation, scattererDensity)
+
+#
+# AcousticPropertyCache
+#
+
+def hashFile(path, blockSize=1 << 20):
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(blockSize), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+def hashArray(array):
+  digest = hashlib.sha1()
+  digest.update(('%s %s' % (array.dtype.str, array.shape)).encode('utf-8'))
+  for start in range(0, array.shape[0], 16):
+    digest.update(np.ascontiguousarray(array[start:start + 16]).tobytes())
+  return digest.hexdigest()
+
+class AcousticPropertyCache(object):
+  """Persistent cache of acoustic property volumes. Entries are keyed by the
+  hash of the source data and the mapping parameters, stored as .npy files
+  that are memory mapped on load, and evicted least recently used first when
+  the cache grows beyond maxBytes.
+
+  File hashes are remembered by path, size and modification time, so a cache
+  hit does not need to read the source file again. Array hashes are
+  remembered in memory by a sourceKey (name, version) given with the array,
+  e.g. a volume node ID and the modification time of its image data.
+  """
+
+  def __init__(self, directory, maxBytes=4 * 1024 ** 3):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.fileHashesPath = os.path.join(directory, 'fileHashes.json')
+    # Array name: (version, hash) of the last version hashed
+    self.arrayHashes = {}
+
+  def sourceHash(self, source, sourceKey=None):
+    """Content hash of a file path or of a voxel array. The hash of an array
+    is reused while its sourceKey, a (name, version) pair whose version
+    changes whenever the array does, stays the same.
+    """
+    if not isinstance(source, str):
+      if sourceKey is None:
+        return hashArray(source)
+      name, version = sourceKey
+      if self.arrayHashes.get(name, (None, None))[0] != version:
+        self.arrayHashes[name] = (version, hashArray(source))
+      return self.arrayHashes[name][1]
+    stat = os.stat(source)
+    fileKey = '%s|%d|%d' % (os.path.abspath(source), stat.st_size, int(stat.st_mtime))
+    try:
+      with open(self.fileHashesPath) as f:
+        fileHashes = json.load(f)
+    except (IOError, ValueError):
+      fileHashes = {}
+    if fileKey not in fileHashes:
+      fileHashes[fileKey] = hashFile(source)
+      with open(self.fileHashesPath + '.partial', 'w') as f:
+        json.dump(fileHashes, f)
+      os.rename(self.fileHashesPath + '.partial', self.fileHashesPath)
+    return fileHashes[fileKey]
+
+  def entryKey(self, sourceHash, mappingParameters=None):
+    parameters = json.dumps([CACHE_FORMAT_VERSION, mappingParameters or defaultMappingParameters()], sort_keys=True)
+    return hashlib.sha1((sourceHash + parameters).encode('utf-8')).hexdigest()[:24]
+
+  def entries(self):
+    """(path, size in bytes, last access time) of all complete entries.
+    """
+    result = []
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      if not os.path.isdir(path) or name.endswith('.partial'):
+        continue
+      size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+      result.append((path, size, os.path.getmtime(path)))
+    return result
+
+  def evict(self, keep=None):
+    """Removes least recently used entries until the cache fits in maxBytes.
+    """
+    entries = sorted(self.entries(), key=lambda entry: entry[2])
+    totalBytes = sum(entry[1] for entry in entries)
+    for path, size, _ in entries:
+      if totalBytes <= self.maxBytes:
+        break
+      if path == keep:
+        continue
+      shutil.rmtree(path, ignore_errors=True)
+      totalBytes -= size
+
+  def get(self, source, volume=None, mappingParameters=None, sourceKey=None):
+    """Returns the property volumes of source (a file path or voxel array),
+    computing and storing them on a miss. volume is the voxel array of a file
+    source, only read on a miss. sourceKey identifies the version of an
+    array source (see sourceHash).
+    """
+    key = self.entryKey(self.sourceHash(source, sourceKey), mappingParameters)
+    path = os.path.join(self.directory, key)
+    if os.path.isdir(path):
+      os.utime(path, None)
+      return AcousticPropertyVolumes.load(path)
+    properties = computeAcousticProperties(source if volume is None else volume, mappingParameters)
+    partialPath = path + '.partial'
+    shutil.rmtree(partialPath, ignore_errors=True)
+    os.makedirs(partialPath)
+    properties.save(partialPath)
+    os.rename(partialPath, path)
+    self.evict(keep=path)
+    return AcousticPropertyVolumes.load(path)
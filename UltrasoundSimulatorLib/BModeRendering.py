@@ -0,0 +1,376 @@
+import numpy as np
+
+from .PostProcessing import PostProcessor
+from .ProbeGeometry import LinearProbe
+from .Profiler import Profiler
+
+#
+# Acoustic properties of tissue as a function of Hounsfield units
+#
+
+# Piecewise-linear control points: air, lung, fat, water, soft tissue,
+# trabecular bone, cortical bone and dense bone/metal.
+HU_CONTROL_POINTS = np.array([-1000.0, -500.0, -100.0, 0.0, 50.0, 300.0, 1000.0, 3000.0], dtype=np.float32)
+# Density in g/cm^3
+DENSITY_CONTROL_POINTS = np.array([0.0012, 0.5, 0.95, 1.0, 1.06, 1.2, 1.9, 2.5], dtype=np.float32)
+# Speed of sound in m/s
+SPEED_OF_SOUND_CONTROL_POINTS = np.array([343.0, 650.0, 1450.0, 1480.0, 1540.0, 1900.0, 3500.0, 4000.0], dtype=np.float32)
+# Attenuation in dB/(cm MHz)
+ATTENUATION_CONTROL_POINTS = np.array([10.0, 40.0, 0.6, 0.0022, 0.54, 3.0, 10.0, 20.0], dtype=np.float32)
+# Relative scatterer density, 0 (none) to 255
+SCATTERER_DENSITY_CONTROL_POINTS = np.array([0.0, 10.0, 90.0, 5.0, 200.0, 255.0, 150.0, 100.0], dtype=np.float32)
+
+def mapHounsfieldToImpedance(hu):
+  """Acoustic impedance in MRayl for an array of Hounsfield units.
+  """
+  impedance = np.interp(hu, HU_CONTROL_POINTS, DENSITY_CONTROL_POINTS)
+  impedance *= np.interp(hu, HU_CONTROL_POINTS, SPEED_OF_SOUND_CONTROL_POINTS)
+  impedance *= 1e-3
+  return impedance.astype(np.float32)
+
+def mapHounsfieldToAttenuation(hu):
+  """Attenuation coefficient in dB/(cm MHz) for an array of Hounsfield units.
+  """
+  return np.interp(hu, HU_CONTROL_POINTS, ATTENUATION_CONTROL_POINTS).astype(np.float32)
+
+def mapHounsfieldToScattererDensity(hu):
+  """Relative scatterer density (0-255) for an array of Hounsfield units.
+  """
+  return np.interp(hu, HU_CONTROL_POINTS, SCATTERER_DENSITY_CONTROL_POINTS).astype(np.float32)
+
+#
+# Geometry helpers
+#
+
+def rasToIjkMatrix(spacing, origin, directions=None):
+  """Returns the 4x4 matrix mapping world (RAS) coordinates to continuous
+  voxel indices (i, j, k) of a volume with the given geometry.
+  """
+  ijkToRas = np.eye(4)
+  if directions is None:
+    directions = np.eye(3)
+  ijkToRas[:3, :3] = np.asarray(directions, dtype=np.float64) * np.asarray(spacing, dtype=np.float64)
+  ijkToRas[:3, 3] = origin
+  return np.linalg.inv(ijkToRas)
+
+def transformPoints(matrix, points, out=None):
+  """Applies a 4x4 homogeneous matrix to an (..., 3) array of points, written
+  to out (float32, shaped like points) if given. Written out element-wise
+  rather than with np.dot so results do not depend on the BLAS library or
+  its threading, which keeps frames bit-identical between processes.
+  """
+  matrix = np.asarray(matrix, dtype=np.float32)
+  # Summed in place, in the order of the written out expression
+  transformed = np.multiply(points[..., 0, np.newaxis], matrix[:3, 0], out=out)
+  transformed += points[..., 1, np.newaxis] * matrix[:3, 1]
+  transformed += points[..., 2, np.newaxis] * matrix[:3, 2]
+  transformed += matrix[:3, 3]
+  return transformed
+
+#
+# Sampling
+#
+
+class TrilinearWeights(object):
+  """Corner indices and interpolation weights of an (..., 3) array of
+  continuous (i, j, k) indices in a volume of the given (k, j, i) shape.
+  Computing them once allows sampling several volumes of the same geometry
+  (e.g. acoustic property volumes) at the same points.
+  """
+
+  def __init__(self, shape, ijk):
+    ijk = np.asarray(ijk, dtype=np.float32)
+    self.dims = dims = np.array(shape[::-1], dtype=np.intp)
+    # Axis by axis, as reductions and broadcasts over the last axis of size 3
+    # are several times slower than operations on its strided columns
+    self.inside = inside = ijk[..., 0] >= 0
+    # Computed in place in float32, the first corner indices are whole numbers
+    base = np.floor(ijk)
+    for axis in range(3):
+      if axis:
+        inside &= ijk[..., axis] >= 0
+      inside &= ijk[..., axis] <= dims[axis] - 1
+      column = base[..., axis]
+      np.maximum(column, 0, out=column)
+      np.minimum(column, max(dims[axis] - 2, 0), out=column)
+    frac = ijk - base
+    np.clip(frac, 0.0, 1.0, out=frac)
+    self.fi, self.fj, self.fk = frac[..., 0], frac[..., 1], frac[..., 2]
+    # Flat index of the first corner in a C ordered (k, j, i) array, and the
+    # offsets of the other seven (zero along axes of a single voxel)
+    self.index = base[..., 2].astype(np.intp)
+    self.index *= dims[1]
+    self.index += base[..., 1].astype(np.intp)
+    self.index *= dims[0]
+    self.index += base[..., 0].astype(np.intp)
+    di, dj, dk = int(dims[0] > 1), dims[0] * int(dims[1] > 1), dims[0] * dims[1] * int(dims[2] > 1)
+    self.offsets = (0, di, dj, dj + di, dk, dk + di, dk + dj, dk + dj + di)
+
+  def corners(self, volume):
+    """Iterates over the values of volume at the 8 corners of every point,
+    ordered k0j0i0, k0j0i1, k0j1i0, ..., k1j1i1.
+    """
+    if isinstance(volume, np.ndarray) and volume.flags.c_contiguous:
+      flat = volume.reshape(-1)
+      return (np.take(flat, self.index + offset) if offset else np.take(flat, self.index)
+              for offset in self.offsets)
+    # Other volumes (e.g. BrickedVolume) are indexed along each axis
+    dims = self.dims
+    k0, ji = np.divmod(self.index, dims[0] * dims[1])
+    j0, i0 = np.divmod(ji, dims[0])
+    i1 = np.minimum(i0 + 1, dims[0] - 1)
+    j1 = np.minimum(j0 + 1, dims[1] - 1)
+    k1 = np.minimum(k0 + 1, dims[2] - 1)
+    return (volume[k, j, i] for k in (k0, k1) for j in (j0, j1) for i in (i0, i1))
+
+  def sample(self, volume, outsideValue=0.0):
+    """Interpolates volume at the points in one vectorized gather. Corners
+    are fetched as they are needed and combined in place, so few point
+    sized temporaries are alive at once.
+    """
+    corners = self.corners(volume)
+    fi, fj, fk = self.fi, self.fj, self.fk
+    # Along i for the 4 (j, k) edges, then along j and along k
+    edges = []
+    for _ in range(4):
+      edge = next(corners) * (1 - fi)
+      edge += next(corners) * fi
+      edges.append(edge)
+    c00, c10, c01, c11 = edges
+    c00 *= 1 - fj
+    c10 *= fj
+    c00 += c10
+    c01 *= 1 - fj
+    c11 *= fj
+    c01 += c11
+    c00 *= 1 - fk
+    c01 *= fk
+    c00 += c01
+    samples = c00.astype(np.float32, copy=False)
+    samples[~self.inside] = outsideValue
+    return samples
+
+def trilinearSample(volume, ijk, outsideValue=0.0):
+  """Trilinearly interpolates a (k, j, i) indexed volume at an (..., 3) array
+  of continuous (i, j, k) indices in one vectorized gather. Samples outside
+  the volume are set to outsideValue.
+  """
+  return TrilinearWeights(volume.shape, ijk).sample(volume, outsideValue)
+
+#
+# Scanline processing
+#
+
+def scanlineEcho(impedance, attenuation, sampleSpacing, frequency, scattering=None, shadowing=True):
+  """Echo amplitude along scanlines from (scanlines, samples) arrays of
+  impedance and attenuation, as prefix operations over depth for all
+  scanlines at once. Interfaces reflect according to the intensity
+  reflection coefficient and the echo is attenuated on its round trip.
+  Scattering amplitudes (e.g. complex speckle scatterers) are added to the
+  reflections before attenuation. With shadowing, the echo of a sample is
+  also scaled by the transmission (1 - reflection) of every shallower
+  interface, so strong reflectors such as bone or air shadow what lies
+  behind them.
+  """
+  reflection = np.zeros_like(impedance)
+  numerator = impedance[:, 1:] - impedance[:, :-1]
+  denominator = impedance[:, 1:] + impedance[:, :-1]
+  np.maximum(denominator, 1e-6, out=denominator)
+  numerator /= denominator
+  np.square(numerator, out=reflection[:, 1:])
+  del numerator, denominator
+  # Round trip loss in dB, sampleSpacing in mm, turned into the amplitude in place
+  amplitude = np.cumsum(attenuation, axis=1, dtype=np.result_type(attenuation, np.float32))
+  amplitude *= 2.0 * frequency * sampleSpacing * 0.1
+  np.negative(amplitude, out=amplitude)
+  amplitude /= 20.0
+  amplitude = np.power(10.0, amplitude, dtype=np.float32)
+  if shadowing:
+    # Transmission through the interfaces above each sample, excluding its own
+    transmission = np.ones_like(reflection)
+    np.cumprod(1.0 - reflection[:, :-1], axis=1, out=transmission[:, 1:])
+    amplitude *= transmission
+  if scattering is not None:
+    reflection = reflection + scattering
+  reflection *= amplitude
+  return reflection
+
+def scanlineEchoReference(impedance, attenuation, sampleSpacing, frequency, scattering=None, shadowing=True):
+  """Sample by sample implementation of scanlineEcho in double precision,
+  marching down every scanline. Only meant to check the vectorized version.
+  """
+  impedance = np.asarray(impedance, dtype=np.float64)
+  echo = np.zeros(impedance.shape, dtype=np.complex128 if np.iscomplexobj(scattering) else np.float64)
+  for line in range(impedance.shape[0]):
+    lossDb = 0.0
+    transmission = 1.0
+    for sample in range(impedance.shape[1]):
+      reflection = 0.0
+      if sample > 0:
+        previous, current = impedance[line, sample - 1], impedance[line, sample]
+        reflection = ((current - previous) / max(current + previous, 1e-6)) ** 2
+      lossDb += attenuation[line, sample] * 2.0 * frequency * sampleSpacing * 0.1
+      scattered = reflection if scattering is None else reflection + scattering[line, sample]
+      echo[line, sample] = scattered * transmission * 10.0 ** (-lossDb / 20.0)
+      if shadowing:
+        transmission *= 1.0 - reflection
+  return echo
+
+def logCompress(envelope, dynamicRange=60.0, gain=0.0, out=None):
+  """Log compresses an envelope (reference amplitude 1) into uint8 grey
+  values, written to out (uint8 or float32) if given.
+  """
+  db = 20.0 * np.log10(np.maximum(envelope, 1e-12)) + gain
+  scaled = (db + dynamicRange) * (255.0 / dynamicRange)
+  if out is None:
+    return np.clip(scaled, 0.0, 255.0).astype(np.uint8)
+  np.clip(scaled, 0.0, 255.0, out=scaled)
+  if out.dtype.kind in 'iu':
+    np.floor(scaled, out=scaled)
+  np.copyto(out, scaled, casting='unsafe')
+  return out
+
+#
+# BModeRenderer
+#
+
+class BModeRenderer(object):
+  """Renders B-mode frames from a CT volume without any GUI. All scanlines
+  are processed at once as (scanlines, samples) arrays.
+
+  The volume is indexed (k, j, i) as returned by slicer.util.arrayFromVolume,
+  the probe pose maps probe coordinates (x lateral, y depth, millimeters) to
+  world coordinates. The scanline geometry is probe (a ProbeGeometry), by
+  default a LinearProbe of the given width, depth, numberOfScanlines and
+  samplesPerLine. If acousticProperties (AcousticPropertyVolumes of the
+  same volume) are given, impedance and attenuation are sampled from them
+  instead of being mapped from HU on every frame. If speckle (a
+  SpeckleModel) is given, scatterers are added to the echoes, which are then
+  convolved with its point spread function. With shadowing, strong
+  reflectors shadow the tissue behind them (see scanlineEcho). Gain, tgc
+  (dB at equally spaced depths) and dynamic range are applied by
+  postProcessor, which keeps the envelope of the last frame, updated by
+  renders of some scanlines, so postProcess redisplays it when they change. Stages are timed by profiler,
+  a disabled Profiler unless one is assigned.
+  """
+
+  def __init__(self, volume, spacing, origin, directions=None,
+               width=60.0, depth=80.0, numberOfScanlines=128, samplesPerLine=256,
+               frequency=5.0, dynamicRange=60.0, gain=0.0, outsideValue=-1000.0,
+               acousticProperties=None, probe=None, speckle=None, shadowing=True, tgc=None):
+    self.volume = volume
+    self.rasToIjk = rasToIjkMatrix(spacing, origin, directions)
+    self.frequency = frequency
+    self.outsideValue = outsideValue
+    self.acousticProperties = acousticProperties
+    self.speckle = speckle
+    self.shadowing = shadowing
+    self.profiler = Profiler()
+    if probe is None:
+      probe = LinearProbe(width, depth, numberOfScanlines, samplesPerLine)
+    self.probe = probe
+    self.probePoints = probe.points
+    self.sampleSpacing = probe.sampleSpacing
+    self.postProcessor = PostProcessor(probe.samplesPerLine, dynamicRange, gain, tgc)
+
+  @property
+  def dynamicRange(self):
+    return self.postProcessor.dynamicRange
+
+  @dynamicRange.setter
+  def dynamicRange(self, dynamicRange):
+    self.postProcessor.setParameters(dynamicRange=dynamicRange)
+
+  @property
+  def gain(self):
+    return self.postProcessor.gain
+
+  @gain.setter
+  def gain(self, gain):
+    self.postProcessor.setParameters(gain=gain)
+
+  @property
+  def frameShape(self):
+    """(samples, scanlines) shape of the rendered frames.
+    """
+    return self.probePoints.shape[1::-1]
+
+  def sampleWeights(self, probeToWorld, scanlines=None):
+    """Trilinear weights of the probe plane samples for a probe pose, of all
+    scanlines or of the given scanline indices.
+    """
+    probeToIjk = np.dot(self.rasToIjk, probeToWorld)
+    points = self.probePoints if scanlines is None else self.probePoints[scanlines]
+    return TrilinearWeights(self.volume.shape, transformPoints(probeToIjk, points))
+
+  def reslice(self, probeToWorld, scanlines=None):
+    """Samples the volume on the probe plane, returns (scanlines, samples) HU.
+    """
+    return self.sampleWeights(probeToWorld, scanlines).sample(self.volume, self.outsideValue)
+
+  def sampleAcousticProperties(self, probeToWorld, scanlines=None, scattererDensity=False):
+    """Impedance and attenuation, and the scatterer density if requested, on
+    the probe plane as (scanlines, samples) arrays.
+    """
+    return self.sampleProperties(self.sampleWeights(probeToWorld, scanlines), scattererDensity)
+
+  def sampleProperties(self, weights, scattererDensity=False):
+    """Impedance and attenuation, and the scatterer density if requested, at
+    the points of TrilinearWeights in the volume.
+    """
+    if self.acousticProperties is None:
+      hu = weights.sample(self.volume, self.outsideValue)
+      properties = (mapHounsfieldToImpedance(hu), mapHounsfieldToAttenuation(hu))
+      if scattererDensity:
+        properties += (mapHounsfieldToScattererDensity(hu),)
+      return properties
+    outside = np.float32(self.outsideValue)
+    properties = (weights.sample(self.acousticProperties.impedance, mapHounsfieldToImpedance(outside)),
+                  weights.sample(self.acousticProperties.attenuation, mapHounsfieldToAttenuation(outside)))
+    if scattererDensity:
+      properties += (weights.sample(self.acousticProperties.scattererDensity, mapHounsfieldToScattererDensity(outside)),)
+    return properties
+
+  def envelope(self, probeToWorld, scanlines=None):
+    """Echo amplitude along all (or the given) scanlines before log compression.
+    """
+    with self.profiler.stage('reslice'):
+      properties = self.sampleAcousticProperties(probeToWorld, scanlines, self.speckle is not None)
+    return self.propertiesEnvelope(probeToWorld, properties, scanlines)
+
+  def propertiesEnvelope(self, probeToWorld, properties, scanlines=None):
+    """Echo amplitude from acoustic properties sampled on the probe plane (as
+    returned by sampleAcousticProperties, with the scatterer density if
+    speckle is used).
+    """
+    if self.speckle is None:
+      impedance, attenuation = properties
+      with self.profiler.stage('echo'):
+        return scanlineEcho(impedance, attenuation, self.sampleSpacing, self.frequency, shadowing=self.shadowing)
+    impedance, attenuation, scattererDensity = properties
+    with self.profiler.stage('speckle'):
+      points = self.probePoints if scanlines is None else self.probePoints[scanlines]
+      scattering = self.speckle.scatterers(transformPoints(probeToWorld, points), scattererDensity)
+    with self.profiler.stage('echo'):
+      echo = scanlineEcho(impedance, attenuation, self.sampleSpacing, self.frequency, scattering, self.shadowing)
+    with self.profiler.stage('speckle'):
+      return self.speckle.envelope(echo, self.sampleSpacing, self.probe.scanlineSpacing)
+
+  def render(self, probeToWorld, scanlines=None, out=None):
+    """Returns a uint8 B-mode frame shaped (samples, scanlines), depth along
+    rows, or writes it to out (e.g. the frame of a FrameDisplaySink). Without
+    speckle scanlines are independent, so rendering a subset of scanline
+    indices gives the matching columns of the full frame.
+    """
+    envelope = self.envelope(probeToWorld, scanlines)
+    with self.profiler.stage('logCompress'):
+      frame = self.postProcessor.compress(envelope, None if out is None else out.T, scanlines=scanlines)
+      return frame.T
+
+  def postProcess(self, out=None):
+    """The last frame rendered, with the scanlines rendered since replaced,
+    with the current gain, TGC and dynamic range, without simulating it
+    again. None if no full frame was rendered.
+    """
+    frame = self.postProcessor.recompress(None if out is None else out.T)
+    return None if frame is None else frame.T
@@ -0,0 +1,170 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from .AcousticProperties import AcousticPropertyVolumes
+from .BModeRendering import BModeRenderer
+
+#
+# Shared volume and output stacks
+#
+
+def sharedTemporaryDirectory():
+  """Creates a temporary directory, in RAM (/dev/shm) when available, for
+  arrays that are memory mapped by several processes.
+  """
+  parent = '/dev/shm' if os.path.isdir('/dev/shm') else None
+  return tempfile.mkdtemp(prefix='UltrasoundSimulator-', dir=parent)
+
+def memmapDescriptor(array):
+  """Returns (filename, dtype, shape, offset) of a C-contiguous np.memmap,
+  or None if the array cannot be reopened from a file.
+  """
+  filename = getattr(array, 'filename', None)
+  if not isinstance(array, np.memmap) or not filename or not array.flags.c_contiguous:
+    return None
+  return (filename, array.dtype.str, array.shape, array.offset)
+
+def openMemmap(descriptor, mode='r'):
+  filename, dtype, shape, offset = descriptor
+  return np.memmap(filename, dtype=np.dtype(dtype), mode=mode, shape=tuple(shape), offset=offset)
+
+def shareVolume(volume, directory):
+  """Returns a memmap descriptor of volume, writing it once to directory if it
+  is not memory mapped already. Workers open the descriptor read-only, so the
+  volume is never pickled.
+  """
+  descriptor = memmapDescriptor(volume)
+  if descriptor is None:
+    path = os.path.join(directory, 'volume.npy')
+    np.save(path, np.ascontiguousarray(volume))
+    descriptor = memmapDescriptor(np.load(path, mmap_mode='r'))
+  return descriptor
+
+def shareParameters(parameters, directory):
+  """Returns renderer parameters that are cheap to pickle: acoustic property
+  volumes and the speckle texture held in memory are written once to
+  directory and memory mapped, so workers receive their paths instead of
+  copies of the arrays.
+  """
+  shared = dict(parameters)
+  acousticProperties = shared.get('acousticProperties')
+  if acousticProperties is not None and not acousticProperties.directory:
+    path = os.path.join(directory, 'acousticProperties')
+    os.mkdir(path)
+    acousticProperties.save(path)
+    shared['acousticProperties'] = AcousticPropertyVolumes.load(path)
+  speckle = shared.get('speckle')
+  if speckle is not None:
+    shared['speckle'] = speckle.shared(os.path.join(directory, 'speckleTexture.npy'))
+  return shared
+
+#
+# Workers
+#
+
+def processPoolContext(startMethod=None, pythonExecutable=None):
+  """Multiprocessing context of the worker pools. Forking a process that runs
+  other threads (in Slicer the render worker, frame store writer or pose
+  sources) can deadlock the children, so by default workers are forked by a
+  fork server, a single threaded process that preloaded this module, or
+  spawned where there is none (Windows). pythonExecutable starts the fork
+  server or spawned workers, for applications whose sys.executable is not a
+  Python interpreter. As with spawn, workers import the main script of the
+  application, which must guard its code with if __name__ == '__main__'.
+  """
+  if startMethod is None:
+    startMethod = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+  context = multiprocessing.get_context(startMethod)
+  if pythonExecutable:
+    context.set_executable(pythonExecutable)
+  if startMethod == 'forkserver':
+    # Rather than the default __main__, which may be an application script
+    context.set_forkserver_preload([__name__])
+  return context
+
+_workerRenderer = None
+_workerOutput = None
+
+def _initializeWorker(volumeDescriptor, spacing, origin, directions, parameters, outputDescriptor):
+  global _workerRenderer, _workerOutput
+  volume = openMemmap(volumeDescriptor, 'r')
+  _workerRenderer = BModeRenderer(volume, spacing, origin, directions, **parameters)
+  _workerOutput = openMemmap(outputDescriptor, 'r+')
+
+def _renderChunk(chunk):
+  start, poses = chunk
+  for index, pose in enumerate(poses):
+    _workerOutput[start + index] = _workerRenderer.render(pose)
+  _workerOutput.flush()
+  return len(poses)
+
+#
+# Sequence simulation
+#
+
+def simulateSequence(volume, spacing, origin, poses, directions=None, outputPath=None,
+                     numberOfWorkers=None, chunkSize=None, startMethod=None, pythonExecutable=None,
+                     **parameters):
+  """Renders a B-mode frame for each 4x4 pose in poses (N, 4, 4).
+
+  Poses are split into chunks that are rendered by a pool of numberOfWorkers
+  processes (all cores by default, 1 renders in this process). Every worker
+  memory maps the same read-only copy of the volume, and of the acoustic
+  property volumes and speckle texture if given, and writes its frames
+  straight into a shared (N, samples, scanlines) uint8 stack, so results are
+  bit-identical to the single process path. Workers are started as
+  processPoolContext(startMethod, pythonExecutable) does.
+
+  If outputPath is given the stack is stored there as a .npy file and returned
+  as a memmap, otherwise an in-memory array is returned.
+  """
+  poses = np.asarray(poses, dtype=np.float64).reshape(-1, 4, 4)
+  numberOfPoses = len(poses)
+  if numberOfWorkers is None:
+    numberOfWorkers = multiprocessing.cpu_count()
+  numberOfWorkers = max(1, min(numberOfWorkers, numberOfPoses))
+
+  renderer = BModeRenderer(volume, spacing, origin, directions, **parameters)
+  frameShape = renderer.probePoints.shape[1::-1]
+
+  temporaryDirectory = sharedTemporaryDirectory()
+  try:
+    path = outputPath or os.path.join(temporaryDirectory, 'frames.npy')
+    output = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(numberOfPoses,) + frameShape)
+    startTime = time.time()
+
+    if numberOfWorkers == 1:
+      for index, pose in enumerate(poses):
+        output[index] = renderer.render(pose)
+    else:
+      if chunkSize is None:
+        chunkSize = max(1, int(np.ceil(numberOfPoses / float(4 * numberOfWorkers))))
+      chunks = [(start, poses[start:start + chunkSize]) for start in range(0, numberOfPoses, chunkSize)]
+      context = processPoolContext(startMethod, pythonExecutable)
+      initArgs = (shareVolume(volume, temporaryDirectory), spacing, origin, directions,
+                  shareParameters(parameters, temporaryDirectory), memmapDescriptor(output))
+      pool = context.Pool(numberOfWorkers, _initializeWorker, initArgs)
+      try:
+        for _ in pool.imap_unordered(_renderChunk, chunks):
+          pass
+      finally:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - startTime
+    logging.info('simulateSequence: %d frames in %.2f s (%.1f frames/s, %d workers)'
+                 % (numberOfPoses, elapsed, numberOfPoses / max(elapsed, 1e-9), numberOfWorkers))
+    output.flush()
+    if outputPath:
+      return output
+    frames = np.array(output)
+    del output
+    return frames
+  finally:
+    shutil.rmtree(temporaryDirectory, ignore_errors=True)
@@ -0,0 +1,690 @@
+import copy
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from .BModeRendering import BModeRenderer, mapHounsfieldToAttenuation, mapHounsfieldToImpedance
+from .VolumeStore import VolumeStore
+
+#
+# Measurement helpers
+#
+
+def currentRss():
+  """Resident set size of this process in bytes (Linux), or the peak RSS
+  where /proc is not available.
+  """
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (IOError, OSError):
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def centeredProbePose(shape, spacing, origin, directions=None, depth=80.0):
+  """Probe pose whose imaging plane goes through the center of the volume.
+  """
+  if directions is None:
+    directions = np.eye(3)
+  center = np.dot(np.asarray(directions) * np.asarray(spacing), (np.array(shape[::-1]) - 1) / 2.0) + origin
+  pose = np.eye(4)
+  pose[:3, :3] = directions
+  pose[:3, 3] = center - pose[:3, 1] * depth / 2.0
+  return pose
+
+def _runInSubprocess(function, args):
+  """Runs function(*args) in a fresh process and returns its result, so
+  memory measurements are not affected by earlier runs.
+  """
+  context = multiprocessing.get_context()
+  pool = context.Pool(1)
+  try:
+    return pool.apply(function, args)
+  finally:
+    pool.close()
+    pool.join()
+
+#
+# Volume loading
+#
+
+def _measureVolumeLoad(path, cacheDirectory, memoryMapped):
+  rss = currentRss()
+  startTime = time.time()
+  store = VolumeStore(path, cacheDirectory)
+  volume = store.array if memoryMapped else np.array(store.array)
+  loadSeconds = time.time() - startTime
+  renderer = BModeRenderer(volume, store.spacing, store.origin, store.directions)
+  renderer.render(centeredProbePose(volume.shape, store.spacing, store.origin, store.directions))
+  return {
+    'loadSeconds': loadSeconds,
+    'firstFrameSeconds': time.time() - startTime,
+    'rssBytes': currentRss() - rss,
+    }
+
+def benchmarkVolumeLoad(path, cacheDirectory=None):
+  """Compares reading the whole volume into memory, like
+  slicer.util.loadVolume does, with the memory mapped VolumeStore. Returns
+  load time, time to first frame and RSS growth for both. Each variant runs in
+  its own process; the brick cache of compressed files is built beforehand.
+  """
+  VolumeStore(path, cacheDirectory)
+  return {
+    'fullRead': _runInSubprocess(_measureVolumeLoad, (path, cacheDirectory, False)),
+    'memoryMapped': _runInSubprocess(_measureVolumeLoad, (path, cacheDirectory, True)),
+    }
+
+#
+# Acoustic properties
+#
+
+def benchmarkAcousticProperties(volume, cacheDirectory):
+  """Time to derive the acoustic property volumes from scratch and to load
+  them from the cache.
+  """
+  from .AcousticProperties import AcousticPropertyCache, computeAcousticProperties
+  startTime = time.time()
+  computeAcousticProperties(volume)
+  rebuildSeconds = time.time() - startTime
+  cache = AcousticPropertyCache(cacheDirectory)
+  cache.get(volume)
+  startTime = time.time()
+  cache.get(volume)
+  return {'rebuildSeconds': rebuildSeconds, 'cachedLoadSeconds': time.time() - startTime}
+
+#
+# Probe geometries
+#
+
+def defaultProbeConfigurations():
+  from .ProbeGeometry import ConvexProbe, LinearProbe
+  return [
+    LinearProbe(width=40.0, depth=50.0, numberOfScanlines=64, samplesPerLine=128),
+    LinearProbe(width=60.0, depth=80.0, numberOfScanlines=128, samplesPerLine=256),
+    LinearProbe(width=60.0, depth=80.0, numberOfScanlines=256, samplesPerLine=512),
+    ConvexProbe(radius=40.0, angle=60.0, depth=120.0, numberOfScanlines=128, samplesPerLine=256),
+    ConvexProbe(radius=60.0, angle=75.0, depth=160.0, numberOfScanlines=256, samplesPerLine=512),
+    # Resampling the whole 180 x 180 mm slice view, as the probe mask layer did
+    LinearProbe(width=180.0, depth=180.0, numberOfScanlines=512, samplesPerLine=512),
+    ]
+
+def benchmarkProbeGeometries(volume, spacing, origin, directions=None, probes=None, numberOfFrames=20):
+  """Mean time per frame for a set of probe geometries (linear and convex
+  configurations by default). Returns a list of (probe, samples per frame,
+  seconds per frame).
+  """
+  results = []
+  for probe in probes or defaultProbeConfigurations():
+    renderer = BModeRenderer(volume, spacing, origin, directions, probe=probe)
+    pose = centeredProbePose(volume.shape, spacing, origin, directions, probe.depth)
+    renderer.render(pose)
+    startTime = time.time()
+    for _ in range(numberOfFrames):
+      renderer.render(pose)
+    results.append((probe, probe.numberOfSamples, (time.time() - startTime) / numberOfFrames))
+  return results
+
+#
+# Scan conversion
+#
+
+def benchmarkScanConversion(probes=None, outputShape=(512, 512), numberOfFrames=20, seed=0):
+  """Time per frame of scan conversion with a precomputed ScanConverter and
+  with the interpolation rebuilt for every frame, for a set of probe
+  geometries. Returns a list of (probe, precomputed seconds, rebuilt
+  seconds, operator bytes).
+  """
+  from .ScanConversion import ScanConverter
+  random = np.random.RandomState(seed)
+  results = []
+  for probe in probes or defaultProbeConfigurations():
+    frame = random.randint(0, 256, (probe.samplesPerLine, probe.numberOfScanlines)).astype(np.uint8)
+    converter = ScanConverter(probe, outputShape)
+    out = converter.apply(frame)
+    seconds = []
+    for convert in (lambda: converter.apply(frame, out), lambda: ScanConverter(probe, outputShape).apply(frame, out)):
+      startTime = time.perf_counter()
+      for _ in range(numberOfFrames):
+        convert()
+      seconds.append((time.perf_counter() - startTime) / numberOfFrames)
+    results.append((probe, seconds[0], seconds[1], converter.nbytes))
+  return results
+
+#
+# Multiple probes
+#
+
+def benchmarkMultiProbe(volume, spacing, origin, directions=None, probe=None, probeCounts=(1, 2, 4, 8),
+                        numberOfFrames=10):
+  """Time per update for 1, 2, 4, ... copies of a probe rendered by a
+  MultiProbeRenderer, to see how many probes a machine keeps interactive,
+  and by one BModeRenderer per probe. Returns a list of (number of probes,
+  seconds, seconds with separate renderers).
+  """
+  from .MultiProbeRendering import MultiProbeRenderer
+  from .ProbeGeometry import LinearProbe
+  probe = probe or LinearProbe(width=40.0, depth=50.0, numberOfScanlines=64, samplesPerLine=128)
+  pose = centeredProbePose(volume.shape, spacing, origin, directions, probe.depth)
+  results = []
+  for count in probeCounts:
+    # Poses fanned around the center so the probes see different samples
+    poses = np.repeat(pose[np.newaxis], count, axis=0)
+    poses[:, :3, 3] += np.outer(np.linspace(-5.0, 5.0, count), pose[:3, 2])
+    renderer = MultiProbeRenderer(volume, spacing, origin, [probe] * count, directions)
+    renderer.render(poses)
+    startTime = time.perf_counter()
+    for _ in range(numberOfFrames):
+      renderer.render(poses)
+    seconds = (time.perf_counter() - startTime) / numberOfFrames
+    startTime = time.perf_counter()
+    for _ in range(numberOfFrames):
+      for probeRenderer, probeToWorld in zip(renderer.renderers, poses):
+        probeRenderer.render(probeToWorld)
+    results.append((count, seconds, (time.perf_counter() - startTime) / numberOfFrames))
+  return results
+
+#
+# Imaging modes
+#
+
+def benchmarkMMode(volume, spacing, origin, directions=None, probe=None, numberOfUpdates=100):
+  """Time per M-mode update (one scanline) compared with a full B-mode frame
+  of the same probe, with the probe moving on every update. Returns
+  (M-mode seconds, B-mode seconds).
+  """
+  from .ImagingModes import MModeRenderer
+  renderer = BModeRenderer(volume, spacing, origin, directions, probe=probe)
+  mMode = MModeRenderer(renderer)
+  pose = centeredProbePose(volume.shape, spacing, origin, directions, renderer.probe.depth)
+  poses = np.repeat(pose[np.newaxis], numberOfUpdates, axis=0)
+  poses[:, :3, 3] += np.outer(np.linspace(-2.0, 2.0, numberOfUpdates), pose[:3, 0])
+  seconds = []
+  for render in (mMode.render, renderer.render):
+    render(pose)
+    startTime = time.perf_counter()
+    for probeToWorld in poses:
+      render(probeToWorld)
+    seconds.append((time.perf_counter() - startTime) / numberOfUpdates)
+  return tuple(seconds)
+
+def benchmarkDoppler(volume, spacing, origin, directions=None, probe=None, roiFractions=(0.25, 0.5, 1.0),
+                     ensembleSize=8, numberOfUpdates=20, seed=0):
+  """Time per color Doppler update (velocity estimates only, and with the
+  B-mode frame and overlay) for centered ROIs covering the given fractions
+  of the scanlines and samples, with a synthetic vessel crossing the frame.
+  Returns a list of (fraction, estimate seconds, frame seconds).
+  """
+  from .ImagingModes import DopplerRenderer
+  renderer = BModeRenderer(volume, spacing, origin, directions, probe=probe)
+  pose = centeredProbePose(volume.shape, spacing, origin, directions, renderer.probe.depth)
+  labels = np.zeros(volume.shape, dtype=np.uint8)
+  j = np.arange(volume.shape[1])
+  labels[:, np.abs(j - volume.shape[1] // 2) <= max(volume.shape[1] // 16, 1), :] = 1
+  numberOfScanlines, samplesPerLine = renderer.probe.numberOfScanlines, renderer.probe.samplesPerLine
+  results = []
+  for fraction in roiFractions:
+    scanlineMargin = int(numberOfScanlines * (1 - fraction) / 2)
+    sampleMargin = int(samplesPerLine * (1 - fraction) / 2)
+    roi = (scanlineMargin, numberOfScanlines - scanlineMargin, sampleMargin, samplesPerLine - sampleMargin)
+    doppler = DopplerRenderer(renderer, labels, {1: (100.0, 100.0, 0.0)}, roi, ensembleSize=ensembleSize, seed=seed)
+    seconds = []
+    for render in (doppler.velocities, doppler.render):
+      render(pose)
+      startTime = time.perf_counter()
+      for _ in range(numberOfUpdates):
+        render(pose)
+      seconds.append((time.perf_counter() - startTime) / numberOfUpdates)
+    results.append((fraction, seconds[0], seconds[1]))
+  return results
+
+#
+# Speckle
+#
+
+def benchmarkSpeckle(sizes=(256, 512, 1024), numberOfFrames=5, seed=0):
+  """Time per frame with and without speckle for square frames of the given
+  numbers of scanlines and samples, on a synthetic soft tissue volume.
+  Returns a list of (size, seconds without speckle, seconds with speckle).
+  """
+  from .ProbeGeometry import LinearProbe
+  from .Speckle import SpeckleModel
+  volume = np.random.RandomState(seed).normal(40, 20, (96, 128, 128)).astype(np.int16)
+  spacing, origin = (0.5, 0.5, 0.5), (0.0, 0.0, 0.0)
+  speckle = SpeckleModel(seed=seed)
+  results = []
+  for size in sizes:
+    probe = LinearProbe(width=50.0, depth=50.0, numberOfScanlines=size, samplesPerLine=size)
+    pose = centeredProbePose(volume.shape, spacing, origin, depth=probe.depth)
+    seconds = []
+    for model in (None, speckle):
+      renderer = BModeRenderer(volume, spacing, origin, probe=probe, speckle=model)
+      renderer.render(pose)
+      startTime = time.time()
+      for _ in range(numberOfFrames):
+        renderer.render(pose)
+      seconds.append((time.time() - startTime) / numberOfFrames)
+    results.append((size, seconds[0], seconds[1]))
+  return results
+
+#
+# Scanline echo
+#
+
+def benchmarkScanlineEcho(shapes=((128, 256), (256, 512), (512, 1024)), numberOfFrames=20,
+                          referenceShape=(32, 128), seed=0):
+  """Throughput of the vectorized scanlineEcho with shadowing for (scanlines,
+  samples) frames of the given shapes, compared with the sample by sample
+  scanlineEchoReference on a frame of referenceShape. Returns a list of
+  (shape, seconds per frame, samples per second), the reference last.
+  """
+  from .BModeRendering import scanlineEcho, scanlineEchoReference
+  random = np.random.RandomState(seed)
+  results = []
+  for shape in tuple(shapes) + (referenceShape,):
+    hu = random.normal(40, 20, shape)
+    hu[:, shape[1] // 2:] = 1000
+    impedance, attenuation = mapHounsfieldToImpedance(hu), mapHounsfieldToAttenuation(hu)
+    if shape is referenceShape:
+      echo, frames = scanlineEchoReference, 1
+    else:
+      echo, frames = scanlineEcho, numberOfFrames
+    echo(impedance, attenuation, 0.3, 5.0)
+    startTime = time.perf_counter()
+    for _ in range(frames):
+      echo(impedance, attenuation, 0.3, 5.0)
+    seconds = (time.perf_counter() - startTime) / frames
+    results.append((shape, seconds, shape[0] * shape[1] / seconds))
+  return results
+
+#
+# Calibration spheres
+#
+
+def sphereMesh(center, radius, resolution=32):
+  """Closed triangle mesh of a sphere: resolution rings of 2 * resolution
+  vertices and the two poles. Returns (vertices, faces).
+  """
+  polar = np.linspace(0.0, np.pi, resolution + 2)[1:-1]
+  azimuth = np.linspace(0.0, 2.0 * np.pi, 2 * resolution, endpoint=False)
+  ring = np.stack([np.outer(np.sin(polar), np.cos(azimuth)), np.outer(np.sin(polar), np.sin(azimuth)),
+                   np.repeat(np.cos(polar)[:, np.newaxis], len(azimuth), axis=1)], axis=-1).reshape(-1, 3)
+  vertices = np.concatenate([ring, [[0.0, 0.0, 1.0], [0.0, 0.0, -1.0]]]) * radius + np.asarray(center, dtype=np.float64)
+  grid = np.arange(len(ring)).reshape(resolution, len(azimuth))
+  following = np.roll(grid, -1, axis=1)
+  faces = [np.stack([grid[:-1], grid[1:], following[1:]], axis=-1).reshape(-1, 3),
+           np.stack([grid[:-1], following[1:], following[:-1]], axis=-1).reshape(-1, 3),
+           np.stack([np.full(len(azimuth), len(ring)), grid[0], following[0]], axis=-1),
+           np.stack([np.full(len(azimuth), len(ring) + 1), following[-1], grid[-1]], axis=-1)]
+  return vertices, np.concatenate(faces)
+
+def syntheticCalibrationModel(centers=((0.0, 0.0, 0.0), (60.0, 0.0, 0.0), (0.0, 40.0, 20.0)), radius=5.0,
+                              resolution=32):
+  """Triangle mesh of calibration spheres at centers (mm) above a flat base
+  plate. Returns (vertices, faces).
+  """
+  meshes = [sphereMesh(center, radius, resolution) for center in centers]
+  centers = np.asarray(centers, dtype=np.float64)
+  low, high = centers.min(axis=0) - 2 * radius, centers.max(axis=0) + 2 * radius
+  # Plate of two triangles per side, below the spheres
+  x, y, z = np.meshgrid([low[0], high[0]], [low[1], high[1]], [low[2] - 3 * radius, low[2] - 2 * radius], indexing='ij')
+  box = np.stack([x.ravel(), y.ravel(), z.ravel()], axis=-1)
+  boxFaces = np.array([[0, 1, 3], [0, 3, 2], [4, 6, 7], [4, 7, 5], [0, 4, 5], [0, 5, 1],
+                       [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 5, 7], [1, 7, 3]])
+  meshes.append((box, boxFaces))
+  vertices, faces, offset = [], [], 0
+  for meshVertices, meshFaces in meshes:
+    vertices.append(meshVertices)
+    faces.append(meshFaces + offset)
+    offset += len(meshVertices)
+  return np.concatenate(vertices), np.concatenate(faces)
+
+def benchmarkSphereDetection(path=None, numberOfClicks=20, seed=0):
+  """Time to read and index the calibration model STL at path (a synthetic
+  one with three spheres by default) and detect all of its spheres, and
+  time per sphere fitted near a click. Returns (number of vertices, load
+  seconds, detection seconds, seconds per click).
+  """
+  from .SphereDetection import SphereDetector, readStl, writeStl
+  temporaryDirectory = None
+  if path is None:
+    temporaryDirectory = tempfile.mkdtemp()
+    path = os.path.join(temporaryDirectory, 'Calibration_model.stl')
+    writeStl(path, *syntheticCalibrationModel(resolution=64))
+  try:
+    startTime = time.perf_counter()
+    vertices, faces = readStl(path)
+    detector = SphereDetector(vertices, faces)
+    loadSeconds = time.perf_counter() - startTime
+    startTime = time.perf_counter()
+    spheres = detector.detectSpheres()
+    detectionSeconds = time.perf_counter() - startTime
+    random = np.random.RandomState(seed)
+    clicks = spheres.center[random.randint(0, max(len(spheres.center), 1), numberOfClicks)]
+    clicks += random.uniform(-0.5, 0.5, clicks.shape) * spheres.radius.min() if len(spheres.center) else 0.0
+    startTime = time.perf_counter()
+    for click in clicks:
+      detector.fitNear(click)
+    clickSeconds = (time.perf_counter() - startTime) / max(len(clicks), 1)
+  finally:
+    if temporaryDirectory:
+      shutil.rmtree(temporaryDirectory, ignore_errors=True)
+  return len(vertices), loadSeconds, detectionSeconds, clickSeconds
+
+#
+# Frame export
+#
+
+def benchmarkFrameStore(numberOfFrames=2048, chunkSize=256, compress=True, numberOfRenderedFrames=32, seed=0):
+  """Throughput of a FrameStoreWriter fed as fast as possible (blocking
+  when its queue is full) with B-mode frames of a synthetic phantom along a
+  sweep, cycled. Returns the writer statistics plus the mean and maximum
+  time spent in write, in seconds.
+  """
+  from .FrameStore import FrameStoreWriter
+  volume = syntheticPhantom(seed=seed)
+  spacing = (0.5, 0.5, 0.5)
+  renderer = BModeRenderer(volume, spacing, (0.0, 0.0, 0.0))
+  pose = centeredProbePose(volume.shape, spacing, (0.0, 0.0, 0.0), depth=renderer.probe.depth)
+  poses = np.repeat(pose[np.newaxis], numberOfRenderedFrames, axis=0)
+  poses[:, 2, 3] += np.linspace(-10.0, 10.0, numberOfRenderedFrames)
+  frames = [renderer.render(probeToWorld) for probeToWorld in poses]
+  directory = tempfile.mkdtemp()
+  try:
+    writer = FrameStoreWriter(os.path.join(directory, 'frames'), frames[0].shape, chunkSize=chunkSize,
+                              compress=compress, blocking=True)
+    writeSeconds = []
+    for index in range(numberOfFrames):
+      startTime = time.perf_counter()
+      writer.write(frames[index % numberOfRenderedFrames], poses[index % numberOfRenderedFrames], index)
+      writeSeconds.append(time.perf_counter() - startTime)
+    writer.close()
+    statistics = writer.statistics()
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+  statistics.update({'meanWriteSeconds': float(np.mean(writeSeconds)), 'maxWriteSeconds': float(np.max(writeSeconds))})
+  return statistics
+
+#
+# Benchmark suite
+#
+
+def syntheticPhantom(shape=(128, 160, 160), seed=0):
+  """CT-like (k, j, i) int16 phantom in HU: an ellipsoidal soft tissue body
+  (40 +- 20 HU) in air, with a bone sphere and a vessel along k. Generated in
+  process from a RandomState(seed), so every run sees the same volume.
+  """
+  random = np.random.RandomState(seed)
+  k, j, i = np.ogrid[tuple(slice(0, size) for size in shape)]
+  center = [(size - 1) / 2.0 for size in shape]
+  radius = [0.45 * size for size in shape]
+  body = ((k - center[0]) / radius[0]) ** 2 + ((j - center[1]) / radius[1]) ** 2 + ((i - center[2]) / radius[2]) ** 2 <= 1.0
+  phantom = np.full(shape, -1000, dtype=np.int16)
+  phantom[body] = random.normal(40, 20, np.count_nonzero(body)).astype(np.int16)
+  boneRadius = 0.15 * min(shape)
+  bone = (k - center[0]) ** 2 + (j - 0.6 * shape[1]) ** 2 + (i - 0.35 * shape[2]) ** 2 <= boneRadius ** 2
+  phantom[bone] = 700
+  vessel = (j - 0.4 * shape[1]) ** 2 + (i - 0.65 * shape[2]) ** 2 <= (0.05 * min(shape)) ** 2
+  phantom[np.broadcast_to(vessel, shape) & body] = 30
+  return phantom
+
+def writeMetaImage(path, volume, spacing=(1.0, 1.0, 1.0)):
+  """Writes a (k, j, i) array as an uncompressed .mha file with an identity
+  orientation, readable by VolumeStore and Slicer.
+  """
+  types = {np.dtype(value): key for key, value in (('MET_UCHAR', 'u1'), ('MET_SHORT', 'i2'), ('MET_FLOAT', 'f4'))}
+  volume = np.ascontiguousarray(volume, dtype=volume.dtype.newbyteorder('<'))
+  with open(path, 'wb') as f:
+    f.write(('ObjectType = Image\nNDims = 3\nBinaryData = True\nBinaryDataByteOrderMSB = False\n'
+             'CompressedData = False\nTransformMatrix = 1 0 0 0 1 0 0 0 1\nOffset = 0 0 0\n'
+             'ElementSpacing = %s\nDimSize = %s\nElementType = %s\nElementDataFile = LOCAL\n'
+             % (' '.join(str(value) for value in spacing), ' '.join(str(size) for size in volume.shape[::-1]),
+                types[volume.dtype])).encode('latin-1'))
+    volume.tofile(f)
+
+def timeInterleaved(functions, rounds=1, minimumDuration=0.0):
+  """Times a sequence of (name, function, repeats) in rounds: every round runs
+  each function its share of repeats, and then again until it took its share
+  of minimumDuration seconds, before moving on to the next function. A slow
+  period of the machine (another process, frequency scaling) then only
+  affects some of the runs of each function instead of all the runs of one.
+  Returns {name: {seconds, min, max, repeats}}: the median, minimum and
+  maximum duration (seconds) measured with time.perf_counter and the number
+  of runs.
+  """
+  durations = dict((name, []) for name, _, _ in functions)
+  for _ in range(rounds):
+    for name, function, repeats in functions:
+      roundDurations = []
+      while len(roundDurations) * rounds < repeats or sum(roundDurations) * rounds < minimumDuration:
+        startTime = time.perf_counter()
+        function()
+        roundDurations.append(time.perf_counter() - startTime)
+      durations[name] += roundDurations
+  return dict((name, {'seconds': float(np.median(values)), 'min': float(np.min(values)),
+                      'max': float(np.max(values)), 'repeats': len(values)})
+              for name, values in durations.items())
+
+def timeRepeats(function, repeats, minimumDuration=0.0):
+  """Runs function repeats times, and then again until the runs took
+  minimumDuration seconds in total; returns the median, minimum and maximum
+  duration (seconds) measured with time.perf_counter and the number of runs.
+  """
+  return timeInterleaved([(None, function, repeats)], 1, minimumDuration)[None]
+
+def benchmarkEnvironment():
+  return {
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'platform': platform.platform(),
+    'processor': platform.processor() or platform.machine(),
+    'cpuCount': multiprocessing.cpu_count(),
+    }
+
+def runBenchmarkSuite(shape=(128, 160, 160), spacing=(0.5, 0.5, 0.5), numberOfFrames=64, workerCounts=None,
+                      repeats=5, seed=0, probeParameters=None, minimumDuration=0.0, rounds=1):
+  """Headless benchmark of the simulation stages on a synthetic phantom: volume
+  load (uncompressed .mha read into memory), acoustic property precompute,
+  single frame latency, batch time per frame for every worker count
+  (1, 2, 4, ... up to the number of cores by default) and landmark
+  registration with RANSAC. Needs neither a GUI, a GPU nor the network.
+  Every stage runs at least repeats times and for at least minimumDuration
+  seconds, spread over rounds interleaved with the other stages (see
+  timeInterleaved).
+
+  Returns {'environment': ..., 'parameters': ..., 'stages': {name: {seconds,
+  min, max, repeats}}, 'throughput': {workers: frames/s}}, where seconds is
+  the median over the runs. Stage names: volumeLoad, acousticProperties,
+  frameLatency, batchFrame/<workers> and registration.
+  """
+  from .AcousticProperties import computeAcousticProperties
+  from .BatchSimulation import simulateSequence
+  from .LandmarkRegistration import fitLandmarkTransformRansac
+  if workerCounts is None:
+    cpuCount = multiprocessing.cpu_count()
+    workerCounts = sorted(set([1] + [2 ** n for n in range(1, 8) if 2 ** n <= cpuCount] + [cpuCount]))
+  probeParameters = probeParameters or {}
+  origin = (0.0, 0.0, 0.0)
+  random = np.random.RandomState(seed)
+  moving = random.uniform(-50, 50, (50, 3))
+  rotation = np.linalg.qr(random.standard_normal((3, 3)))[0]
+  rotation *= np.linalg.det(rotation)
+  fixed = np.dot(moving, rotation.T) + [10.0, -5.0, 20.0] + random.normal(0, 0.5, moving.shape)
+  fixed[:5] += random.uniform(20, 40, (5, 3))
+
+  directory = tempfile.mkdtemp(prefix='UltrasoundSimulatorBenchmark-')
+  try:
+    path = os.path.join(directory, 'phantom.mha')
+    writeMetaImage(path, syntheticPhantom(shape, seed), spacing)
+    volume = np.array(VolumeStore(path, directory).array)
+    renderer = BModeRenderer(volume, spacing, origin, **probeParameters)
+    pose = centeredProbePose(volume.shape, spacing, origin, depth=renderer.probe.depth)
+    renderer.render(pose)
+    # A sweep across the body
+    poses = np.repeat(pose[np.newaxis], numberOfFrames, axis=0)
+    poses[:, 2, 3] += np.linspace(-0.3, 0.3, numberOfFrames) * shape[0] * spacing[2]
+
+    functions = [
+      ('volumeLoad', lambda: np.array(VolumeStore(path, directory).array), repeats),
+      ('acousticProperties', lambda: computeAcousticProperties(volume), repeats),
+      ('frameLatency', lambda: renderer.render(pose), max(repeats, 20)),
+      ]
+    for workers in workerCounts:
+      functions.append(('batchFrame/%d' % workers,
+                        lambda workers=workers: simulateSequence(volume, spacing, origin, poses,
+                                                                 numberOfWorkers=workers, **probeParameters),
+                        max(repeats // 2, 1)))
+    functions.append(('registration', lambda: fitLandmarkTransformRansac(moving, fixed, 2.0, seed=seed), repeats))
+    stages = timeInterleaved(functions, rounds, minimumDuration)
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+  throughput = {}
+  for workers in workerCounts:
+    timing = stages['batchFrame/%d' % workers]
+    for key in ('seconds', 'min', 'max'):
+      timing[key] /= numberOfFrames
+    throughput[workers] = 1.0 / timing['seconds']
+
+  return {
+    'environment': benchmarkEnvironment(),
+    'parameters': {'shape': list(shape), 'spacing': list(spacing), 'numberOfFrames': numberOfFrames,
+                   'workerCounts': list(workerCounts), 'repeats': repeats, 'seed': seed,
+                   'probeParameters': probeParameters, 'minimumDuration': minimumDuration,
+                   'rounds': rounds},
+    'stages': stages,
+    'throughput': throughput,
+    }
+
+def saveBenchmarkResults(results, path):
+  with open(path, 'w') as f:
+    json.dump(results, f, indent=2, sort_keys=True)
+
+def loadBenchmarkResults(path):
+  with open(path) as f:
+    return json.load(f)
+
+def _fastestRun(timing):
+  return timing.get('min', timing['seconds'])
+
+def compareToBaseline(results, baseline, threshold=0.25, minimumSeconds=1e-3):
+  """Stages of results that are slower than in baseline (both as returned by
+  runBenchmarkSuite) by more than threshold (a fraction) and by more than
+  minimumSeconds, so timer noise of very short stages is ignored. The fastest
+  run of each stage is compared rather than the median: scheduling and other
+  processes only ever add time, so the minimum is far less noisy, in
+  particular on machines with few cores. Stages missing from either side are
+  skipped. Returns a list of (stage, baseline seconds, seconds, ratio),
+  sorted by stage.
+  """
+  regressions = []
+  for stage in sorted(results['stages']):
+    if stage not in baseline['stages']:
+      continue
+    reference = _fastestRun(baseline['stages'][stage])
+    seconds = _fastestRun(results['stages'][stage])
+    if seconds > reference * (1.0 + threshold) and seconds - reference > minimumSeconds:
+      regressions.append((stage, reference, seconds, seconds / max(reference, 1e-12)))
+  return regressions
+
+def fastestResults(results, other):
+  """Combines two runBenchmarkSuite results with the same parameters, keeping
+  the timing of the faster run of every stage.
+  """
+  combined = copy.deepcopy(results)
+  for stage, timing in other['stages'].items():
+    if stage not in combined['stages'] or _fastestRun(timing) < _fastestRun(combined['stages'][stage]):
+      combined['stages'][stage] = copy.deepcopy(timing)
+  for workers in combined['throughput']:
+    combined['throughput'][workers] = 1.0 / combined['stages']['batchFrame/%d' % int(workers)]['seconds']
+  return combined
+
+def runAndCompare(baseline, threshold=0.25, retries=2, **parameters):
+  """Runs the benchmark suite (see runBenchmarkSuite for the parameters) and
+  compares it with baseline. While stages regressed, the suite is run again,
+  up to retries times, keeping the fastest run of every stage: a real
+  regression is slower in every run, whereas a slow period of the machine
+  passes. Returns the results and the list of regressions (see
+  compareToBaseline, empty without baseline).
+  """
+  results = runBenchmarkSuite(**parameters)
+  if baseline is None:
+    return results, []
+  regressions = compareToBaseline(results, baseline, threshold)
+  for _ in range(retries):
+    if not regressions:
+      break
+    results = fastestResults(results, runBenchmarkSuite(**parameters))
+    regressions = compareToBaseline(results, baseline, threshold)
+  return results, regressions
+
+def formatBenchmarkResults(results, baseline=None):
+  lines = ['%-20s %12s %12s %12s' % ('stage', 'median ms', 'min ms', 'baseline min')]
+  for stage in sorted(results['stages']):
+    timing = results['stages'][stage]
+    reference = ''
+    if baseline is not None and stage in baseline['stages']:
+      reference = '%.3f' % (_fastestRun(baseline['stages'][stage]) * 1000)
+    lines.append('%-20s %12.3f %12.3f %12s' % (stage, timing['seconds'] * 1000, timing['min'] * 1000, reference))
+  for workers in sorted(results['throughput'], key=int):
+    lines.append('%d workers: %.1f frames/s' % (int(workers), results['throughput'][workers]))
+  return '\n'.join(lines)
+
+def main(argv=None):
+  """Command line entry point: python -m UltrasoundSimulatorLib.Benchmark.
+  Exits with status 1 if a stage regressed compared to the baseline.
+  """
+  import argparse
+  parser = argparse.ArgumentParser(description='Headless benchmark of the ultrasound simulator.')
+  parser.add_argument('--baseline', help='baseline results (JSON) to compare with')
+  parser.add_argument('--update-baseline', action='store_true', help='store the results as the baseline')
+  parser.add_argument('--output', help='write the results (JSON) to this file')
+  parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown per stage (fraction)')
+  parser.add_argument('--repeats', type=int, default=5, help='minimum number of runs per stage')
+  parser.add_argument('--minimum-duration', type=float, default=0.0,
+                      help='minimum total time per stage (seconds), 0.5 with --quick')
+  parser.add_argument('--rounds', type=int, default=1,
+                      help='interleaved rounds over which the runs of each stage are spread, 8 with --quick')
+  parser.add_argument('--retries', type=int, default=2,
+                      help='runs of the suite again while stages regressed, keeping the fastest')
+  parser.add_argument('--quick', action='store_true', help='small phantom and batch, for smoke tests')
+  parser.add_argument('--seed', type=int, default=0)
+  arguments = parser.parse_args(argv)
+
+  parameters = dict(repeats=arguments.repeats, seed=arguments.seed, minimumDuration=arguments.minimum_duration,
+                    rounds=arguments.rounds)
+  if arguments.quick:
+    # The stages of the small phantom take a few milliseconds: run each of
+    # them often enough, and spread over the whole run, that its fastest run
+    # is reproducible
+    parameters.update(repeats=max(arguments.repeats, 16), minimumDuration=arguments.minimum_duration or 0.5,
+                      rounds=max(arguments.rounds, 8),
+                      shape=(48, 64, 64), spacing=(1.0, 1.0, 1.0), numberOfFrames=16, workerCounts=(1, 2),
+                      probeParameters=dict(width=40.0, depth=50.0, numberOfScanlines=64, samplesPerLine=128))
+  baseline = None
+  if arguments.baseline and os.path.exists(arguments.baseline) and not arguments.update_baseline:
+    baseline = loadBenchmarkResults(arguments.baseline)
+  results, regressions = runAndCompare(baseline, arguments.threshold, arguments.retries, **parameters)
+  if arguments.output:
+    saveBenchmarkResults(results, arguments.output)
+
+  print(formatBenchmarkResults(results, baseline))
+  if arguments.baseline and arguments.update_baseline:
+    saveBenchmarkResults(results, arguments.baseline)
+    print('Baseline written to %s' % arguments.baseline)
+  if baseline is None:
+    return 0
+  if baseline.get('parameters') != results['parameters']:
+    print('Warning: the baseline was measured with different parameters')
+  for stage, reference, seconds, ratio in regressions:
+    print('REGRESSION %s: %.3f ms -> %.3f ms (x%.2f)' % (stage, reference * 1000, seconds * 1000, ratio))
+  return 1 if regressions else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,103 @@
+import logging
+
+#
+# CalibrationStateMachine
+#
+
+class CalibrationStateMachine(object):
+  """GUI independent state machine of the calibration workflow. It only
+  changes state when an event is processed (a button press, a placed
+  fiducial, a finished registration), so nothing needs to be polled.
+
+  stateChangedCallbacks are called as callback(previousState, state, event)
+  after every transition and fiducialPlacedCallbacks as callback(count) after
+  every fiducial that does not complete a set. Events raised from within a
+  callback are queued and processed once all callbacks have returned.
+  """
+
+  # States
+  IDLE = "IDLE"
+  PLACE_START_FIDUCIALS = "PLACE_START_FIDUCIALS"
+  ALIGN_CALIBRATION_MODEL = "ALIGN_CALIBRATION_MODEL"
+  PLACE_END_FIDUCIALS = "PLACE_END_FIDUCIALS"
+  CALCULATE_START_TO_END = "CALCULATE_START_TO_END"
+  APPLY_AND_FINALIZE_CALIBRATION = "APPLY_AND_FINALIZE_CALIBRATION"
+  COMPLETED = "COMPLETED"
+
+  # Events
+  START = "START"
+  FIDUCIAL_PLACED = "FIDUCIAL_PLACED"
+  ALL_FIDUCIALS_PLACED = "ALL_FIDUCIALS_PLACED"
+  MODEL_ALIGNED = "MODEL_ALIGNED"
+  CALCULATE = "CALCULATE"
+  REGISTRATION_COMPLETED = "REGISTRATION_COMPLETED"
+  REGISTRATION_FAILED = "REGISTRATION_FAILED"
+  STOP = "STOP"
+
+  TRANSITIONS = {
+    (IDLE, START): PLACE_START_FIDUCIALS,
+    (COMPLETED, START): PLACE_START_FIDUCIALS,
+    (PLACE_START_FIDUCIALS, ALL_FIDUCIALS_PLACED): ALIGN_CALIBRATION_MODEL,
+    (ALIGN_CALIBRATION_MODEL, MODEL_ALIGNED): PLACE_END_FIDUCIALS,
+    (PLACE_END_FIDUCIALS, ALL_FIDUCIALS_PLACED): CALCULATE_START_TO_END,
+    (CALCULATE_START_TO_END, CALCULATE): APPLY_AND_FINALIZE_CALIBRATION,
+    (APPLY_AND_FINALIZE_CALIBRATION, REGISTRATION_COMPLETED): COMPLETED,
+    (APPLY_AND_FINALIZE_CALIBRATION, REGISTRATION_FAILED): CALCULATE_START_TO_END,
+    }
+
+  def __init__(self, numberOfFiducialsToPlace=3):
+    self.numberOfFiducialsToPlace = numberOfFiducialsToPlace
+    self.numberOfFiducialsPlaced = 0
+    self.state = self.IDLE
+    self.stateChangedCallbacks = []
+    self.fiducialPlacedCallbacks = []
+    self.pendingEvents = []
+    self.dispatching = False
+
+  def processEvent(self, event):
+    """Advances the state machine. Returns False if the event is not
+    expected in the current state, in which case it is ignored.
+    """
+    if self.dispatching:
+      self.pendingEvents.append(event)
+      return True
+    self.dispatching = True
+    try:
+      handled = self.dispatchEvent(event)
+      while self.pendingEvents:
+        self.dispatchEvent(self.pendingEvents.pop(0))
+    finally:
+      self.dispatching = False
+      self.pendingEvents = []
+    return handled
+
+  def dispatchEvent(self, event):
+    if event == self.FIDUCIAL_PLACED:
+      if self.state not in (self.PLACE_START_FIDUCIALS, self.PLACE_END_FIDUCIALS):
+        logging.debug('CalibrationStateMachine: fiducial placed in state %s ignored' % self.state)
+        return False
+      self.numberOfFiducialsPlaced += 1
+      if self.numberOfFiducialsPlaced < self.numberOfFiducialsToPlace:
+        for callback in self.fiducialPlacedCallbacks:
+          callback(self.numberOfFiducialsPlaced)
+        return True
+      event = self.ALL_FIDUCIALS_PLACED
+
+    if event == self.STOP:
+      nextState = self.IDLE
+    else:
+      nextState = self.TRANSITIONS.get((self.state, event))
+    if nextState is None:
+      logging.debug('CalibrationStateMachine: event %s ignored in state %s' % (event, self.state))
+      return False
+
+    previousState = self.state
+    self.state = nextState
+    if nextState == self.PLACE_START_FIDUCIALS:
+      self.numberOfFiducialsPlaced = 0
+    elif nextState == self.PLACE_END_FIDUCIALS:
+      # The first end fiducial is the first start fiducial
+      self.numberOfFiducialsPlaced = 1
+    for callback in self.stateChangedCallbacks:
+      callback(previousState, nextState, event)
+    return True
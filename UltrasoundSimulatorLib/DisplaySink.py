@@ -0,0 +1,94 @@
+import tracemalloc
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+#
+# FrameDisplaySink
+#
+
+class FrameDisplaySink(object):
+  """Persistent vtkImageData whose scalars share memory with a NumPy array,
+  so frames reach the views without allocating or converting an image.
+
+  frame is the (rows, columns) NumPy view of the image; renderers can write
+  into it directly (BModeRenderer.render(pose, out=sink.frame)) or through
+  write. modified then signals VTK, and the volume node showing the image,
+  that the scalars changed. dtype is uint8 for B-mode frames or float32 for
+  envelopes. Color frames (e.g. color Doppler) have numberOfComponents 3 and
+  frame is then (rows, columns, 3).
+  """
+
+  def __init__(self, shape, spacing=(1.0, 1.0), dtype=np.uint8, numberOfComponents=1):
+    rows, columns = shape
+    # VTK stores x fastest, so a (1, rows, columns) C-ordered array is an image
+    # of columns x rows x 1 pixels
+    components = (numberOfComponents,) if numberOfComponents > 1 else ()
+    self.buffer = np.zeros((1, rows, columns) + components, dtype=dtype)
+    self.frame = self.buffer[0]
+    self.numberOfComponents = numberOfComponents
+    self.imageData = vtk.vtkImageData()
+    self.imageData.SetDimensions(columns, rows, 1)
+    self.imageData.SetSpacing(spacing[1], spacing[0], 1.0)
+    self.scalars = numpy_support.numpy_to_vtk(self.buffer.reshape(-1, numberOfComponents), deep=False)
+    self.scalars.SetName('Frame')
+    self.imageData.GetPointData().SetScalars(self.scalars)
+    self.numberOfFrames = 0
+
+  @property
+  def shape(self):
+    return self.frame.shape[:2]
+
+  def write(self, frame):
+    """Copies a frame into the shared buffer and signals the change.
+    """
+    np.copyto(self.frame, frame, casting='unsafe')
+    self.modified()
+
+  def modified(self):
+    self.scalars.Modified()
+    self.imageData.Modified()
+    self.numberOfFrames += 1
+
+def measureAllocations(update, arguments, warmUp=2):
+  """Bytes allocated by Python and NumPy while calling update with each of
+  arguments, after warmUp calls. Returns the mean net allocation per call
+  and the peak traced memory above the starting point, which includes the
+  temporaries of a call.
+  """
+  wasTracing = tracemalloc.is_tracing()
+  if not wasTracing:
+    tracemalloc.start()
+  try:
+    # Traced from the warm up on, so buffers it allocates and later calls
+    # replace (e.g. the envelope kept for recompress) are counted as freed
+    for argument in arguments[:warmUp]:
+      update(argument)
+    if hasattr(tracemalloc, 'reset_peak'):
+      tracemalloc.reset_peak()
+    startBytes, _ = tracemalloc.get_traced_memory()
+    for argument in arguments[warmUp:]:
+      update(argument)
+    endBytes, peakBytes = tracemalloc.get_traced_memory()
+  finally:
+    if not wasTracing:
+      tracemalloc.stop()
+  numberOfCalls = max(len(arguments) - warmUp, 1)
+  return {'bytesPerFrame': float(endBytes - startBytes) / numberOfCalls, 'peakBytes': peakBytes - startBytes}
+
+def measureWriteAllocations(sink, frames, warmUp=2):
+  """Allocations (see measureAllocations) of writing already rendered
+  frames (a sequence of arrays) to sink.
+  """
+  return measureAllocations(sink.write, frames, warmUp)
+
+def measureRenderAllocations(sink, renderer, poses, warmUp=2):
+  """Allocations (see measureAllocations) of rendering frames of a
+  BModeRenderer at poses straight into sink, as the logic does. The peak
+  includes the renderer's temporaries.
+  """
+  def update(probeToWorld):
+    renderer.render(probeToWorld, out=sink.frame)
+    sink.modified()
+  return measureAllocations(update, poses, warmUp)
@@ -0,0 +1,94 @@
+import numpy as np
+
+from .BModeRendering import transformPoints
+
+def poseDifference(pose, otherPose):
+  """Rotation angle (degrees) and translation distance (mm) between two 4x4 poses.
+  """
+  pose = np.asarray(pose, dtype=np.float64)
+  otherPose = np.asarray(otherPose, dtype=np.float64)
+  relativeRotation = np.dot(pose[:3, :3].T, otherPose[:3, :3])
+  cosine = np.clip((np.trace(relativeRotation) - 1.0) / 2.0, -1.0, 1.0)
+  return np.degrees(np.arccos(cosine)), np.linalg.norm(pose[:3, 3] - otherPose[:3, 3])
+
+#
+# FrameCoherenceCache
+#
+
+class FrameCoherenceCache(object):
+  """Reuses the last rendered frame while the probe barely moves.
+
+  If the pose differs from the last rendered one by less than
+  rotationTolerance degrees and translationTolerance mm, the cached frame is
+  returned (a hit). Otherwise only scanlines whose samples moved more than
+  resampleDistance voxels since they were last rendered are re-rendered (a
+  partial hit), and the whole frame if all of them did (a miss). As the
+  transform is affine, how far a scanline moved is given by its two ends.
+  With speckle, any resampled scanline re-renders the whole frame.
+  """
+
+  def __init__(self, renderer, rotationTolerance=0.05, translationTolerance=0.05, resampleDistance=1.0):
+    self.renderer = renderer
+    self.rotationTolerance = rotationTolerance
+    self.translationTolerance = translationTolerance
+    self.resampleDistance = resampleDistance
+    self.scanlineEnds = renderer.probePoints[:, [0, -1]]
+    self.reset()
+
+  def reset(self):
+    self.frame = None
+    self.pose = None
+    self.renderedEnds = None
+    self.hits = 0
+    self.partialHits = 0
+    self.misses = 0
+    self.resampledScanlines = 0
+
+  def scanlineEndsIjk(self, probeToWorld):
+    return transformPoints(np.dot(self.renderer.rasToIjk, probeToWorld), self.scanlineEnds)
+
+  def render(self, probeToWorld):
+    """Returns the frame for a pose, shaped like BModeRenderer.render.
+    """
+    probeToWorld = np.array(probeToWorld, dtype=np.float64)
+    if self.frame is not None:
+      angle, distance = poseDifference(self.pose, probeToWorld)
+      if angle <= self.rotationTolerance and distance <= self.translationTolerance:
+        self.hits += 1
+        return self.frame.copy()
+
+    ends = self.scanlineEndsIjk(probeToWorld)
+    if self.frame is None:
+      moved = np.ones(len(ends), dtype=bool)
+    else:
+      moved = np.max(np.linalg.norm(ends - self.renderedEnds, axis=-1), axis=-1) > self.resampleDistance
+    scanlines = np.nonzero(moved)[0]
+    # The lateral point spread function of speckle couples neighboring scanlines
+    if len(scanlines) == len(ends) or (len(scanlines) and self.renderer.speckle is not None):
+      scanlines = np.arange(len(ends))
+      self.frame = self.renderer.render(probeToWorld)
+      self.renderedEnds = ends
+      self.misses += 1
+    else:
+      if len(scanlines):
+        self.frame[:, scanlines] = self.renderer.render(probeToWorld, scanlines)
+        self.renderedEnds[scanlines] = ends[scanlines]
+      self.partialHits += 1
+    self.resampledScanlines += len(scanlines)
+    self.pose = probeToWorld
+    return self.frame.copy()
+
+  def statistics(self):
+    """Hit, partial hit and miss counts, the hit rate and the mean fraction of
+    scanlines rendered per frame.
+    """
+    frames = self.hits + self.partialHits + self.misses
+    numberOfScanlines = len(self.scanlineEnds)
+    return {
+      'frames': frames,
+      'hits': self.hits,
+      'partialHits': self.partialHits,
+      'misses': self.misses,
+      'hitRate': float(self.hits) / frames if frames else 0.0,
+      'renderedScanlineFraction': float(self.resampledScanlines) / (frames * numberOfScanlines) if frames else 0.0,
+      }
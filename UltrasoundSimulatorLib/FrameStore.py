@@ -0,0 +1,274 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+#
+# Store layout
+#
+# A directory of .npz shards of chunkSize frames each (the last one of a
+# writing session may be shorter), holding the frames, the 4x4 pose of
+# every frame and its timestamp, and an index.jsonl file: a JSON line of
+# metadata followed by one JSON line per shard, appended once the shard is
+# completely written. Shards are written under a temporary name and
+# renamed, and a line cut short by a crash is ignored when reading, so a
+# store is always readable and writes resume after the last listed shard.
+#
+
+INDEX_FILE_NAME = 'index.jsonl'
+FORMAT_VERSION = 1
+
+def readIndex(path):
+  """Metadata and list of shards ({file, start, count, bytes}) of a store.
+  """
+  with open(os.path.join(path, INDEX_FILE_NAME)) as f:
+    lines = f.read().split('\n')
+  metadata = json.loads(lines[0])
+  shards = []
+  # Only newline terminated lines are complete
+  for line in lines[1:-1]:
+    shards.append(json.loads(line))
+  return metadata, shards
+
+#
+# FrameStoreWriter
+#
+
+class FrameStoreWriter(object):
+  """Appends frames and their poses to a chunked frame store on a
+  background thread.
+
+  write copies a frame into the chunk being filled, which is queued for the
+  writer thread once full. The queue holds at most queueSize chunks. When it
+  is full, write drops the chunk and counts its frames, so the simulation
+  never waits for the disk, unless blocking is set (e.g. for offline dataset
+  generation), in which case it waits for room. Chunks are saved compressed
+  with numpy.savez_compressed if compress is set.
+
+  If path already holds a store of the same frame shape and type, frames
+  are appended after its last complete shard.
+  """
+
+  def __init__(self, path, frameShape, dtype=np.uint8, chunkSize=256, compress=True, queueSize=8, blocking=False,
+               metadata=None):
+    self.path = path
+    self.frameShape = tuple(int(size) for size in frameShape)
+    self.dtype = np.dtype(dtype)
+    self.chunkSize = chunkSize
+    self.compress = compress
+    self.blocking = blocking
+    if os.path.exists(os.path.join(path, INDEX_FILE_NAME)):
+      storeMetadata, shards = readIndex(path)
+      if tuple(storeMetadata['frameShape']) != self.frameShape or np.dtype(storeMetadata['dtype']) != self.dtype:
+        raise ValueError('FrameStoreWriter: %s holds %s %s frames, not %s %s'
+                         % (path, storeMetadata['dtype'], tuple(storeMetadata['frameShape']), self.dtype, self.frameShape))
+      self.numberOfShards = len(shards)
+      self.numberOfFrames = sum(shard['count'] for shard in shards)
+      self.resumedFrames = self.numberOfFrames
+      # Drop a line cut short by a crash before appending
+      with open(os.path.join(path, INDEX_FILE_NAME), 'rb+') as f:
+        f.truncate(f.read().rfind(b'\n') + 1)
+    else:
+      if not os.path.exists(path):
+        os.makedirs(path)
+      storeMetadata = dict(metadata or {})
+      storeMetadata.update({'version': FORMAT_VERSION, 'frameShape': list(self.frameShape), 'dtype': self.dtype.str,
+                            'chunkSize': chunkSize, 'compressed': compress, 'createdTime': time.time()})
+      with open(os.path.join(path, INDEX_FILE_NAME), 'w') as f:
+        f.write(json.dumps(storeMetadata) + '\n')
+      self.numberOfShards = 0
+      self.numberOfFrames = 0
+      self.resumedFrames = 0
+    self.index = open(os.path.join(path, INDEX_FILE_NAME), 'a')
+    self.lock = threading.Lock()
+    self.queue = queue.Queue(queueSize)
+    self.chunk = None
+    self.queuedFrames = 0
+    self.writtenFrames = 0
+    self.droppedFrames = 0
+    self.writtenBytes = 0
+    self.frameBytes = 0
+    self.writeSeconds = 0.0
+    self.startTime = time.perf_counter()
+    self.error = None
+    self.thread = threading.Thread(target=self.run, name='UltrasoundSimulatorFrameStoreWriter')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def newChunk(self):
+    return {'frames': np.empty((self.chunkSize,) + self.frameShape, dtype=self.dtype),
+            'poses': np.empty((self.chunkSize, 4, 4)), 'timestamps': np.empty(self.chunkSize), 'count': 0}
+
+  def write(self, frame, pose=None, timestamp=None):
+    """Adds a frame with its 4x4 pose (identity if not given) and timestamp
+    (time.time() by default). Returns False if the frame had to be dropped.
+    """
+    if self.error is not None:
+      raise IOError('FrameStoreWriter: writing %s failed: %s' % (self.path, self.error))
+    if self.chunk is None:
+      self.chunk = self.newChunk()
+    count = self.chunk['count']
+    self.chunk['frames'][count] = frame
+    self.chunk['poses'][count] = np.eye(4) if pose is None else pose
+    self.chunk['timestamps'][count] = time.time() if timestamp is None else timestamp
+    self.chunk['count'] = count + 1
+    if self.chunk['count'] == self.chunkSize:
+      return self.queueChunk()
+    return True
+
+  def queueChunk(self):
+    chunk, self.chunk = self.chunk, None
+    if chunk is None or not chunk['count']:
+      return True
+    try:
+      self.queue.put(chunk, block=self.blocking)
+    except queue.Full:
+      with self.lock:
+        self.droppedFrames += chunk['count']
+      logging.warning('FrameStoreWriter: writer queue full, %d frames dropped' % chunk['count'])
+      return False
+    with self.lock:
+      self.queuedFrames += chunk['count']
+    return True
+
+  def run(self):
+    while True:
+      chunk = self.queue.get()
+      try:
+        if chunk is None:
+          return
+        if self.error is None:
+          self.writeChunk(chunk)
+      except Exception as error:
+        logging.exception('FrameStoreWriter: writing %s failed' % self.path)
+        self.error = error
+      finally:
+        self.queue.task_done()
+
+  def writeChunk(self, chunk):
+    startTime = time.perf_counter()
+    count = chunk['count']
+    fileName = 'chunk-%08d.npz' % self.numberOfShards
+    temporaryPath = os.path.join(self.path, fileName + '.tmp')
+    save = np.savez_compressed if self.compress else np.savez
+    with open(temporaryPath, 'wb') as f:
+      save(f, frames=chunk['frames'][:count], poses=chunk['poses'][:count], timestamps=chunk['timestamps'][:count])
+    os.replace(temporaryPath, os.path.join(self.path, fileName))
+    shardBytes = os.path.getsize(os.path.join(self.path, fileName))
+    self.index.write(json.dumps({'file': fileName, 'start': self.numberOfFrames, 'count': count,
+                                 'bytes': shardBytes}) + '\n')
+    self.index.flush()
+    with self.lock:
+      self.numberOfShards += 1
+      self.numberOfFrames += count
+      self.writtenFrames += count
+      self.writtenBytes += shardBytes
+      self.frameBytes += chunk['frames'][:count].nbytes
+      self.writeSeconds += time.perf_counter() - startTime
+
+  def flush(self):
+    """Queues the chunk being filled, even if not full, and waits until
+    every queued chunk is on disk.
+    """
+    if self.chunk is not None:
+      self.queue.put(self.chunk)
+      with self.lock:
+        self.queuedFrames += self.chunk['count']
+      self.chunk = None
+    self.queue.join()
+    if self.error is not None:
+      raise IOError('FrameStoreWriter: writing %s failed: %s' % (self.path, self.error))
+
+  def close(self):
+    try:
+      self.flush()
+    finally:
+      self.queue.put(None)
+      self.thread.join()
+      self.index.close()
+
+  def statistics(self):
+    """Frame counts, bytes on disk and write throughput, in frames/s and
+    MB/s of frame data, over the time the writer thread spent writing and
+    over the time since the writer was created.
+    """
+    with self.lock:
+      elapsedSeconds = time.perf_counter() - self.startTime
+      writeSeconds = max(self.writeSeconds, 1e-9)
+      return {
+        'frames': self.numberOfFrames,
+        'resumedFrames': self.resumedFrames,
+        'writtenFrames': self.writtenFrames,
+        'droppedFrames': self.droppedFrames,
+        'pendingFrames': self.queuedFrames - self.writtenFrames + (self.chunk['count'] if self.chunk else 0),
+        'shards': self.numberOfShards,
+        'bytes': self.writtenBytes,
+        'compressionRatio': self.frameBytes / float(max(self.writtenBytes, 1)),
+        'writeFramesPerSecond': self.writtenFrames / writeSeconds,
+        'writeMegabytesPerSecond': self.frameBytes / writeSeconds / 1024.0 ** 2,
+        'framesPerSecond': self.writtenFrames / max(elapsedSeconds, 1e-9),
+        }
+
+#
+# FrameStore
+#
+
+class FrameStore(object):
+  """Read access to a frame store written by FrameStoreWriter. Frames are
+  loaded one shard at a time, the last loaded shard is kept.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.metadata, self.shards = readIndex(path)
+    self.frameShape = tuple(self.metadata['frameShape'])
+    self.dtype = np.dtype(self.metadata['dtype'])
+    # First frame of every shard and the number of frames, so indexing
+    # does not depend on the number of shards
+    self.starts = np.cumsum([0] + [shard['count'] for shard in self.shards], dtype=np.int64)
+    self.numberOfFrames = int(self.starts[-1])
+    self.loadedShard = None
+    self.loadedArrays = None
+
+  def __len__(self):
+    return self.numberOfFrames
+
+  def loadShard(self, shardIndex):
+    """(frames, poses, timestamps) of a shard.
+    """
+    if self.loadedShard != shardIndex:
+      with np.load(os.path.join(self.path, self.shards[shardIndex]['file'])) as arrays:
+        self.loadedArrays = (arrays['frames'], arrays['poses'], arrays['timestamps'])
+      self.loadedShard = shardIndex
+    return self.loadedArrays
+
+  def __getitem__(self, index):
+    """(frame, pose, timestamp) of a frame.
+    """
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError('FrameStore: frame %d out of range' % index)
+    shardIndex = int(np.searchsorted(self.starts, index, 'right')) - 1
+    frames, poses, timestamps = self.loadShard(shardIndex)
+    offset = index - self.starts[shardIndex]
+    return frames[offset], poses[offset], timestamps[offset]
+
+  def chunks(self):
+    """Iterates over the (frames, poses, timestamps) of all shards in order.
+    """
+    for shardIndex in range(len(self.shards)):
+      yield self.loadShard(shardIndex)
+
+  def poses(self):
+    """(N, 4, 4) poses of all frames.
+    """
+    poses = [np.zeros((0, 4, 4))]
+    for shard in self.shards:
+      with np.load(os.path.join(self.path, shard['file'])) as arrays:
+        poses.append(arrays['poses'])
+    return np.concatenate(poses)
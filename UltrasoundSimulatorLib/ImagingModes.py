@@ -0,0 +1,234 @@
+import numpy as np
+
+from .BModeRendering import transformPoints
+
+B_MODE = 'B-mode'
+M_MODE = 'M-mode'
+COLOR_DOPPLER = 'Color Doppler'
+IMAGING_MODES = (B_MODE, M_MODE, COLOR_DOPPLER)
+
+#
+# M-mode
+#
+
+class MModeRenderer(object):
+  """M-mode: one scanline of a BModeRenderer displayed over time.
+
+  Every update renders only the selected scanline (the center one by
+  default) and writes it as the next column of a (samples, numberOfColumns)
+  image, sweeping from left to right and wrapping around like a scanner's
+  erase bar. With speckle, the neighboring scanlines within the lateral
+  point spread function are rendered too, so the line matches the column of
+  the B-mode frame. While the pose does not change the previous column is
+  reused, so the sweep can advance at the display rate when the probe is
+  still.
+  """
+
+  def __init__(self, renderer, scanline=None, numberOfColumns=256):
+    self.renderer = renderer
+    probe = renderer.probe
+    self.scanline = probe.numberOfScanlines // 2 if scanline is None else scanline
+    radius = 0
+    if renderer.speckle is not None:
+      _, lateralKernel = renderer.speckle.pointSpreadFunction(probe.sampleSpacing, probe.scanlineSpacing)
+      radius = len(lateralKernel) // 2
+    self.scanlines = np.arange(max(self.scanline - radius, 0), min(self.scanline + radius + 1, probe.numberOfScanlines))
+    self.image = np.zeros((probe.samplesPerLine, numberOfColumns), dtype=np.uint8)
+    self.numberOfUpdates = 0
+    self.lastPose = None
+    self.lastLine = None
+
+  @property
+  def frameShape(self):
+    return self.image.shape
+
+  @property
+  def column(self):
+    """Index of the column written by the last update.
+    """
+    return (self.numberOfUpdates - 1) % self.image.shape[1]
+
+  def render(self, probeToWorld):
+    """Adds the scanline at a pose to the image and returns a copy of the
+    image, which later updates (e.g. on a RenderWorker thread) do not change.
+    """
+    probeToWorld = np.asarray(probeToWorld, dtype=np.float64)
+    if self.lastPose is None or not np.array_equal(probeToWorld, self.lastPose):
+      lines = self.renderer.render(probeToWorld, self.scanlines)
+      self.lastLine = lines[:, self.scanline - self.scanlines[0]]
+      self.lastPose = probeToWorld.copy()
+    self.numberOfUpdates += 1
+    self.image[:, self.column] = self.lastLine
+    return self.image.copy()
+
+#
+# Color Doppler
+#
+
+def vesselFlowVelocities(labelVolume, spacing, origin, directions=None, speed=300.0):
+  """Plug flow velocities (mm/s, world coordinates) of the labeled vessels of
+  a (k, j, i) label volume: each label flows at speed along the principal
+  axis of its voxels. Returns {label: velocity}.
+  """
+  if directions is None:
+    directions = np.eye(3)
+  ijkToRas = np.asarray(directions, dtype=np.float64) * np.asarray(spacing, dtype=np.float64)
+  velocities = {}
+  for label in np.unique(labelVolume):
+    if label == 0:
+      continue
+    kji = np.argwhere(labelVolume == label)
+    if len(kji) < 2:
+      continue
+    positions = np.dot(kji[:, ::-1], ijkToRas.T)
+    _, _, vt = np.linalg.svd(positions - positions.mean(axis=0), full_matrices=False)
+    velocities[int(label)] = vt[0] * speed
+  return velocities
+
+def colorFlowOverlay(frame, velocities, nyquistVelocity, out=None):
+  """RGB uint8 image (samples, scanlines, 3) of a B-mode frame with velocity
+  estimates (mm/s, NaN where no flow) in red toward and blue away from the
+  probe, brighter for faster flow.
+  """
+  if out is None:
+    out = np.empty(frame.shape + (3,), dtype=np.uint8)
+  out[...] = frame[..., np.newaxis]
+  flow = ~np.isnan(velocities)
+  level = np.clip(np.abs(velocities[flow]) / nyquistVelocity, 0.0, 1.0)
+  color = (127 + 128 * level).astype(np.uint8)
+  toward = velocities[flow] > 0
+  out[flow] = 0
+  out[flow, 0] = np.where(toward, color, 0)
+  out[flow, 2] = np.where(toward, 0, color)
+  return out
+
+class DopplerRenderer(object):
+  """Color flow imaging over a B-mode frame, within a region of interest.
+
+  Only the samples of roi (scanline start, scanline end, sample start,
+  sample end, as indices of the renderer's probe) are processed. Their
+  labels are looked up (nearest voxel) in labelVolume, which has the
+  geometry of the renderer's volume. Labels listed in flowVelocities ({label:
+  (3,) velocity in mm/s, world coordinates}, e.g. from vesselFlowVelocities)
+  are blood moving at that velocity, other samples stationary tissue.
+
+  For every ROI sample an ensemble of ensembleSize pulses, repeated at prf
+  Hz, is simulated as complex IQ samples: stationary clutter, blood
+  scatterers whose phase advances by 4 pi f0 v / c per pulse with v the
+  velocity toward the probe, and noise. A first order difference wall
+  filter removes the clutter and the Kasai autocorrelation estimator gives
+  the velocity, which aliases beyond the Nyquist velocity c prf / (4 f0)
+  like on a scanner. Samples whose filtered power is below powerThreshold
+  times the noise power show no flow.
+  """
+
+  def __init__(self, renderer, labelVolume=None, flowVelocities=None, roi=None, prf=4000.0, ensembleSize=8,
+               speedOfSound=1540.0, clutterLevel=10.0, noiseLevel=0.05, powerThreshold=4.0, seed=None):
+    self.renderer = renderer
+    self.labelVolume = labelVolume
+    self.flowVelocities = dict(flowVelocities or {})
+    self.prf = prf
+    self.ensembleSize = ensembleSize
+    self.speedOfSound = speedOfSound
+    self.clutterLevel = clutterLevel
+    self.noiseLevel = noiseLevel
+    self.powerThreshold = powerThreshold
+    self.random = np.random.RandomState(seed)
+    # Velocity per label, row 0 for no flow
+    maxLabel = max(list(self.flowVelocities) + [0])
+    self.labelVelocities = np.zeros((maxLabel + 1, 3))
+    self.labelFlowing = np.zeros(maxLabel + 1, dtype=bool)
+    for label, velocity in self.flowVelocities.items():
+      self.labelVelocities[label] = velocity
+      self.labelFlowing[label] = True
+    self.setRoi(roi)
+
+  @property
+  def frameShape(self):
+    return self.renderer.probePoints.shape[1::-1]
+
+  @property
+  def nyquistVelocity(self):
+    """Highest unaliased velocity in mm/s.
+    """
+    return self.speedOfSound * self.prf / (4.0 * self.renderer.frequency * 1e6) * 1000.0
+
+  def setRoi(self, roi=None):
+    """Sets the region of interest as (scanline start, scanline end, sample
+    start, sample end) indices, the whole frame by default.
+    """
+    probe = self.renderer.probe
+    if roi is None:
+      roi = (0, probe.numberOfScanlines, 0, probe.samplesPerLine)
+    self.roi = tuple(int(index) for index in roi)
+    scanlineStart, scanlineEnd, sampleStart, sampleEnd = self.roi
+    self.roiSlices = (slice(scanlineStart, scanlineEnd), slice(sampleStart, sampleEnd))
+    self.roiPoints = self.renderer.probePoints[self.roiSlices]
+    # Beam direction of every ROI scanline in probe coordinates
+    points = self.renderer.probePoints[scanlineStart:scanlineEnd]
+    beams = points[:, -1] - points[:, 0]
+    self.roiBeams = (beams / np.linalg.norm(beams, axis=-1)[:, np.newaxis]).astype(np.float64)
+    self.lastPose = None
+    self.lastLabels = None
+
+  def roiLabels(self, probeToWorld):
+    """Labels at the ROI samples (nearest voxel), 0 outside the volume. The
+    lookup is reused while the pose does not change.
+    """
+    if self.lastPose is not None and np.array_equal(probeToWorld, self.lastPose):
+      return self.lastLabels
+    shape = self.roiPoints.shape[:2]
+    labels = np.zeros(shape, dtype=np.intp)
+    if self.labelVolume is not None and self.flowVelocities:
+      ijk = np.round(transformPoints(np.dot(self.renderer.rasToIjk, probeToWorld), self.roiPoints)).astype(np.intp)
+      dims = np.array(self.labelVolume.shape[::-1])
+      inside = np.all((ijk >= 0) & (ijk < dims), axis=-1)
+      found = self.labelVolume[ijk[inside, 2], ijk[inside, 1], ijk[inside, 0]].astype(np.intp)
+      labels[inside] = np.where(found < len(self.labelVelocities), found, 0)
+    self.lastPose = probeToWorld.copy()
+    self.lastLabels = labels
+    return labels
+
+  def ensemble(self, probeToWorld):
+    """Simulated IQ ensemble (ensembleSize, scanlines, samples) of the ROI and
+    the flow mask.
+    """
+    labels = self.roiLabels(probeToWorld)
+    flowing = self.labelFlowing[labels]
+    # Velocity toward the probe, mm/s
+    beams = np.dot(self.roiBeams, probeToWorld[:3, :3].T)
+    towardProbe = -np.einsum('lsi,li->ls', self.labelVelocities[labels], beams)
+    phaseStep = 4.0 * np.pi * self.renderer.frequency * 1e6 * towardProbe * 1e-3 / (self.speedOfSound * self.prf)
+    shape = labels.shape
+    def complexNormal(size):
+      values = self.random.standard_normal(size + (2,)).astype(np.float32)
+      return (values[..., 0] + 1j * values[..., 1]) * np.float32(np.sqrt(0.5))
+    blood = complexNormal(shape) * flowing
+    clutter = complexNormal(shape) * np.float32(self.clutterLevel)
+    pulses = np.arange(self.ensembleSize, dtype=np.float32).reshape(-1, 1, 1)
+    iq = clutter + blood * np.exp(1j * (pulses * phaseStep.astype(np.float32)))
+    iq += complexNormal((self.ensembleSize,) + shape) * np.float32(self.noiseLevel)
+    return iq.astype(np.complex64), flowing
+
+  def velocities(self, probeToWorld):
+    """Velocity estimates (mm/s, positive toward the probe) shaped like the
+    frame, (samples, scanlines), NaN outside the ROI and where no flow is
+    detected.
+    """
+    probeToWorld = np.asarray(probeToWorld, dtype=np.float64)
+    iq, _ = self.ensemble(probeToWorld)
+    filtered = iq[1:] - iq[:-1]
+    autocorrelation = np.sum(filtered[1:] * np.conj(filtered[:-1]), axis=0)
+    power = np.mean(np.abs(filtered) ** 2, axis=0)
+    roiVelocities = np.angle(autocorrelation) * (self.nyquistVelocity / np.pi)
+    # The difference filter doubles the noise power
+    roiVelocities[power < self.powerThreshold * 2.0 * self.noiseLevel ** 2] = np.nan
+    velocities = np.full(self.frameShape[::-1], np.nan, dtype=np.float32)
+    velocities[self.roiSlices] = roiVelocities
+    return velocities.T
+
+  def render(self, probeToWorld, out=None):
+    """B-mode frame with the color flow of the ROI, RGB uint8 (samples, scanlines, 3).
+    """
+    frame = self.renderer.render(probeToWorld)
+    return colorFlowOverlay(frame, self.velocities(probeToWorld), self.nyquistVelocity, out)
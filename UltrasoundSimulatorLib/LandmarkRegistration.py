@@ -0,0 +1,88 @@
+import collections
+
+import numpy as np
+
+RegistrationResult = collections.namedtuple('RegistrationResult', ['matrix', 'rms', 'residuals'])
+
+#
+# Closed-form landmark registration
+#
+
+def fitLandmarkTransform(moving, fixed, weights=None, similarity=False):
+  """Least squares rigid (or similarity, with similarity=True) transform
+  mapping moving points onto fixed points (Kabsch/Umeyama, via SVD).
+
+  moving and fixed are (..., N, 3) arrays; leading dimensions are a batch of
+  independent point sets solved at once. weights (..., N) are optional
+  per-point weights. Returns a RegistrationResult of (..., 4, 4) matrices,
+  (...) weighted RMS errors and (..., N) per-point residual distances.
+  """
+  moving = np.asarray(moving, dtype=np.float64)
+  fixed = np.asarray(fixed, dtype=np.float64)
+  if moving.shape != fixed.shape or moving.shape[-1] != 3:
+    raise ValueError('fitLandmarkTransform: point sets must both be (..., N, 3)')
+  if weights is None:
+    weights = np.ones(moving.shape[:-1])
+  weights = np.asarray(weights, dtype=np.float64)
+  weights = weights / np.sum(weights, axis=-1, keepdims=True)
+  w = weights[..., np.newaxis]
+
+  movingCentroid = np.sum(w * moving, axis=-2)
+  fixedCentroid = np.sum(w * fixed, axis=-2)
+  movingCentered = moving - movingCentroid[..., np.newaxis, :]
+  fixedCentered = fixed - fixedCentroid[..., np.newaxis, :]
+  covariance = np.einsum('...ni,...nj->...ij', w * movingCentered, fixedCentered)
+
+  u, singularValues, vt = np.linalg.svd(covariance)
+  # Flip the last axis if needed so the result is a rotation, not a reflection
+  d = np.linalg.det(np.einsum('...ji,...kj->...ik', vt, u))
+  correction = np.ones(singularValues.shape)
+  correction[..., 2] = np.where(d < 0, -1.0, 1.0)
+  rotation = np.einsum('...ji,...j,...kj->...ik', vt, correction, u)
+
+  if similarity:
+    movingVariance = np.sum(w[..., 0] * np.sum(movingCentered ** 2, axis=-1), axis=-1)
+    scale = np.sum(singularValues * correction, axis=-1) / movingVariance
+  else:
+    scale = np.ones(rotation.shape[:-2])
+  linear = rotation * scale[..., np.newaxis, np.newaxis]
+
+  matrix = np.zeros(rotation.shape[:-2] + (4, 4))
+  matrix[..., :3, :3] = linear
+  matrix[..., :3, 3] = fixedCentroid - np.einsum('...ij,...j->...i', linear, movingCentroid)
+  matrix[..., 3, 3] = 1.0
+
+  residuals = landmarkResiduals(matrix, moving, fixed)
+  rms = np.sqrt(np.sum(weights * residuals ** 2, axis=-1))
+  return RegistrationResult(matrix, rms, residuals)
+
+def landmarkResiduals(matrix, moving, fixed):
+  """Distances between transformed moving points and fixed points.
+  """
+  transformed = np.einsum('...ij,...nj->...ni', matrix[..., :3, :3], moving) + matrix[..., np.newaxis, :3, 3]
+  return np.linalg.norm(transformed - fixed, axis=-1)
+
+def fitLandmarkTransformRansac(moving, fixed, inlierDistance, numberOfTrials=200, similarity=False, seed=None):
+  """Robust landmark registration for point sets with outliers. Minimal
+  subsets of 3 points are fitted as one batch, every candidate is scored
+  against all points at once, and the best candidate is refitted on its
+  inliers. Returns the RegistrationResult of the refit (residuals of all
+  points) and a boolean inlier mask.
+  """
+  moving = np.asarray(moving, dtype=np.float64)
+  fixed = np.asarray(fixed, dtype=np.float64)
+  numberOfPoints = len(moving)
+  if numberOfPoints < 3:
+    raise ValueError('fitLandmarkTransformRansac: at least 3 point pairs are required')
+  random = np.random.RandomState(seed)
+  subsets = np.argsort(random.rand(numberOfTrials, numberOfPoints), axis=1)[:, :3]
+  candidates = fitLandmarkTransform(moving[subsets], fixed[subsets], similarity=similarity)
+  distances = landmarkResiduals(candidates.matrix, moving[np.newaxis], fixed[np.newaxis])
+  inlierCounts = np.sum(distances < inlierDistance, axis=1)
+  # Among candidates with most inliers, prefer the smallest inlier error
+  score = inlierCounts - np.sum(np.minimum(distances, inlierDistance), axis=1) / (inlierDistance * (numberOfPoints + 1))
+  inliers = distances[np.argmax(score)] < inlierDistance
+  if np.sum(inliers) < 3:
+    inliers[:] = True
+  result = fitLandmarkTransform(moving[inliers], fixed[inliers], similarity=similarity)
+  return RegistrationResult(result.matrix, result.rms, landmarkResiduals(result.matrix, moving, fixed)), inliers
@@ -0,0 +1,117 @@
+import numpy as np
+
+from .BModeRendering import BModeRenderer, TrilinearWeights, transformPoints
+from .Profiler import Profiler
+
+#
+# MultiProbeRenderer
+#
+
+class MultiProbeRenderer(object):
+  """Renders frames of several probes (ProbeGeometry instances, e.g. a
+  biplane pair or one probe per trainee) on the same volume in one pass.
+
+  The probe to voxel transforms of all probes are composed together and
+  their sample positions transformed into one array, so the trilinear
+  weights are computed and each volume (or acoustic property volume) is
+  resampled in a single vectorized gather per update. Probes with the same
+  number of samples per line and sample spacing are stored next to each
+  other and share one scanlineEcho call (without speckle, whose lateral
+  point spread function must not mix neighboring probes). The work per
+  sample stays the same, but the per update overhead of every stage is paid
+  once rather than once per probe. Each frame is identical to what a
+  BModeRenderer of the same probe renders. The other parameters are those
+  of BModeRenderer and are shared by all probes.
+  """
+
+  def __init__(self, volume, spacing, origin, probes, directions=None, **parameters):
+    parameters.pop('probe', None)
+    self.probes = list(probes)
+    if not self.probes:
+      raise ValueError('MultiProbeRenderer: at least one probe is required')
+    self.renderers = [BModeRenderer(volume, spacing, origin, directions, probe=probe, **parameters)
+                      for probe in self.probes]
+    self.profiler = Profiler()
+    # Every group of probes sharing their sampling along scanlines is a
+    # contiguous (scanlines, samples) block of the gathered samples
+    groups = {}
+    for index, probe in enumerate(self.probes):
+      groups.setdefault((probe.samplesPerLine, probe.sampleSpacing), []).append(index)
+    self.groups = []
+    self.sampleRanges = [None] * len(self.probes)
+    start = 0
+    for (samplesPerLine, _), indices in sorted(groups.items()):
+      groupStart = start
+      for index in indices:
+        end = start + self.probes[index].numberOfScanlines * samplesPerLine
+        self.sampleRanges[index] = (start, end)
+        start = end
+      self.groups.append((indices, groupStart, start, samplesPerLine))
+    self.numberOfSamples = start
+
+  @property
+  def profiler(self):
+    return self._profiler
+
+  @profiler.setter
+  def profiler(self, profiler):
+    self._profiler = profiler
+    for renderer in self.renderers:
+      renderer.profiler = profiler
+
+  @property
+  def numberOfProbes(self):
+    return len(self.probes)
+
+  def checkPoses(self, probeToWorlds):
+    probeToWorlds = np.asarray(probeToWorlds, dtype=np.float64).reshape(-1, 4, 4)
+    if len(probeToWorlds) != len(self.probes):
+      raise ValueError('MultiProbeRenderer: %d poses given for %d probes' % (len(probeToWorlds), len(self.probes)))
+    return probeToWorlds
+
+  def sampleWeights(self, probeToWorlds):
+    """Trilinear weights of the samples of all probes, for one pose per
+    probe, stored group by group.
+    """
+    renderer = self.renderers[0]
+    probeToIjks = np.matmul(renderer.rasToIjk, probeToWorlds)
+    ijk = np.empty((self.numberOfSamples, 3), dtype=np.float32)
+    for probe, probeToIjk, (start, end) in zip(self.probes, probeToIjks, self.sampleRanges):
+      transformPoints(probeToIjk, probe.points, ijk[start:end].reshape(probe.points.shape))
+    return TrilinearWeights(renderer.volume.shape, ijk)
+
+  def envelopes(self, probeToWorlds):
+    """Echo amplitudes of every probe, (scanlines, samples) arrays in probe order.
+    """
+    probeToWorlds = self.checkPoses(probeToWorlds)
+    speckle = self.renderers[0].speckle is not None
+    with self.profiler.stage('reslice'):
+      properties = self.renderers[0].sampleProperties(self.sampleWeights(probeToWorlds), speckle)
+    envelopes = [None] * len(self.probes)
+    for indices, groupStart, groupEnd, samplesPerLine in self.groups:
+      if speckle:
+        for index in indices:
+          start, end = self.sampleRanges[index]
+          probeProperties = [values[start:end].reshape(-1, samplesPerLine) for values in properties]
+          envelopes[index] = self.renderers[index].propertiesEnvelope(probeToWorlds[index], probeProperties)
+        continue
+      # Without speckle scanlines are independent, so the group is one array
+      groupProperties = [values[groupStart:groupEnd].reshape(-1, samplesPerLine) for values in properties]
+      envelope = self.renderers[indices[0]].propertiesEnvelope(None, groupProperties)
+      for index in indices:
+        start, end = self.sampleRanges[index]
+        envelopes[index] = envelope[(start - groupStart) // samplesPerLine:(end - groupStart) // samplesPerLine]
+    return envelopes
+
+  def render(self, probeToWorlds, outs=None):
+    """Returns a uint8 B-mode frame shaped (samples, scanlines) per probe, for
+    a sequence of one 4x4 pose per probe, or writes them to the arrays in
+    outs (e.g. the frames of FrameDisplaySinks).
+    """
+    envelopes = self.envelopes(probeToWorlds)
+    frames = []
+    with self.profiler.stage('logCompress'):
+      for index, (renderer, envelope) in enumerate(zip(self.renderers, envelopes)):
+        out = None if outs is None or outs[index] is None else outs[index].T
+        frames.append(renderer.postProcessor.compress(envelope, out).T)
+    return frames
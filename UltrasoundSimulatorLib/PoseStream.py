@@ -0,0 +1,253 @@
+import logging
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+#
+# Quaternions (w, x, y, z)
+#
+
+def quaternionFromMatrix(matrix):
+  """Unit quaternions of the rotation part of (..., 3+, 3+) matrices.
+  """
+  m = np.asarray(matrix, dtype=np.float64)[..., :3, :3]
+  trace = m[..., 0, 0] + m[..., 1, 1] + m[..., 2, 2]
+  # Shepperd's method: pick the numerically largest of w, x, y, z
+  candidates = np.stack([
+    np.stack([1 + trace, m[..., 2, 1] - m[..., 1, 2], m[..., 0, 2] - m[..., 2, 0], m[..., 1, 0] - m[..., 0, 1]], -1),
+    np.stack([m[..., 2, 1] - m[..., 1, 2], 1 + m[..., 0, 0] - m[..., 1, 1] - m[..., 2, 2], m[..., 0, 1] + m[..., 1, 0], m[..., 0, 2] + m[..., 2, 0]], -1),
+    np.stack([m[..., 0, 2] - m[..., 2, 0], m[..., 0, 1] + m[..., 1, 0], 1 - m[..., 0, 0] + m[..., 1, 1] - m[..., 2, 2], m[..., 1, 2] + m[..., 2, 1]], -1),
+    np.stack([m[..., 1, 0] - m[..., 0, 1], m[..., 0, 2] + m[..., 2, 0], m[..., 1, 2] + m[..., 2, 1], 1 - m[..., 0, 0] - m[..., 1, 1] + m[..., 2, 2]], -1),
+    ], -2)
+  diagonal = np.stack([trace, m[..., 0, 0], m[..., 1, 1], m[..., 2, 2]], -1)
+  best = np.argmax(diagonal, axis=-1)
+  q = np.take_along_axis(candidates, best[..., np.newaxis, np.newaxis], axis=-2)[..., 0, :]
+  q = q / np.linalg.norm(q, axis=-1, keepdims=True)
+  return q * np.where(q[..., :1] < 0, -1.0, 1.0)
+
+def matrixFromQuaternion(q):
+  """3x3 rotation matrices of (..., 4) unit quaternions.
+  """
+  w, x, y, z = np.moveaxis(np.asarray(q, dtype=np.float64), -1, 0)
+  return np.stack([
+    np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)], -1),
+    np.stack([2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)], -1),
+    np.stack([2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], -1),
+    ], -2)
+
+def slerp(q0, q1, t):
+  """Spherical linear interpolation between (..., 4) quaternions.
+  """
+  q0 = np.asarray(q0, dtype=np.float64)
+  q1 = np.asarray(q1, dtype=np.float64)
+  t = np.asarray(t, dtype=np.float64)[..., np.newaxis]
+  dot = np.sum(q0 * q1, axis=-1, keepdims=True)
+  q1 = np.where(dot < 0, -q1, q1)
+  dot = np.abs(dot)
+  angle = np.arccos(np.clip(dot, -1.0, 1.0))
+  sinAngle = np.sin(angle)
+  # Fall back to linear interpolation for nearly identical rotations
+  small = sinAngle < 1e-6
+  safeSin = np.where(small, 1.0, sinAngle)
+  w0 = np.where(small, 1 - t, np.sin((1 - t) * angle) / safeSin)
+  w1 = np.where(small, t, np.sin(t * angle) / safeSin)
+  q = w0 * q0 + w1 * q1
+  return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+def poseMatrix(quaternion, translation):
+  matrix = np.eye(4)
+  matrix[:3, :3] = matrixFromQuaternion(quaternion)
+  matrix[:3, 3] = translation
+  return matrix
+
+#
+# PoseStream
+#
+
+class PoseStream(object):
+  """Buffers high rate pose samples and hands out the pose to display.
+
+  Samples are stored in a preallocated ring buffer as timestamped
+  quaternions and translations, optionally smoothed with an exponential
+  filter (time constant smoothingTimeConstant seconds). poseAt interpolates
+  (slerp) the buffered samples at a display time, displayDelay seconds in
+  the past, so the renderer can run at its own rate whatever the sensor
+  rate. Samples must arrive in timestamp order: a sample older than the
+  newest buffered one (e.g. a UDP packet overtaken by the next one) is
+  dropped and counted in numberOfLateSamples. addSample is thread safe so
+  sources can run on their own threads.
+  """
+
+  def __init__(self, capacity=256, smoothingTimeConstant=0.0, displayDelay=0.0, latencyHistory=256):
+    self.capacity = capacity
+    self.smoothingTimeConstant = smoothingTimeConstant
+    self.displayDelay = displayDelay
+    self.timestamps = np.zeros(capacity)
+    self.receiveTimes = np.zeros(capacity)
+    self.quaternions = np.zeros((capacity, 4))
+    self.translations = np.zeros((capacity, 3))
+    self.numberOfSamples = 0
+    self.numberOfLateSamples = 0
+    self.lock = threading.Lock()
+    self.latencies = np.zeros(latencyHistory)
+    self.numberOfPosesDisplayed = 0
+    self.lastDisplayedSample = 0
+
+  def addSample(self, matrix, timestamp=None):
+    """Adds a 4x4 pose sampled at timestamp (time.time() clock, now by
+    default). Returns False if the sample was dropped for being late.
+    """
+    receiveTime = time.time()
+    if timestamp is None:
+      timestamp = receiveTime
+    matrix = np.asarray(matrix, dtype=np.float64)
+    q = quaternionFromMatrix(matrix)
+    translation = matrix[:3, 3]
+    with self.lock:
+      if self.numberOfSamples:
+        previous = (self.numberOfSamples - 1) % self.capacity
+        if timestamp < self.timestamps[previous]:
+          self.numberOfLateSamples += 1
+          logging.debug('PoseStream: dropped a sample %.3f s older than the newest one'
+                        % (self.timestamps[previous] - timestamp))
+          return False
+        previousQ = self.quaternions[previous]
+        if np.dot(q, previousQ) < 0:
+          q = -q
+        if self.smoothingTimeConstant > 0:
+          dt = timestamp - self.timestamps[previous]
+          alpha = 1.0 - np.exp(-dt / self.smoothingTimeConstant)
+          q = slerp(previousQ, q, alpha)
+          translation = self.translations[previous] + alpha * (translation - self.translations[previous])
+      index = self.numberOfSamples % self.capacity
+      self.timestamps[index] = timestamp
+      self.receiveTimes[index] = receiveTime
+      self.quaternions[index] = q
+      self.translations[index] = translation
+      self.numberOfSamples += 1
+    return True
+
+  def poseAt(self, displayTime=None):
+    """Returns the 4x4 pose at displayTime - displayDelay, interpolated between
+    buffered samples (the latest sample if it is newer), or None if no sample
+    was received yet.
+    """
+    if displayTime is None:
+      displayTime = time.time()
+    queryTime = displayTime - self.displayDelay
+    with self.lock:
+      count = min(self.numberOfSamples, self.capacity)
+      if count == 0:
+        return None
+      order = (np.arange(count) + self.numberOfSamples - count) % self.capacity
+      timestamps = self.timestamps[order]
+      after = np.searchsorted(timestamps, queryTime)
+      if after >= count or after == 0:
+        index = order[min(after, count - 1)]
+        pose = poseMatrix(self.quaternions[index], self.translations[index])
+        newest = index
+      else:
+        before, newest = order[after - 1], order[after]
+        t = (queryTime - timestamps[after - 1]) / max(timestamps[after] - timestamps[after - 1], 1e-9)
+        pose = poseMatrix(slerp(self.quaternions[before], self.quaternions[newest], t),
+                          (1 - t) * self.translations[before] + t * self.translations[newest])
+      self.latencies[self.numberOfPosesDisplayed % len(self.latencies)] = displayTime - self.receiveTimes[newest]
+      self.numberOfPosesDisplayed += 1
+      self.lastDisplayedSample = self.numberOfSamples
+    return pose
+
+  def hasNewSamples(self):
+    """True if samples arrived since the last poseAt call.
+    """
+    return self.numberOfSamples != self.lastDisplayedSample
+
+  def latencyStatistics(self):
+    """Mean, 95th percentile and maximum (seconds) of the time between
+    receiving the newest sample used for a displayed pose and its display.
+    """
+    latencies = self.latencies[:min(self.numberOfPosesDisplayed, len(self.latencies))]
+    if not len(latencies):
+      return {'mean': 0.0, 'p95': 0.0, 'max': 0.0}
+    return {'mean': float(np.mean(latencies)), 'p95': float(np.percentile(latencies, 95)),
+            'max': float(np.max(latencies))}
+
+#
+# Pose sources
+#
+
+class PoseSourceThread(threading.Thread):
+  """Base class of background threads feeding a PoseStream.
+  """
+
+  def __init__(self, stream):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.stream = stream
+    self.stopEvent = threading.Event()
+
+  def stop(self):
+    self.stopEvent.set()
+    self.join()
+
+class FileReplaySource(PoseSourceThread):
+  """Replays recorded poses, an (N, 17) array of timestamp followed by the
+  16 row-major matrix elements (.npy, or text with one sample per line), at
+  speed times the recorded rate. Samples are restamped to the current clock.
+  """
+
+  def __init__(self, stream, path, speed=1.0, loop=False):
+    PoseSourceThread.__init__(self, stream)
+    if path.endswith('.npy'):
+      self.samples = np.load(path)
+    else:
+      self.samples = np.loadtxt(path, delimiter=',' if path.endswith('.csv') else None, ndmin=2)
+    self.speed = speed
+    self.loop = loop
+
+  def run(self):
+    while not self.stopEvent.is_set():
+      startTime = time.time()
+      firstTimestamp = self.samples[0, 0]
+      for sample in self.samples:
+        sampleTime = startTime + (sample[0] - firstTimestamp) / self.speed
+        if self.stopEvent.wait(max(0.0, sampleTime - time.time())):
+          return
+        self.stream.addSample(sample[1:17].reshape(4, 4), sampleTime)
+      if not self.loop:
+        return
+
+class UdpPoseSource(PoseSourceThread):
+  """Receives poses on a local UDP port, one datagram per sample holding 17
+  little-endian doubles: the sensor timestamp and the 16 row-major matrix
+  elements. Samples are stamped with the receive time unless
+  useSensorTimestamps is set (sensor and host clocks must then agree, and
+  packets arriving after a newer one are dropped by the stream).
+  """
+
+  PACKET = struct.Struct('<17d')
+
+  def __init__(self, stream, port, host='127.0.0.1', useSensorTimestamps=False):
+    PoseSourceThread.__init__(self, stream)
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.socket.bind((host, port))
+    self.socket.settimeout(0.1)
+    self.useSensorTimestamps = useSensorTimestamps
+
+  def run(self):
+    try:
+      while not self.stopEvent.is_set():
+        try:
+          data = self.socket.recv(self.PACKET.size)
+        except socket.timeout:
+          continue
+        if len(data) != self.PACKET.size:
+          logging.debug('UdpPoseSource: ignored packet of %d bytes' % len(data))
+          continue
+        values = self.PACKET.unpack(data)
+        timestamp = values[0] if self.useSensorTimestamps else None
+        self.stream.addSample(np.array(values[1:]).reshape(4, 4), timestamp)
+    finally:
+      self.socket.close()
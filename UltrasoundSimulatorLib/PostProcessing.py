@@ -0,0 +1,112 @@
+import numpy as np
+
+#
+# PostProcessor
+#
+
+def tgcProfile(tgc, samplesPerLine):
+  """Gain (dB) of every sample along a scanline from time gain compensation
+  values (dB) at equally spaced depths, the first at the first sample and
+  the last at the last one, interpolated linearly. None gives no gain.
+  """
+  if tgc is None:
+    return np.zeros(samplesPerLine)
+  tgc = np.atleast_1d(np.asarray(tgc, dtype=np.float64))
+  if len(tgc) == 1:
+    return np.full(samplesPerLine, tgc[0])
+  return np.interp(np.linspace(0.0, 1.0, samplesPerLine), np.linspace(0.0, 1.0, len(tgc)), tgc)
+
+class PostProcessor(object):
+  """Gain, time gain compensation and dynamic range of (scanlines, samples)
+  envelopes, applied through a uint8 lookup table.
+
+  compress quantizes the envelope in dB to uint16 codes of codesPerDb codes
+  per dB from minimumDb, and keeps them unless told otherwise. Grey values
+  are then a lookup of the codes shifted by the TGC of their sample, in a
+  table of the log compression (see logCompress) for the current gain and
+  dynamic range. Changing these only rebuilds the table and the per sample
+  shifts, so recompress redisplays the kept envelope without simulating it
+  again. Grey values are within one level of logCompress with gain plus
+  the TGC profile.
+  """
+
+  def __init__(self, samplesPerLine, dynamicRange=60.0, gain=0.0, tgc=None, minimumDb=-200.0, codesPerDb=200.0):
+    self.samplesPerLine = samplesPerLine
+    self.minimumDb = minimumDb
+    self.codesPerDb = codesPerDb
+    self.codes = None
+    self.dynamicRange = dynamicRange
+    self.gain = gain
+    self.tgc = None
+    self.setParameters(dynamicRange, gain, tgc)
+
+  def setParameters(self, dynamicRange=None, gain=None, tgc=None):
+    """Changes the dynamic range and gain (dB) and the TGC (dB at equally
+    spaced depths, see tgcProfile), those given only.
+    """
+    if dynamicRange is not None and dynamicRange <= 0:
+      raise ValueError('PostProcessor: the dynamic range must be positive, got %r' % dynamicRange)
+    if dynamicRange is not None:
+      self.dynamicRange = dynamicRange
+    if gain is not None:
+      self.gain = gain
+    if tgc is not None:
+      self.tgc = tgc
+    self.update()
+
+  def update(self):
+    shifts = np.round(tgcProfile(self.tgc, self.samplesPerLine) * self.codesPerDb).astype(np.int32)
+    lowest = min(int(shifts.min()), 0)
+    codes = np.arange(lowest, np.iinfo(np.uint16).max + 1 + max(int(shifts.max()), 0))
+    db = self.minimumDb + codes / self.codesPerDb + self.gain
+    lut = np.floor(np.clip((db + self.dynamicRange) * (255.0 / self.dynamicRange), 0.0, 255.0)).astype(np.uint8)
+    # Assigned together so a render thread never sees a table of other shifts
+    self.lookup = (lut, shifts - lowest if shifts.any() else None)
+
+  def encode(self, envelope):
+    """uint16 codes of an envelope in dB.
+    """
+    db = 20.0 * np.log10(np.maximum(envelope, 1e-12))
+    codes = (db - np.float32(self.minimumDb)) * np.float32(self.codesPerDb) + np.float32(0.5)
+    np.clip(codes, 0, np.iinfo(np.uint16).max, out=codes)
+    return codes.astype(np.uint16)
+
+  def compress(self, envelope, out=None, keep=True, scanlines=None):
+    """uint8 grey values of an envelope, written to out if given. With keep
+    the envelope is kept for recompress. If the envelope holds only the given
+    scanline indices of a frame, they replace those rows of the kept
+    envelope, if any.
+    """
+    codes = self.encode(envelope)
+    if keep and scanlines is None:
+      self.codes = codes
+    elif keep and self.codes is not None:
+      # Replaced on a copy so recompress never sees a half updated envelope
+      kept = self.codes.copy()
+      kept[scanlines] = codes
+      self.codes = kept
+    return self.apply(codes, out)
+
+  def recompress(self, out=None):
+    """Grey values of the kept envelope with the current parameters, None if
+    no envelope was kept.
+    """
+    codes = self.codes
+    if codes is None:
+      return None
+    return self.apply(codes, out)
+
+  def apply(self, codes, out=None):
+    """Grey values of envelope codes (as returned by encode), written to out
+    (uint8 or float32) if given.
+    """
+    lut, shifts = self.lookup
+    if shifts is None:
+      index = codes
+    else:
+      index = codes.astype(np.int32)
+      index += shifts
+    if out is None:
+      return np.take(lut, index)
+    np.copyto(out, np.take(lut, index), casting='unsafe')
+    return out
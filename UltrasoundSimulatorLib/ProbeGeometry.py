@@ -0,0 +1,137 @@
+import abc
+
+import numpy as np
+
+#
+# Probe geometries
+#
+# Sample positions are in probe coordinates (millimeters): x is lateral, y is
+# depth and the imaging plane is z = 0, with the center of the transducer
+# surface at the origin. They are computed once per geometry, so rendering a
+# frame only transforms them by the probe pose; the work is proportional to
+# the number of samples in the imaged sector, whatever the view's field of view.
+#
+
+def probePlanePoints(width, depth, numberOfScanlines, samplesPerLine):
+  """Sample positions of a linear probe in probe coordinates, shaped
+  (numberOfScanlines, samplesPerLine, 3). x is lateral, y is depth and the
+  imaging plane is z = 0.
+  """
+  lateral = np.linspace(-0.5 * width, 0.5 * width, numberOfScanlines, dtype=np.float32)
+  axial = np.linspace(0.0, depth, samplesPerLine, dtype=np.float32)
+  points = np.zeros((numberOfScanlines, samplesPerLine, 3), dtype=np.float32)
+  points[:, :, 0] = lateral[:, np.newaxis]
+  points[:, :, 1] = axial[np.newaxis, :]
+  return points
+
+def convexProbePoints(radius, angle, depth, numberOfScanlines, samplesPerLine):
+  """Sample positions of a convex (curvilinear) probe with the given radius of
+  curvature (mm) and sector angle (degrees), shaped like probePlanePoints.
+  Scanlines fan out from the center of curvature at (0, -radius, 0).
+  """
+  theta = np.radians(np.linspace(-0.5 * angle, 0.5 * angle, numberOfScanlines))
+  distance = radius + np.linspace(0.0, depth, samplesPerLine)
+  points = np.zeros((numberOfScanlines, samplesPerLine, 3), dtype=np.float32)
+  points[:, :, 0] = np.sin(theta)[:, np.newaxis] * distance
+  points[:, :, 1] = np.cos(theta)[:, np.newaxis] * distance - radius
+  return points
+
+class ProbeGeometry(abc.ABC):
+  """Abstract base class of probe geometries, which implement computePoints
+  and its inverse frameCoordinates.
+  points holds the precomputed (numberOfScanlines, samplesPerLine, 3) sample
+  positions, sampleSpacing the distance between samples along a scanline and
+  scanlineSpacing the distance between scanlines. Geometries with equal
+  parameters (PARAMETER_NAMES) compare equal, so renderers can be reused.
+  """
+
+  PARAMETER_NAMES = ('depth', 'numberOfScanlines', 'samplesPerLine')
+
+  def __init__(self, depth, numberOfScanlines, samplesPerLine):
+    self.depth = float(depth)
+    self.numberOfScanlines = int(numberOfScanlines)
+    self.samplesPerLine = int(samplesPerLine)
+    self.sampleSpacing = self.depth / float(max(self.samplesPerLine - 1, 1))
+    self.points = self.computePoints()
+    self.points.flags.writeable = False
+    # Distance between neighboring scanlines, at mid depth for diverging ones
+    middle = self.points[:, self.samplesPerLine // 2]
+    self.scanlineSpacing = float(np.mean(np.linalg.norm(np.diff(middle, axis=0), axis=-1))) if self.numberOfScanlines > 1 else 0.0
+
+  @abc.abstractmethod
+  def computePoints(self):
+    """(numberOfScanlines, samplesPerLine, 3) float32 sample positions.
+    """
+
+  @abc.abstractmethod
+  def frameCoordinates(self, x, y):
+    """Continuous (scanline, sample) indices of probe plane positions x, y
+    (arrays, mm), the inverse of points. Positions outside the imaged sector
+    map outside [0, numberOfScanlines - 1] x [0, samplesPerLine - 1].
+    """
+
+  def parameters(self):
+    return (type(self).__name__,) + tuple(getattr(self, name) for name in self.PARAMETER_NAMES)
+
+  def withResolution(self, numberOfScanlines, samplesPerLine):
+    """The same geometry sampled with a different number of scanlines and samples.
+    """
+    parameters = dict((name, getattr(self, name)) for name in self.PARAMETER_NAMES)
+    parameters.update(numberOfScanlines=numberOfScanlines, samplesPerLine=samplesPerLine)
+    return type(self)(**parameters)
+
+  @property
+  def numberOfSamples(self):
+    return self.numberOfScanlines * self.samplesPerLine
+
+  def __eq__(self, other):
+    return isinstance(other, ProbeGeometry) and self.parameters() == other.parameters()
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self.parameters())
+
+  def __repr__(self):
+    return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.PARAMETER_NAMES))
+
+class LinearProbe(ProbeGeometry):
+  """Linear array: parallel scanlines across width millimeters.
+  """
+
+  PARAMETER_NAMES = ('width', 'depth', 'numberOfScanlines', 'samplesPerLine')
+
+  def __init__(self, width=60.0, depth=80.0, numberOfScanlines=128, samplesPerLine=256):
+    self.width = float(width)
+    ProbeGeometry.__init__(self, depth, numberOfScanlines, samplesPerLine)
+
+  def computePoints(self):
+    return probePlanePoints(self.width, self.depth, self.numberOfScanlines, self.samplesPerLine)
+
+  def frameCoordinates(self, x, y):
+    scanline = (np.asarray(x) / self.width + 0.5) * (self.numberOfScanlines - 1)
+    sample = np.asarray(y) / self.depth * (self.samplesPerLine - 1)
+    return scanline, sample
+
+class ConvexProbe(ProbeGeometry):
+  """Convex (curvilinear) array: scanlines spread over angle degrees from a
+  transducer surface of the given radius of curvature.
+  """
+
+  PARAMETER_NAMES = ('radius', 'angle', 'depth', 'numberOfScanlines', 'samplesPerLine')
+
+  def __init__(self, radius=40.0, angle=60.0, depth=120.0, numberOfScanlines=128, samplesPerLine=256):
+    self.radius = float(radius)
+    self.angle = float(angle)
+    ProbeGeometry.__init__(self, depth, numberOfScanlines, samplesPerLine)
+
+  def computePoints(self):
+    return convexProbePoints(self.radius, self.angle, self.depth, self.numberOfScanlines, self.samplesPerLine)
+
+  def frameCoordinates(self, x, y):
+    x = np.asarray(x)
+    y = np.asarray(y) + self.radius
+    scanline = (np.degrees(np.arctan2(x, y)) / self.angle + 0.5) * (self.numberOfScanlines - 1)
+    sample = (np.hypot(x, y) - self.radius) / self.depth * (self.samplesPerLine - 1)
+    return scanline, sample
@@ -0,0 +1,131 @@
+import csv
+import json
+import threading
+import time
+
+import numpy as np
+
+#
+# Profiler
+#
+
+class _StageTimer(object):
+
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    self.startTime = time.perf_counter()
+    return self
+
+  def __exit__(self, *exception):
+    self.profiler.record(self.name, time.perf_counter() - self.startTime)
+    return False
+
+class _NullTimer(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exception):
+    return False
+
+_NULL_TIMER = _NullTimer()
+
+class Profiler(object):
+  """Per-stage timers of the simulation pipeline.
+
+  Wrap a stage in "with profiler.stage(name):" to time it with
+  time.perf_counter, and call frame() once per displayed frame. The last
+  historySize durations of every stage are kept in a ring buffer for
+  percentiles. While disabled, stage returns a shared no-op context manager
+  and nothing is recorded, so instrumentation can stay in place. Render
+  threads record into the same profiler as the main thread, so updates
+  and statistics take a lock.
+  """
+
+  STATISTICS = ('count', 'mean', 'p50', 'p95', 'p99', 'max')
+
+  def __init__(self, historySize=1024, enabled=False):
+    self.historySize = historySize
+    self.enabled = enabled
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.durations = {}
+      self.counts = {}
+      self.numberOfFrames = 0
+      self.frameTimes = np.zeros(self.historySize)
+
+  def stage(self, name):
+    if not self.enabled:
+      return _NULL_TIMER
+    return _StageTimer(self, name)
+
+  def record(self, name, seconds):
+    """Adds a duration (seconds) to a stage.
+    """
+    with self.lock:
+      if name not in self.durations:
+        self.durations[name] = np.zeros(self.historySize)
+        self.counts[name] = 0
+      self.durations[name][self.counts[name] % self.historySize] = seconds
+      self.counts[name] += 1
+
+  def frame(self):
+    """Counts a displayed frame, once per frame shown.
+    """
+    if not self.enabled:
+      return
+    with self.lock:
+      self.frameTimes[self.numberOfFrames % self.historySize] = time.perf_counter()
+      self.numberOfFrames += 1
+
+  def framesPerSecond(self):
+    with self.lock:
+      count = min(self.numberOfFrames, self.historySize)
+      times = self.frameTimes[:count].copy()
+    if count < 2:
+      return 0.0
+    return (count - 1) / max(np.max(times) - np.min(times), 1e-9)
+
+  def statistics(self):
+    """{stage: {count, mean, p50, p95, p99, max}} with durations in
+    milliseconds over the recorded history, plus frames and frames/s.
+    """
+    # Copied under the lock, render threads may record meanwhile
+    with self.lock:
+      histories = dict((name, (self.counts[name], durations[:min(self.counts[name], self.historySize)] * 1000.0))
+                       for name, durations in self.durations.items())
+      numberOfFrames = self.numberOfFrames
+    stages = {}
+    for name, (count, history) in histories.items():
+      p50, p95, p99 = np.percentile(history, [50, 95, 99])
+      stages[name] = {'count': count, 'mean': float(np.mean(history)), 'p50': float(p50),
+                      'p95': float(p95), 'p99': float(p99), 'max': float(np.max(history))}
+    return {'stages': stages, 'frames': numberOfFrames, 'framesPerSecond': self.framesPerSecond()}
+
+  def exportJson(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.statistics(), f, indent=2, sort_keys=True)
+
+  def exportCsv(self, path):
+    """One row per stage, durations in milliseconds.
+    """
+    stages = self.statistics()['stages']
+    with open(path, 'w', newline='') as f:
+      writer = csv.writer(f)
+      writer.writerow(('stage',) + self.STATISTICS)
+      for name in sorted(stages):
+        writer.writerow((name,) + tuple(stages[name][statistic] for statistic in self.STATISTICS))
+
+  def export(self, path):
+    """Exports as CSV if path ends with .csv, as JSON otherwise.
+    """
+    if path.lower().endswith('.csv'):
+      self.exportCsv(path)
+    else:
+      self.exportJson(path)
@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+#
+# RenderWorker
+#
+
+class RenderWorker(object):
+  """Renders frames on background threads so the Qt main thread only
+  submits poses and displays finished frames.
+
+  render is a callable mapping a 4x4 pose to a frame (e.g.
+  BModeRenderer.render); NumPy releases the GIL in its heavy gathers and
+  ufuncs, so the main thread keeps handling events meanwhile. Requests are
+  not queued: submit replaces a pose that no thread has picked up yet, and
+  a finished frame replaces one the main thread has not taken yet, so only
+  the latest pose is ever rendered and displayed. With several threads a
+  newer pose can start while an older one is still rendering; frames
+  finishing after a newer one are dropped.
+
+  Latency is measured from submit to takeResult, the time at which the main
+  thread gets the frame for display.
+  """
+
+  def __init__(self, render, numberOfThreads=1, historySize=1024):
+    self.render = render
+    self.historySize = historySize
+    self.condition = threading.Condition()
+    self.pending = None
+    self.result = None
+    self.sequence = 0
+    self.completedSequence = -1
+    self.submitted = 0
+    self.rendered = 0
+    self.delivered = 0
+    self.droppedRequests = 0
+    self.droppedResults = 0
+    self.errors = 0
+    self.latencies = np.zeros(historySize)
+    self.renderTimes = np.zeros(historySize)
+    self.running = True
+    self.threads = [threading.Thread(target=self.run, name='UltrasoundSimulatorRenderWorker-%d' % index)
+                    for index in range(numberOfThreads)]
+    for thread in self.threads:
+      thread.daemon = True
+      thread.start()
+
+  def submit(self, pose, timestamp=None):
+    """Requests a frame for pose, replacing a request still waiting for a
+    thread. timestamp (time.perf_counter seconds, now by default) is when
+    the pose was acquired.
+    """
+    if timestamp is None:
+      timestamp = time.perf_counter()
+    with self.condition:
+      if self.pending is not None:
+        self.droppedRequests += 1
+      self.pending = (self.sequence, np.array(pose, dtype=np.float64), timestamp)
+      self.sequence += 1
+      self.submitted += 1
+      self.condition.notify()
+
+  def run(self):
+    while True:
+      with self.condition:
+        while self.running and self.pending is None:
+          self.condition.wait()
+        if not self.running:
+          return
+        sequence, pose, timestamp = self.pending
+        self.pending = None
+      startTime = time.perf_counter()
+      try:
+        frame = self.render(pose)
+      except Exception:
+        logging.exception('RenderWorker: rendering failed')
+        with self.condition:
+          self.errors += 1
+        continue
+      renderSeconds = time.perf_counter() - startTime
+      with self.condition:
+        self.renderTimes[self.rendered % self.historySize] = renderSeconds
+        self.rendered += 1
+        if sequence < self.completedSequence:
+          self.droppedResults += 1
+          continue
+        if self.result is not None:
+          self.droppedResults += 1
+        self.completedSequence = sequence
+        self.result = (frame, pose, timestamp)
+        self.condition.notify_all()
+
+  def takeResult(self):
+    """Returns the latest finished (frame, pose) not taken yet, or None.
+    Called by the main thread before displaying the frame.
+    """
+    with self.condition:
+      result = self.result
+      self.result = None
+      if result is None:
+        return None
+      frame, pose, timestamp = result
+      self.latencies[self.delivered % self.historySize] = time.perf_counter() - timestamp
+      self.delivered += 1
+    return frame, pose
+
+  def waitForResult(self, timeout=None):
+    """Blocks until a frame is finished (or timeout seconds passed) and takes it.
+    """
+    with self.condition:
+      self.condition.wait_for(lambda: self.result is not None or not self.running, timeout)
+    return self.takeResult()
+
+  def stop(self, timeout=None):
+    with self.condition:
+      self.running = False
+      self.pending = None
+      self.condition.notify_all()
+    for thread in self.threads:
+      thread.join(timeout)
+
+  @staticmethod
+  def percentiles(values):
+    if not len(values):
+      return {'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+    p50, p95 = np.percentile(values * 1000.0, [50, 95])
+    return {'p50': float(p50), 'p95': float(p95), 'max': float(np.max(values) * 1000.0)}
+
+  def statistics(self):
+    """Request and frame counts, and pose to display latency and render time
+    percentiles in milliseconds.
+    """
+    with self.condition:
+      latencies = self.latencies[:min(self.delivered, self.historySize)].copy()
+      renderTimes = self.renderTimes[:min(self.rendered, self.historySize)].copy()
+      return {
+        'submitted': self.submitted,
+        'rendered': self.rendered,
+        'delivered': self.delivered,
+        'droppedRequests': self.droppedRequests,
+        'droppedResults': self.droppedResults,
+        'errors': self.errors,
+        'latency': self.percentiles(latencies),
+        'renderTime': self.percentiles(renderTimes),
+        }
@@ -0,0 +1,133 @@
+import collections
+
+import numpy as np
+
+#
+# ScanConverter
+#
+
+def displayShape(probe, rows=None):
+  """(rows, columns) of a display grid with square pixels covering the
+  imaged sector of a probe, rows defaulting to the samples per line.
+  """
+  rows = rows or probe.samplesPerLine
+  x, y = probe.points[..., 0], probe.points[..., 1]
+  height = max(float(np.max(y) - np.min(y)), 1e-6)
+  width = float(np.max(x) - np.min(x))
+  return rows, max(int(round(width / height * (rows - 1))) + 1, 2)
+
+class ScanConverter(object):
+  """Precomputed bilinear scan conversion of (samples, scanlines) frames of a
+  probe geometry to a Cartesian (rows, columns) display grid.
+
+  The grid spans the bounding box of the imaged sector, rows along depth and
+  columns along the lateral axis. For every pixel inside the sector the
+  flat indices of its four neighboring frame samples and their bilinear
+  weights are computed once, a sparse matrix with four entries per row
+  stored as dense (4, pixels) arrays, so converting a frame is one gather
+  and one weighted sum. Pixels outside the sector get outsideValue.
+  """
+
+  def __init__(self, probe, outputShape=None, outsideValue=0):
+    self.probe = probe
+    self.outputShape = tuple(outputShape or displayShape(probe))
+    self.outsideValue = outsideValue
+    rows, columns = self.outputShape
+    x, y = probe.points[..., 0], probe.points[..., 1]
+    self.origin = (float(np.min(x)), float(np.min(y)))
+    self.pixelSpacing = ((float(np.max(y)) - self.origin[1]) / max(rows - 1, 1),
+                         (float(np.max(x)) - self.origin[0]) / max(columns - 1, 1))
+    pixelY = self.origin[1] + np.arange(rows) * self.pixelSpacing[0]
+    pixelX = self.origin[0] + np.arange(columns) * self.pixelSpacing[1]
+    scanline, sample = probe.frameCoordinates(pixelX[np.newaxis, :], pixelY[:, np.newaxis])
+    scanline, sample = np.broadcast_arrays(scanline, sample)
+    # Tolerate rounding at the edges of the sector
+    epsilon = 1e-6
+    inside = ((scanline >= -epsilon) & (scanline <= probe.numberOfScanlines - 1 + epsilon)
+              & (sample >= -epsilon) & (sample <= probe.samplesPerLine - 1 + epsilon))
+    self.pixelIndices = np.flatnonzero(inside)
+    scanline = np.clip(scanline.ravel()[self.pixelIndices], 0, probe.numberOfScanlines - 1)
+    sample = np.clip(sample.ravel()[self.pixelIndices], 0, probe.samplesPerLine - 1)
+    scanline0 = np.minimum(np.floor(scanline).astype(np.intp), max(probe.numberOfScanlines - 2, 0))
+    sample0 = np.minimum(np.floor(sample).astype(np.intp), max(probe.samplesPerLine - 2, 0))
+    scanline1 = np.minimum(scanline0 + 1, probe.numberOfScanlines - 1)
+    sample1 = np.minimum(sample0 + 1, probe.samplesPerLine - 1)
+    fs = (scanline - scanline0).astype(np.float32)
+    fd = (sample - sample0).astype(np.float32)
+    # Frames are (samples, scanlines), C ordered
+    n = probe.numberOfScanlines
+    self.indices = np.stack([sample0 * n + scanline0, sample0 * n + scanline1,
+                             sample1 * n + scanline0, sample1 * n + scanline1])
+    self.weights = np.stack([(1 - fd) * (1 - fs), (1 - fd) * fs, fd * (1 - fs), fd * fs])
+
+  @property
+  def nbytes(self):
+    return self.pixelIndices.nbytes + self.indices.nbytes + self.weights.nbytes
+
+  @property
+  def numberOfPixels(self):
+    return len(self.pixelIndices)
+
+  def apply(self, frames, out=None):
+    """Scan converts a (samples, scanlines) frame, or a stack of them
+    (..., samples, scanlines), into (..., rows, columns) images of the
+    frames' type (rounded for integer types), written to out if given.
+    """
+    frames = np.asarray(frames)
+    leading = frames.shape[:-2]
+    flat = frames.reshape((-1, frames.shape[-2] * frames.shape[-1]))
+    values = np.einsum('fkp,kp->fp', flat[:, self.indices], self.weights, dtype=np.float32)
+    if frames.dtype.kind in 'iu':
+      np.round(values, out=values)
+    if out is None:
+      out = np.empty(leading + self.outputShape, dtype=frames.dtype)
+    image = out.reshape((-1, self.outputShape[0] * self.outputShape[1]))
+    image[...] = self.outsideValue
+    image[:, self.pixelIndices] = values
+    return out
+
+#
+# ScanConverterCache
+#
+
+class ScanConverterCache(object):
+  """ScanConverters by probe geometry, output shape and outside value, built
+  on first use and evicted least recently used first when their operators
+  take more than maxBytes.
+  """
+
+  def __init__(self, maxBytes=256 * 1024 ** 2):
+    self.maxBytes = maxBytes
+    self.converters = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  @property
+  def nbytes(self):
+    return sum(converter.nbytes for converter in self.converters.values())
+
+  def get(self, probe, outputShape=None, outsideValue=0):
+    key = (probe, tuple(outputShape or displayShape(probe)), outsideValue)
+    converter = self.converters.pop(key, None)
+    if converter is None:
+      self.misses += 1
+      converter = ScanConverter(probe, key[1], outsideValue)
+    else:
+      self.hits += 1
+    self.converters[key] = converter
+    self.evict(keep=key)
+    return converter
+
+  def evict(self, keep=None):
+    totalBytes = self.nbytes
+    for key in list(self.converters):
+      if totalBytes <= self.maxBytes:
+        break
+      if key == keep:
+        continue
+      totalBytes -= self.converters.pop(key).nbytes
+      self.evictions += 1
+
+  def clear(self):
+    self.converters.clear()
@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+#
+# File format
+#
+# A fixed size header (magic, version and JSON metadata padded with spaces)
+# followed by fixed size records, appended as they arrive. A record cut
+# short by a crash is ignored when reading.
+#
+
+MAGIC = b'USSIMREC'
+VERSION = 1
+HEADER_SIZE = 4096
+
+RECORD_DTYPE = np.dtype([('timestamp', '<f8'), ('kind', '<u4'), ('reserved', '<u4'), ('matrix', '<f8', (4, 4))])
+
+# Record kinds
+IMU = 0
+END_TO_START = 1
+INVERSE = 2
+TRANSLATE = 3
+PROBE = 4
+KIND_NAMES = {IMU: 'IMU', END_TO_START: 'EndToStartTransform', INVERSE: 'InverseTransform',
+              TRANSLATE: 'TranslateTransform', PROBE: 'ProbeTransform'}
+
+#
+# SessionRecorder
+#
+
+class SessionRecorder(object):
+  """Appends timestamped transform matrices to a session recording.
+
+  chain lists the record kinds whose matrices map volume coordinates to world
+  coordinates, innermost first (e.g. [TRANSLATE, IMU, INVERSE] for the
+  calibrated CT phantom), so replays can recompose the volume pose.
+  """
+
+  def __init__(self, path, chain=(IMU,), metadata=None):
+    self.path = path
+    self.lock = threading.Lock()
+    header = dict(metadata or {})
+    header.update({'chain': list(chain), 'kinds': KIND_NAMES, 'recordSize': RECORD_DTYPE.itemsize,
+                   'startTime': time.time()})
+    headerBytes = MAGIC + np.array([VERSION], dtype='<u4').tobytes() + json.dumps(header).encode('utf-8')
+    if len(headerBytes) > HEADER_SIZE:
+      raise ValueError('SessionRecorder: metadata too large')
+    self.file = open(path, 'wb')
+    self.file.write(headerBytes.ljust(HEADER_SIZE, b' '))
+    self.record = np.zeros(1, dtype=RECORD_DTYPE)
+    self.numberOfRecords = 0
+
+  def addRecord(self, kind, matrix, timestamp=None):
+    with self.lock:
+      self.record['timestamp'] = time.time() if timestamp is None else timestamp
+      self.record['kind'] = kind
+      self.record['matrix'] = matrix
+      self.file.write(self.record.tobytes())
+      self.numberOfRecords += 1
+
+  def flush(self):
+    with self.lock:
+      self.file.flush()
+
+  def close(self):
+    with self.lock:
+      self.file.close()
+
+#
+# SessionRecording
+#
+
+class SessionRecording(object):
+  """Read access to a session recording. records is a memory mapped
+  structured array with timestamp, kind and matrix fields.
+  """
+
+  # Record kinds
+  IMU = IMU
+  END_TO_START = END_TO_START
+  INVERSE = INVERSE
+  TRANSLATE = TRANSLATE
+  PROBE = PROBE
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      header = f.read(HEADER_SIZE)
+    if not header.startswith(MAGIC):
+      raise ValueError('SessionRecording: %s is not a session recording' % path)
+    self.version = int(np.frombuffer(header[len(MAGIC):len(MAGIC) + 4], dtype='<u4')[0])
+    self.metadata = json.loads(header[len(MAGIC) + 4:].decode('utf-8').rstrip())
+    self.chain = self.metadata['chain']
+    numberOfRecords = (os.path.getsize(path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+    if numberOfRecords > 0:
+      self.records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(numberOfRecords,))
+    else:
+      self.records = np.zeros(0, dtype=RECORD_DTYPE)
+
+  def __len__(self):
+    return len(self.records)
+
+  def matrices(self, kind):
+    """Timestamps and matrices of all records of one kind.
+    """
+    selected = self.records[self.records['kind'] == kind]
+    return selected['timestamp'], selected['matrix']
+
+  def volumeToWorldMatrices(self):
+    """Timestamps of the IMU records and the (N, 4, 4) volume to world
+    matrices at those times, composed from the latest matrix of every kind in
+    the chain recorded up to each IMU record (identity before the first one).
+    """
+    kinds = self.records['kind']
+    imuIndices = np.nonzero(kinds == IMU)[0]
+    composed = np.tile(np.eye(4), (len(imuIndices), 1, 1))
+    for kind in self.chain:
+      if kind == IMU:
+        matrices = self.records['matrix'][imuIndices]
+      else:
+        # Index of the latest record of this kind at or before each IMU record
+        positions = np.where(kinds == kind, np.arange(len(kinds)), -1)
+        latest = np.maximum.accumulate(positions)[imuIndices]
+        matrices = np.where((latest >= 0)[:, np.newaxis, np.newaxis],
+                            self.records['matrix'][np.maximum(latest, 0)], np.eye(4))
+      composed = np.matmul(matrices, composed)
+    return self.records['timestamp'][imuIndices], composed
+
+  def probePoses(self, probeToWorld=None):
+    """Timestamps and probe to volume matrices of the IMU records, for a probe
+    fixed in world coordinates (identity by default).
+    """
+    timestamps, volumeToWorld = self.volumeToWorldMatrices()
+    probeToWorld = np.eye(4) if probeToWorld is None else np.asarray(probeToWorld, dtype=np.float64)
+    return timestamps, np.matmul(np.linalg.inv(volumeToWorld), probeToWorld)
+
+  def replay(self, callback, speed=1.0, kinds=None):
+    """Calls callback(timestamp, kind, matrix) for every record, at speed
+    times the recorded rate, or as fast as possible if speed is None.
+    """
+    startTime = time.time()
+    firstTimestamp = self.records['timestamp'][0] if len(self.records) else 0.0
+    for record in self.records:
+      if kinds is not None and record['kind'] not in kinds:
+        continue
+      if speed:
+        delay = startTime + (record['timestamp'] - firstTimestamp) / speed - time.time()
+        if delay > 0:
+          time.sleep(delay)
+      callback(float(record['timestamp']), int(record['kind']), np.array(record['matrix']))
@@ -0,0 +1,131 @@
+import copy
+
+import numpy as np
+
+#
+# Point spread function
+#
+
+def gaussianKernel(sigma, spacing):
+  """Normalized 1D Gaussian sampled every spacing (same unit as sigma),
+  truncated at 3 sigma. A single tap if sigma is small compared to spacing.
+  """
+  radius = int(np.ceil(3.0 * sigma / spacing)) if spacing > 0 else 0
+  if radius < 1:
+    return np.ones(1, dtype=np.float32)
+  x = np.arange(-radius, radius + 1) * spacing
+  kernel = np.exp(-0.5 * (x / sigma) ** 2)
+  return (kernel / np.sum(kernel)).astype(np.float32)
+
+def convolveAxis(array, kernel, axis, fftThreshold=16):
+  """Convolves an array with a symmetric 1D kernel along one axis (zero
+  padded). Short kernels are applied as a sum of shifted copies of the whole
+  array, longer ones by multiplication in the Fourier domain.
+  """
+  radius = len(kernel) // 2
+  if radius == 0:
+    return array * kernel[0]
+  array = np.moveaxis(array, axis, -1)
+  length = array.shape[-1]
+  if len(kernel) > fftThreshold:
+    size = length + 2 * radius
+    spectrum = np.fft.fft(array, size, axis=-1) * np.fft.fft(kernel, size)
+    result = np.fft.ifft(spectrum, axis=-1)[..., radius:radius + length]
+    if not np.iscomplexobj(array):
+      result = result.real
+    return np.moveaxis(result.astype(array.dtype), -1, axis)
+  padding = [(0, 0)] * (array.ndim - 1) + [(radius, radius)]
+  padded = np.pad(array, padding, mode='constant')
+  result = padded[..., :length] * kernel[0]
+  for tap in range(1, len(kernel)):
+    result += padded[..., tap:tap + length] * kernel[tap]
+  return np.moveaxis(result, -1, axis)
+
+#
+# SpeckleModel
+#
+
+class SpeckleModel(object):
+  """Speckle from a precomputed, tileable 3D texture of complex scatterer
+  amplitudes anchored in volume (world) coordinates, so the speckle pattern
+  moves with the anatomy rather than with the probe.
+
+  Sample positions look up the texture (nearest texel, wrapping around every
+  textureSize * texelSpacing mm), scaled by the local scatterer density
+  (0-255) and scatteringStrength. Echoes are convolved with a separable
+  Gaussian point spread function of axialResolution and lateralResolution
+  (standard deviations, mm) and the envelope is the magnitude of the
+  complex result. The texture is drawn from a RandomState(seed), so
+  datasets are reproducible.
+  """
+
+  def __init__(self, textureSize=128, texelSpacing=0.2, scatteringStrength=0.01,
+               axialResolution=0.3, lateralResolution=0.6, seed=None):
+    self.textureSize = textureSize
+    self.texelSpacing = texelSpacing
+    self.scatteringStrength = scatteringStrength
+    self.axialResolution = axialResolution
+    self.lateralResolution = lateralResolution
+    self.seed = seed
+    random = np.random.RandomState(seed)
+    shape = (textureSize,) * 3
+    self.texture = np.empty(shape, dtype=np.complex64)
+    self.texture.real = random.standard_normal(shape)
+    self.texture.imag = random.standard_normal(shape)
+    self.texture *= np.sqrt(0.5)
+    self.texturePath = None
+    self.kernels = {}
+
+  @property
+  def nbytes(self):
+    return self.texture.nbytes
+
+  def shared(self, path):
+    """Returns a copy of the model whose texture is written once to path (a
+    .npy file) and memory mapped from there, so pickling it only transfers
+    the path, e.g. to worker processes. Returns the model itself if its
+    texture is already memory mapped.
+    """
+    if self.texturePath:
+      return self
+    np.save(path, self.texture)
+    model = copy.copy(self)
+    model.texture = np.load(path, mmap_mode='r')
+    model.texturePath = path
+    return model
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    if state.get('texturePath'):
+      state['texture'] = None
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.__dict__.setdefault('texturePath', None)
+    if self.texture is None:
+      self.texture = np.load(self.texturePath, mmap_mode='r')
+
+  def scatterers(self, positions, scattererDensity):
+    """Complex scatterer amplitudes at (..., 3) world positions (mm), for
+    scatterer densities (0-255) of the same leading shape.
+    """
+    index = np.floor(positions * (1.0 / self.texelSpacing)).astype(np.intp) % self.textureSize
+    amplitude = self.texture[index[..., 2], index[..., 1], index[..., 0]]
+    return amplitude * (scattererDensity * (self.scatteringStrength / 255.0)).astype(np.float32)
+
+  def pointSpreadFunction(self, sampleSpacing, scanlineSpacing):
+    """Axial and lateral kernels for the given sample and scanline spacings (mm).
+    """
+    key = (sampleSpacing, scanlineSpacing)
+    if key not in self.kernels:
+      self.kernels[key] = (gaussianKernel(self.axialResolution, sampleSpacing),
+                           gaussianKernel(self.lateralResolution, scanlineSpacing))
+    return self.kernels[key]
+
+  def envelope(self, echo, sampleSpacing, scanlineSpacing):
+    """Envelope of (scanlines, samples) complex echoes after the PSF.
+    """
+    axialKernel, lateralKernel = self.pointSpreadFunction(sampleSpacing, scanlineSpacing)
+    blurred = convolveAxis(convolveAxis(echo, axialKernel, 1), lateralKernel, 0)
+    return np.abs(blurred).astype(np.float32)
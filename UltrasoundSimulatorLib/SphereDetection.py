@@ -0,0 +1,267 @@
+import collections
+import struct
+
+import numpy as np
+
+SphereFit = collections.namedtuple('SphereFit', ['center', 'radius', 'rms'])
+
+#
+# STL meshes
+#
+
+def readStl(path):
+  """Reads a binary or ASCII STL file. Returns (V, 3) float64 vertices, shared
+  by the triangles, and (F, 3) vertex indices of the triangles.
+  """
+  with open(path, 'rb') as f:
+    data = f.read()
+  if len(data) >= 84:
+    numberOfTriangles = struct.unpack('<I', data[80:84])[0]
+    binary = len(data) == 84 + 50 * numberOfTriangles
+  else:
+    binary = False
+  if binary:
+    records = np.frombuffer(data, dtype=np.dtype([('normal', '<f4', 3), ('vertices', '<f4', (3, 3)),
+                                                   ('attributes', '<u2')]), count=numberOfTriangles, offset=84)
+    corners = records['vertices'].reshape(-1, 3)
+  else:
+    lines = data.decode('latin-1').split('\n')
+    corners = np.array([line.split()[1:4] for line in lines if line.strip().startswith('vertex')], dtype=np.float32)
+    if len(corners) % 3:
+      raise ValueError('readStl: %s is not a valid STL file' % path)
+  return mergeVertices(corners)
+
+def mergeVertices(corners):
+  """Vertices and faces of triangles given as (3 F, 3) corner coordinates:
+  corners with identical float32 coordinates, compared as 12 byte keys,
+  become one vertex shared by the triangles. Returns (V, 3) float64
+  vertices and (F, 3) vertex indices.
+  """
+  corners = np.ascontiguousarray(corners, dtype=np.float32)
+  _, first, inverse = np.unique(corners.view(np.dtype((np.void, 12))).ravel(), return_index=True, return_inverse=True)
+  return corners[first].astype(np.float64), inverse.reshape(-1, 3)
+
+def writeStl(path, vertices, faces):
+  """Writes a triangle mesh as a binary STL file.
+  """
+  triangles = np.asarray(vertices, dtype=np.float64)[np.asarray(faces)]
+  normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+  normals /= np.maximum(np.linalg.norm(normals, axis=-1), 1e-12)[:, np.newaxis]
+  records = np.zeros(len(triangles), dtype=np.dtype([('normal', '<f4', 3), ('vertices', '<f4', (3, 3)),
+                                                     ('attributes', '<u2')]))
+  records['normal'] = normals
+  records['vertices'] = triangles
+  with open(path, 'wb') as f:
+    f.write(b'UltrasoundSimulator'.ljust(80, b' '))
+    f.write(struct.pack('<I', len(records)))
+    records.tofile(f)
+
+def meshComponents(faces, numberOfVertices):
+  """Connected component label of every vertex of a triangle mesh, the
+  smallest vertex index of its component. Labels are propagated along all
+  edges at once and shortcut by pointer jumping until they are stable.
+  """
+  faces = np.asarray(faces)
+  edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+  labels = np.arange(numberOfVertices)
+  while True:
+    previous = labels.copy()
+    smallest = np.minimum(labels[edges[:, 0]], labels[edges[:, 1]])
+    np.minimum.at(labels, edges[:, 0], smallest)
+    np.minimum.at(labels, edges[:, 1], smallest)
+    labels = labels[labels]
+    if np.array_equal(labels, previous):
+      return labels
+
+#
+# SpatialGrid
+#
+
+class SpatialGrid(object):
+  """Uniform grid index of a point set for radius queries, built once.
+
+  Points are sorted by the key of their cell, so the points of a cell are
+  a contiguous range found by binary search, and a query only looks at the
+  cells overlapping the bounding box of its ball.
+  """
+
+  def __init__(self, points, cellSize):
+    self.points = np.asarray(points, dtype=np.float64)
+    self.cellSize = float(cellSize)
+    self.origin = self.points.min(axis=0)
+    cells = np.floor((self.points - self.origin) / self.cellSize).astype(np.int64)
+    self.dimensions = cells.max(axis=0) + 1
+    keys = self.cellKeys(cells)
+    self.order = np.argsort(keys, kind='stable')
+    self.sortedKeys = keys[self.order]
+
+  def cellKeys(self, cells):
+    return (cells[..., 2] * self.dimensions[1] + cells[..., 1]) * self.dimensions[0] + cells[..., 0]
+
+  def query(self, point, radius):
+    """Indices of the points within radius of point.
+    """
+    point = np.asarray(point, dtype=np.float64)
+    lower = np.maximum(np.floor((point - radius - self.origin) / self.cellSize).astype(np.int64), 0)
+    upper = np.minimum(np.floor((point + radius - self.origin) / self.cellSize).astype(np.int64), self.dimensions - 1)
+    if np.any(upper < lower):
+      return np.zeros(0, dtype=np.intp)
+    cells = np.stack(np.meshgrid(*[np.arange(lower[axis], upper[axis] + 1) for axis in range(3)], indexing='ij'),
+                     axis=-1).reshape(-1, 3)
+    keys = self.cellKeys(cells)
+    starts = np.searchsorted(self.sortedKeys, keys, 'left')
+    lengths = np.searchsorted(self.sortedKeys, keys, 'right') - starts
+    # Concatenated ranges starts[c]:starts[c] + lengths[c] of all cells
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.repeat(starts - offsets, lengths) + np.arange(np.sum(lengths))
+    candidates = self.order[positions]
+    distances = np.linalg.norm(self.points[candidates] - point, axis=-1)
+    return candidates[distances <= radius]
+
+#
+# Sphere fitting
+#
+
+def fitSphere(points, iterations=5):
+  """Least squares sphere through (N >= 4, 3) points: the algebraic fit,
+  refined by Gauss-Newton iterations on the distances to the surface.
+  Returns a SphereFit of the center, radius and RMS distance.
+  """
+  points = np.asarray(points, dtype=np.float64)
+  a = np.concatenate([2.0 * points, np.ones((len(points), 1))], axis=1)
+  solution = np.linalg.lstsq(a, np.sum(points ** 2, axis=1), rcond=None)[0]
+  center = solution[:3]
+  radius = np.sqrt(max(solution[3] + np.dot(center, center), 0.0))
+  for _ in range(iterations):
+    offsets = points - center
+    distances = np.maximum(np.linalg.norm(offsets, axis=1), 1e-12)
+    jacobian = np.concatenate([-offsets / distances[:, np.newaxis], -np.ones((len(points), 1))], axis=1)
+    step = np.linalg.lstsq(jacobian, -(distances - radius), rcond=None)[0]
+    center = center + step[:3]
+    radius = radius + step[3]
+  rms = np.sqrt(np.mean((np.linalg.norm(points - center, axis=1) - radius) ** 2))
+  return SphereFit(center, float(radius), float(rms))
+
+def spheresThroughPoints(quadruples):
+  """Spheres through each of (K, 4, 3) point quadruples, solved as one batch.
+  Returns (K, 3) centers and (K,) radii, NaN for (nearly) coplanar points.
+  """
+  a = np.concatenate([2.0 * quadruples, np.ones(quadruples.shape[:2] + (1,))], axis=2)
+  b = np.sum(quadruples ** 2, axis=2)
+  scale = np.max(np.abs(quadruples), axis=(1, 2)) + 1.0
+  solvable = np.abs(np.linalg.det(a)) > 1e-9 * scale ** 3
+  solutions = np.full(b.shape, np.nan)
+  if np.any(solvable):
+    solutions[solvable] = np.linalg.solve(a[solvable], b[solvable][..., np.newaxis])[..., 0]
+  centers = solutions[:, :3]
+  radii = np.sqrt(np.maximum(solutions[:, 3] + np.sum(centers ** 2, axis=1), 0.0))
+  return centers, radii
+
+#
+# SphereDetector
+#
+
+class SphereDetector(object):
+  """Sphere centers of a triangle mesh such as the calibration model.
+
+  The vertices are indexed once by a SpatialGrid. detectSpheres fits a
+  sphere to every connected component of the mesh and keeps those with a
+  radius between minimumRadius and maximumRadius whose RMS distance to the
+  surface is below tolerance times the radius. fitNear finds the sphere
+  next to a position, e.g. a click, even if it is attached to other parts:
+  spheres through random vertex quadruples of the neighborhood are solved
+  as one batch, the one with most vertices on its surface is refined by
+  least squares on them.
+  """
+
+  def __init__(self, vertices, faces=None, minimumRadius=1.0, maximumRadius=50.0, tolerance=0.02, cellSize=None,
+               seed=0):
+    self.vertices = np.asarray(vertices, dtype=np.float64)
+    self.faces = None if faces is None else np.asarray(faces)
+    self.minimumRadius = minimumRadius
+    self.maximumRadius = maximumRadius
+    self.tolerance = tolerance
+    if cellSize is None:
+      cellSize = max(minimumRadius, float(np.max(np.ptp(self.vertices, axis=0))) / 64.0)
+    self.grid = SpatialGrid(self.vertices, cellSize)
+    self.random = np.random.RandomState(seed)
+    self.spheres = None
+
+  def acceptable(self, fit):
+    return (self.minimumRadius <= fit.radius <= self.maximumRadius
+            and fit.rms <= self.tolerance * fit.radius)
+
+  def detectSpheres(self):
+    """SphereFit of (N, 3) centers, (N,) radii and RMS distances of all the
+    spherical components of the mesh, ordered by R, then A, then S of their
+    centers. Computed once.
+    """
+    if self.spheres is not None:
+      return self.spheres
+    if self.faces is None:
+      raise ValueError('SphereDetector: detecting all spheres requires the mesh faces')
+    labels = meshComponents(self.faces, len(self.vertices))
+    order = np.argsort(labels, kind='stable')
+    _, starts = np.unique(labels[order], return_index=True)
+    fits = []
+    for indices in np.split(order, starts[1:]):
+      if len(indices) < 4:
+        continue
+      fit = fitSphere(self.vertices[indices])
+      if self.acceptable(fit):
+        fits.append(fit)
+    centers = np.array([fit.center for fit in fits]).reshape(-1, 3)
+    # Rounded to ignore rounding errors of equal coordinates
+    order = np.lexsort(np.round(centers, 3).T[::-1])
+    self.spheres = SphereFit(centers[order], np.array([fit.radius for fit in fits])[order],
+                             np.array([fit.rms for fit in fits])[order])
+    return self.spheres
+
+  def fitNear(self, position, searchRadius=None, numberOfCandidates=256, maximumPoints=1024, maximumIterations=10):
+    """SphereFit of the sphere with vertices within searchRadius
+    (maximumRadius by default) of position, None if there is none.
+    Candidates are scored on at most maximumPoints vertices of the
+    neighborhood.
+    """
+    position = np.asarray(position, dtype=np.float64)
+    searchRadius = searchRadius or self.maximumRadius
+    neighbors = self.grid.query(position, searchRadius)
+    if len(neighbors) < 4:
+      return None
+    points = self.vertices[neighbors]
+    if len(points) > maximumPoints:
+      points = points[self.random.choice(len(points), maximumPoints, replace=False)]
+    # Quadruples of a vertex among the quarter closest to position, which is
+    # usually inside the sphere, and three of its nearest vertices
+    closest = np.argsort(np.linalg.norm(points - position, axis=1))[:max(len(points) // 4, 4)]
+    seeds = closest[self.random.randint(0, len(closest), numberOfCandidates)]
+    seedDistances = np.linalg.norm(points[np.newaxis] - points[seeds][:, np.newaxis], axis=-1)
+    numberOfNearest = min(32, len(points) - 1)
+    nearest = np.argpartition(seedDistances, numberOfNearest, axis=1)[:, :numberOfNearest + 1]
+    others = nearest[np.arange(numberOfCandidates)[:, np.newaxis],
+                     self.random.randint(0, numberOfNearest + 1, (numberOfCandidates, 3))]
+    centers, radii = spheresThroughPoints(points[np.concatenate([seeds[:, np.newaxis], others], axis=1)])
+    valid = (radii >= self.minimumRadius) & (radii <= self.maximumRadius)
+    if not np.any(valid):
+      return None
+    centers, radii = centers[valid], radii[valid]
+    # Vertices of the neighborhood on the surface of every candidate
+    distances = np.linalg.norm(points[np.newaxis] - centers[:, np.newaxis], axis=-1)
+    inliers = np.abs(distances - radii[:, np.newaxis]) <= self.tolerance * radii[:, np.newaxis]
+    best = np.argmax(np.count_nonzero(inliers, axis=1))
+    fit = SphereFit(centers[best], float(radii[best]), 0.0)
+    surface = None
+    for _ in range(maximumIterations):
+      # The whole sphere, also the part beyond the search radius
+      candidates = self.grid.query(fit.center, fit.radius * (1.0 + 2.0 * self.tolerance))
+      offsets = np.linalg.norm(self.vertices[candidates] - fit.center, axis=-1) - fit.radius
+      onSurface = candidates[np.abs(offsets) <= self.tolerance * fit.radius]
+      if len(onSurface) < 4:
+        return None
+      if surface is not None and np.array_equal(onSurface, surface):
+        break
+      surface = onSurface
+      fit = fitSphere(self.vertices[surface])
+      if not self.minimumRadius <= fit.radius <= self.maximumRadius:
+        return None
+    return fit if self.acceptable(fit) else None
@@ -0,0 +1,66 @@
+import numpy as np
+
+#
+# TransformChain
+#
+
+class TransformChain(object):
+  """Single source of truth for the probe pose relative to the volume.
+
+  Holds the matrices of a chain of linear transforms mapping volume
+  coordinates to world coordinates, innermost first (e.g. TranslateTransform,
+  IMU, InverseTransform), and the probe to world matrix. The composed
+  volume to probe matrix and its inverse, the probe to volume pose used by
+  BModeRenderer, are only recomputed after a matrix changed. It holds plain
+  arrays, so it can be used and pickled without the MRML scene.
+  """
+
+  def __init__(self, numberOfTransforms, probeToWorld=None):
+    self.matrices = [np.eye(4) for _ in range(numberOfTransforms)]
+    self.probeToWorld = np.eye(4) if probeToWorld is None else np.array(probeToWorld, dtype=np.float64)
+    # Incremented on every change, so users can tell whether a pose they cached is stale
+    self.modifiedTime = 0
+    self.numberOfCompositions = 0
+    self.composedTime = -1
+    self.composedVolumeToProbe = None
+    self.composedProbeToVolume = None
+
+  def setMatrix(self, index, matrix):
+    """Sets the matrix of transform index of the chain (0 is innermost).
+    """
+    self.matrices[index] = np.array(matrix, dtype=np.float64)
+    self.modifiedTime += 1
+
+  def setProbeToWorld(self, matrix):
+    self.probeToWorld = np.array(matrix, dtype=np.float64)
+    self.modifiedTime += 1
+
+  def isModifiedSince(self, time):
+    return self.modifiedTime > time
+
+  def update(self):
+    if self.composedTime == self.modifiedTime:
+      return
+    self.composedProbeToVolume = np.dot(np.linalg.inv(self.volumeToWorld()), self.probeToWorld)
+    self.composedVolumeToProbe = np.linalg.inv(self.composedProbeToVolume)
+    self.composedTime = self.modifiedTime
+    self.numberOfCompositions += 1
+
+  def volumeToWorld(self):
+    volumeToWorld = np.eye(4)
+    for matrix in self.matrices:
+      volumeToWorld = np.dot(matrix, volumeToWorld)
+    return volumeToWorld
+
+  def volumeToProbe(self):
+    """Composed volume to probe matrix (a copy).
+    """
+    self.update()
+    return self.composedVolumeToProbe.copy()
+
+  def probeToVolume(self):
+    """Composed probe to volume matrix (a copy), the pose to pass to
+    BModeRenderer.render.
+    """
+    self.update()
+    return self.composedProbeToVolume.copy()
@@ -0,0 +1,174 @@
+import time
+
+import numpy as np
+
+from .BModeRendering import BModeRenderer
+from .FrameCache import poseDifference
+
+#
+# Downsampling
+#
+
+def downsampleVolume(volume, slabSize=32):
+  """Halves the resolution of a (k, j, i) volume by averaging 2x2x2 blocks,
+  slab by slab so memory mapped volumes are streamed. Odd dimensions are
+  padded by repeating the last voxel. Integer volumes keep their type.
+  """
+  outputShape = tuple((size + 1) // 2 for size in volume.shape)
+  output = np.empty(outputShape, dtype=volume.dtype)
+  for start in range(0, outputShape[0], slabSize):
+    block = np.asarray(volume[2 * start:2 * (start + slabSize)], dtype=np.float32)
+    padding = [(0, size % 2) for size in block.shape]
+    if any(after for _, after in padding):
+      block = np.pad(block, padding, mode='edge')
+    k, j, i = (size // 2 for size in block.shape)
+    mean = block.reshape(k, 2, j, 2, i, 2).mean(axis=(1, 3, 5))
+    if volume.dtype.kind in 'iu':
+      mean = np.round(mean)
+    output[start:start + k] = mean
+  return output
+
+def downsampleGeometry(spacing, origin, directions=None):
+  """Spacing and origin of a volume downsampled by downsampleVolume: voxel
+  (i, j, k) of the result is centered between voxels 2i and 2i + 1.
+  """
+  if directions is None:
+    directions = np.eye(3)
+  spacing = np.asarray(spacing, dtype=np.float64)
+  origin = np.asarray(origin, dtype=np.float64) + np.dot(directions, 0.5 * spacing)
+  return tuple(float(value) for value in 2 * spacing), tuple(float(value) for value in origin)
+
+#
+# VolumePyramid
+#
+
+class VolumePyramid(object):
+  """Full resolution volume and versions downsampled 2x, 4x, ... (levels 1,
+  2, ...), built once. Each downsampled level takes an eighth of the memory
+  of the previous one, so the overhead stays below a seventh of the volume.
+  """
+
+  def __init__(self, volume, spacing, origin, directions=None, numberOfLevels=3):
+    self.directions = directions
+    self.levels = [(volume, tuple(spacing), tuple(origin))]
+    startTime = time.time()
+    for _ in range(1, numberOfLevels):
+      previous, previousSpacing, previousOrigin = self.levels[-1]
+      if min(previous.shape) < 2:
+        break
+      levelSpacing, levelOrigin = downsampleGeometry(previousSpacing, previousOrigin, directions)
+      self.levels.append((downsampleVolume(previous), levelSpacing, levelOrigin))
+    self.buildSeconds = time.time() - startTime
+
+  def __len__(self):
+    return len(self.levels)
+
+  def level(self, index):
+    """(volume, spacing, origin) of a level, 0 being full resolution.
+    """
+    return self.levels[index]
+
+  @property
+  def overheadBytes(self):
+    return sum(volume.nbytes for volume, _, _ in self.levels[1:])
+
+  def memoryReport(self):
+    """Shape and size of every level and the memory overhead of the pyramid.
+    """
+    fullBytes = self.levels[0][0].nbytes
+    return {
+      'levels': [{'shape': volume.shape, 'spacing': spacing, 'bytes': volume.nbytes} for volume, spacing, _ in self.levels],
+      'overheadBytes': self.overheadBytes,
+      'overheadFraction': float(self.overheadBytes) / fullBytes if fullBytes else 0.0,
+      'buildSeconds': self.buildSeconds,
+      }
+
+#
+# LevelOfDetailRenderer
+#
+
+class LevelOfDetailRenderer(object):
+  """Renders from a coarser pyramid level while the probe rotates quickly.
+
+  The angular velocity (degrees/s) between consecutive poses selects level
+  i + 1 when it exceeds angularVelocityThresholds[i]. Level n samples a
+  2^n times downsampled volume with 2^n times fewer scanlines and samples
+  per line, and its frames are upsampled (nearest neighbor) to the full
+  frame shape. Rendering the last pose again, or refine, renders it at full
+  resolution once the motion stopped.
+
+  renderer, if given, is the full resolution BModeRenderer of the level 0
+  volume (e.g. one shared with other views), otherwise one is created. The
+  coarser levels use its gain, dynamic range and TGC.
+  """
+
+  def __init__(self, pyramid, angularVelocityThresholds=(30.0, 90.0), acousticProperties=None, renderer=None,
+               **parameters):
+    self.pyramid = pyramid
+    self.angularVelocityThresholds = angularVelocityThresholds
+    volume, spacing, origin = pyramid.level(0)
+    fullResolution = renderer or BModeRenderer(volume, spacing, origin, pyramid.directions,
+                                               acousticProperties=acousticProperties, **parameters)
+    probe = fullResolution.probe
+    parameters.pop('probe', None)
+    parameters.update(dynamicRange=fullResolution.dynamicRange, gain=fullResolution.gain,
+                      tgc=fullResolution.postProcessor.tgc)
+    self.renderers = [fullResolution]
+    self.upsamplingIndices = [None]
+    for index in range(1, min(len(pyramid), len(angularVelocityThresholds) + 1)):
+      volume, spacing, origin = pyramid.level(index)
+      levelProbe = probe.withResolution(max(probe.numberOfScanlines >> index, 2), max(probe.samplesPerLine >> index, 2))
+      self.renderers.append(BModeRenderer(volume, spacing, origin, pyramid.directions, probe=levelProbe, **parameters))
+      self.upsamplingIndices.append((self.nearestIndices(probe.samplesPerLine, levelProbe.samplesPerLine),
+                                     self.nearestIndices(probe.numberOfScanlines, levelProbe.numberOfScanlines)))
+    self.pose = None
+    self.timestamp = None
+    self.levelRendered = None
+    self.framesPerLevel = [0] * len(self.renderers)
+
+  @property
+  def frameShape(self):
+    return self.renderers[0].frameShape
+
+  @staticmethod
+  def nearestIndices(fineSize, coarseSize):
+    return np.round(np.arange(fineSize) * (coarseSize - 1) / float(max(fineSize - 1, 1))).astype(np.intp)
+
+  def selectLevel(self, angularVelocity):
+    level = 0
+    for threshold in self.angularVelocityThresholds[:len(self.renderers) - 1]:
+      if angularVelocity > threshold:
+        level += 1
+    return level
+
+  def render(self, probeToWorld, timestamp=None):
+    """Renders a frame for a pose sampled at timestamp (now by default) at the
+    level matching the angular velocity since the previous pose.
+    """
+    if timestamp is None:
+      timestamp = time.time()
+    probeToWorld = np.array(probeToWorld, dtype=np.float64)
+    angularVelocity = 0.0
+    if self.pose is not None and timestamp > self.timestamp:
+      angularVelocity = poseDifference(self.pose, probeToWorld)[0] / (timestamp - self.timestamp)
+    level = self.selectLevel(angularVelocity)
+    self.pose = probeToWorld
+    self.timestamp = timestamp
+    return self.renderLevel(level)
+
+  def refine(self):
+    """Re-renders the last pose at full resolution if it was rendered at a
+    coarser level, otherwise returns None.
+    """
+    if not self.levelRendered:
+      return None
+    return self.renderLevel(0)
+
+  def renderLevel(self, level):
+    self.levelRendered = level
+    self.framesPerLevel[level] += 1
+    frame = self.renderers[level].render(self.pose)
+    if level:
+      rows, columns = self.upsamplingIndices[level]
+      frame = frame[rows][:, columns]
+    return frame
@@ -0,0 +1,273 @@
+import hashlib
+import os
+import zlib
+
+import numpy as np
+
+#
+# Header parsing
+#
+
+METAIMAGE_TYPES = {
+  'MET_CHAR': 'i1', 'MET_UCHAR': 'u1', 'MET_SHORT': 'i2', 'MET_USHORT': 'u2',
+  'MET_INT': 'i4', 'MET_UINT': 'u4', 'MET_LONG_LONG': 'i8', 'MET_ULONG_LONG': 'u8',
+  'MET_FLOAT': 'f4', 'MET_DOUBLE': 'f8',
+  }
+
+NRRD_TYPES = {
+  'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+  'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+  'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+  'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+  'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+  'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+  'longlong': 'i8', 'long long': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+  'ulonglong': 'u8', 'unsigned long long': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+  'float': 'f4', 'double': 'f8',
+  }
+
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0])
+
+class VolumeHeader(object):
+  """Geometry and raw data location of a volume file. Coordinates are RAS,
+  like volume nodes loaded by Slicer.
+  """
+
+  def __init__(self):
+    self.shape = None # (k, j, i)
+    self.dtype = None
+    self.spacing = (1.0, 1.0, 1.0)
+    self.origin = (0.0, 0.0, 0.0)
+    self.directions = np.eye(3)
+    self.dataPath = None
+    self.dataOffset = 0
+    self.compressed = False
+
+def readMetaImageHeader(path):
+  """Parses a .mha/.mhd header.
+  """
+  header = VolumeHeader()
+  fields = {}
+  with open(path, 'rb') as f:
+    while True:
+      line = f.readline()
+      if not line:
+        raise ValueError('readMetaImageHeader: no ElementDataFile in %s' % path)
+      key, _, value = line.decode('latin-1').partition('=')
+      fields[key.strip()] = value.strip()
+      if key.strip() == 'ElementDataFile':
+        header.dataOffset = f.tell()
+        break
+
+  if int(fields.get('NDims', 3)) != 3 or int(fields.get('ElementNumberOfChannels', 1)) != 1:
+    raise ValueError('readMetaImageHeader: only single channel 3D images are supported')
+  byteOrder = '>' if fields.get('BinaryDataByteOrderMSB', fields.get('ElementByteOrderMSB', 'False')) == 'True' else '<'
+  header.dtype = np.dtype(byteOrder + METAIMAGE_TYPES[fields['ElementType']])
+  header.shape = tuple(int(v) for v in fields['DimSize'].split())[::-1]
+  header.spacing = tuple(float(v) for v in fields.get('ElementSpacing', '1 1 1').split())
+  origin = fields.get('Offset', fields.get('Position', fields.get('Origin', '0 0 0')))
+  directions = fields.get('TransformMatrix', fields.get('Orientation', fields.get('Rotation', '1 0 0 0 1 0 0 0 1')))
+  # TransformMatrix lists the axis directions one after the other
+  header.directions = np.dot(LPS_TO_RAS, np.array(directions.split(), dtype=np.float64).reshape(3, 3).T)
+  header.origin = tuple(float(v) for v in np.dot(LPS_TO_RAS, np.array(origin.split(), dtype=np.float64)))
+  header.compressed = fields.get('CompressedData', 'False') == 'True'
+  if fields['ElementDataFile'] == 'LOCAL':
+    header.dataPath = path
+  else:
+    header.dataPath = os.path.join(os.path.dirname(path), fields['ElementDataFile'])
+    header.dataOffset = 0
+  return header
+
+def readNrrdHeader(path):
+  """Parses an attached (.nrrd) or detached (.nhdr) NRRD header.
+  """
+  header = VolumeHeader()
+  fields = {}
+  with open(path, 'rb') as f:
+    if not f.readline().startswith(b'NRRD'):
+      raise ValueError('readNrrdHeader: %s is not a NRRD file' % path)
+    while True:
+      line = f.readline()
+      if not line.strip():
+        header.dataOffset = f.tell()
+        break
+      line = line.decode('latin-1')
+      if line.startswith('#') or ':=' in line:
+        continue
+      key, _, value = line.partition(':')
+      fields[key.strip()] = value.strip()
+
+  if int(fields['dimension']) != 3:
+    raise ValueError('readNrrdHeader: only 3D images are supported')
+  byteOrder = '>' if fields.get('endian', 'little') == 'big' else '<'
+  header.dtype = np.dtype(byteOrder + NRRD_TYPES[fields['type']])
+  header.shape = tuple(int(v) for v in fields['sizes'].split())[::-1]
+  if 'space directions' in fields:
+    vectors = np.array([[float(v) for v in vector.strip('()').split(',')]
+                        for vector in fields['space directions'].split()])
+    spacing = np.linalg.norm(vectors, axis=1)
+    directions = (vectors / spacing[:, np.newaxis]).T
+  else:
+    spacing = np.array([float(v) for v in fields.get('spacings', '1 1 1').split()])
+    directions = np.eye(3)
+  origin = np.array([float(v) for v in fields.get('space origin', '(0,0,0)').strip('()').split(',')])
+  if fields.get('space', 'left-posterior-superior') in ('left-posterior-superior', 'LPS'):
+    directions = np.dot(LPS_TO_RAS, directions)
+    origin = np.dot(LPS_TO_RAS, origin)
+  header.spacing = tuple(float(v) for v in spacing)
+  header.origin = tuple(float(v) for v in origin)
+  header.directions = directions
+  header.compressed = fields.get('encoding', 'raw') in ('gzip', 'gz')
+  if fields.get('encoding', 'raw') not in ('raw', 'gzip', 'gz'):
+    raise ValueError('readNrrdHeader: unsupported encoding %s' % fields['encoding'])
+  dataFile = fields.get('data file', fields.get('datafile'))
+  if dataFile:
+    header.dataPath = os.path.join(os.path.dirname(path), dataFile)
+    header.dataOffset = int(fields.get('byte skip', 0))
+  else:
+    header.dataPath = path
+  return header
+
+def readVolumeHeader(path):
+  extension = os.path.splitext(path)[1].lower()
+  if extension in ('.mha', '.mhd'):
+    return readMetaImageHeader(path)
+  if extension in ('.nrrd', '.nhdr'):
+    return readNrrdHeader(path)
+  raise ValueError('readVolumeHeader: unsupported file type %s' % extension)
+
+#
+# Bricked volumes
+#
+
+class BrickedVolume(object):
+  """Read-only (k, j, i) volume stored as cubic bricks in a memory mapped
+  (bricksK, bricksJ, bricksI, size, size, size) array, so sampling a plane
+  only pages in the bricks it intersects. Supports the integer array
+  indexing used by trilinearSample.
+  """
+
+  def __init__(self, bricks, shape):
+    self.bricks = bricks
+    self.shape = tuple(shape)
+    self.dtype = bricks.dtype
+    self.ndim = 3
+    self.brickSize = bricks.shape[-1]
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return self.slab(index)
+    k, j, i = index
+    if isinstance(k, slice) or isinstance(j, slice) or isinstance(i, slice):
+      raise TypeError('BrickedVolume only supports integer indexing and slabs along k')
+    brickK, k = np.divmod(k, self.brickSize)
+    brickJ, j = np.divmod(j, self.brickSize)
+    brickI, i = np.divmod(i, self.brickSize)
+    return self.bricks[brickK, brickJ, brickI, k, j, i]
+
+  def slab(self, kRange):
+    """Dense copy of the slices in kRange (a slice with step 1), reading
+    only the bricks that contain them.
+    """
+    start, stop, step = kRange.indices(self.shape[0])
+    if step != 1:
+      raise TypeError('BrickedVolume slabs must be contiguous')
+    stop = max(start, stop)
+    size = self.brickSize
+    firstBrick = start // size
+    bricks = np.asarray(self.bricks[firstBrick:-(-stop // size)])
+    nk, nj, ni = bricks.shape[:3]
+    dense = bricks.transpose(0, 3, 1, 4, 2, 5).reshape(nk * size, nj * size, ni * size)
+    return dense[start - firstBrick * size:stop - firstBrick * size, :self.shape[1], :self.shape[2]]
+
+  def __array__(self, dtype=None, copy=None):
+    return np.ascontiguousarray(self.slab(slice(None)), dtype=dtype)
+
+class _DecompressedStream(object):
+  """Reads exact byte counts from a zlib or gzip compressed file.
+  """
+
+  def __init__(self, f):
+    self.f = f
+    self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+    self.buffer = b''
+
+  def read(self, size):
+    chunks = [self.buffer]
+    available = len(self.buffer)
+    while available < size:
+      data = self.f.read(1 << 20)
+      if not data:
+        raise IOError('Compressed volume data ended early')
+      chunk = self.decompressor.decompress(data)
+      chunks.append(chunk)
+      available += len(chunk)
+    data = b''.join(chunks)
+    self.buffer = data[size:]
+    return data[:size]
+
+def writeBrickCache(header, cachePath, brickSize=32):
+  """Decompresses the volume slab by slab into a bricked .npy cache file.
+  Only one slab of brickSize slices is held in memory at a time.
+  """
+  nk, nj, ni = header.shape
+  size = brickSize
+  bricksShape = tuple(-(-n // size) for n in header.shape)
+  temporaryPath = cachePath + '.partial.npy'
+  bricks = np.lib.format.open_memmap(temporaryPath, mode='w+', dtype=header.dtype.newbyteorder('='),
+                                     shape=bricksShape + (size, size, size))
+  slab = np.zeros((size, bricksShape[1] * size, bricksShape[2] * size), dtype=bricks.dtype)
+  sliceBytes = nj * ni * header.dtype.itemsize
+  with open(header.dataPath, 'rb') as f:
+    f.seek(header.dataOffset)
+    stream = _DecompressedStream(f)
+    for brickK in range(bricksShape[0]):
+      slices = min(size, nk - brickK * size)
+      data = np.frombuffer(stream.read(slices * sliceBytes), dtype=header.dtype).reshape(slices, nj, ni)
+      slab[:slices, :nj, :ni] = data
+      slab[slices:] = 0
+      bricks[brickK] = slab.reshape(size, bricksShape[1], size, bricksShape[2], size).transpose(1, 3, 0, 2, 4)
+  bricks.flush()
+  del bricks
+  os.rename(temporaryPath, cachePath)
+
+#
+# VolumeStore
+#
+
+def defaultCacheDirectory():
+  import tempfile
+  return os.path.join(tempfile.gettempdir(), 'UltrasoundSimulatorCache')
+
+class VolumeStore(object):
+  """Memory mapped access to a MetaImage or NRRD volume. Uncompressed raw data
+  is mapped in place; compressed data is converted once into a bricked cache
+  file that is reused as long as the source file is unchanged.
+
+  array is indexed (k, j, i) and can be passed to BModeRenderer in place of
+  the voxel array of a volume node.
+  """
+
+  def __init__(self, path, cacheDirectory=None, brickSize=32):
+    self.path = path
+    self.header = readVolumeHeader(path)
+    self.spacing = self.header.spacing
+    self.origin = self.header.origin
+    self.directions = self.header.directions
+    self.cachePath = None
+    if not self.header.compressed:
+      self.array = np.memmap(self.header.dataPath, dtype=self.header.dtype, mode='r',
+                             offset=self.header.dataOffset, shape=self.header.shape)
+      return
+    cacheDirectory = cacheDirectory or defaultCacheDirectory()
+    if not os.path.isdir(cacheDirectory):
+      os.makedirs(cacheDirectory)
+    self.cachePath = os.path.join(cacheDirectory, 'bricks-%s.npy' % self.cacheKey(brickSize))
+    if not os.path.exists(self.cachePath):
+      writeBrickCache(self.header, self.cachePath, brickSize)
+    self.array = BrickedVolume(np.load(self.cachePath, mmap_mode='r'), self.header.shape)
+
+  def cacheKey(self, brickSize):
+    stat = os.stat(self.header.dataPath)
+    key = '%s|%d|%d|%d' % (os.path.abspath(self.header.dataPath), stat.st_size, int(stat.st_mtime), brickSize)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
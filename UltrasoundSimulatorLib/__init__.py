@@ -0,0 +1,25 @@
+from .BModeRendering import (BModeRenderer, logCompress, mapHounsfieldToAttenuation,
+                             mapHounsfieldToImpedance, rasToIjkMatrix,
+                             scanlineEcho, scanlineEchoReference, transformPoints, trilinearSample)
+from .PostProcessing import PostProcessor, tgcProfile
+from .ProbeGeometry import ConvexProbe, LinearProbe, ProbeGeometry, probePlanePoints
+from .ScanConversion import ScanConverter, ScanConverterCache, displayShape
+from .Speckle import SpeckleModel
+from .MultiProbeRendering import MultiProbeRenderer
+from .ImagingModes import (IMAGING_MODES, DopplerRenderer, MModeRenderer, colorFlowOverlay,
+                           vesselFlowVelocities)
+from .BatchSimulation import simulateSequence
+from .FrameCache import FrameCoherenceCache, poseDifference
+from .FrameStore import FrameStore, FrameStoreWriter
+from .VolumeStore import BrickedVolume, VolumeStore, readVolumeHeader
+from .VolumePyramid import LevelOfDetailRenderer, VolumePyramid, downsampleVolume
+from .AcousticProperties import AcousticPropertyCache, AcousticPropertyVolumes, computeAcousticProperties
+from .CalibrationStateMachine import CalibrationStateMachine
+from .SphereDetection import SphereDetector, SphereFit, SpatialGrid, fitSphere, mergeVertices, readStl, writeStl
+from .LandmarkRegistration import RegistrationResult, fitLandmarkTransform, fitLandmarkTransformRansac
+from .PoseStream import (FileReplaySource, PoseStream, UdpPoseSource, matrixFromQuaternion,
+                         quaternionFromMatrix, slerp)
+from .SessionRecording import SessionRecorder, SessionRecording
+from .TransformChain import TransformChain
+from .Profiler import Profiler
+from .RenderWorker import RenderWorker